@@ -1,4 +1,9 @@
+from celery import current_app
 from django.contrib import admin
+from django.contrib.admin.views.main import ChangeList
+from django.core.exceptions import PermissionDenied
+from django.utils.encoding import force_text
+from django.utils import timezone
 from django.utils.html import format_html
 from django.conf import settings
 from django.contrib import messages
@@ -8,9 +13,13 @@ from cparte.models import Initiative, Campaign, Challenge, Channel, ExtraInfo, M
                           Account, SharePost
 import channel_middleware
 import ConfigParser
+import duplicates
 import logging
 import gettext
 import os
+import pagination
+import profiler
+import search
 
 MESSAGE_TAGS = {
     messages.SUCCESS: 'alert-success success',
@@ -22,6 +31,55 @@ logger = logging.getLogger(__name__)
 
 _ = gettext.gettext
 
+# Read the configuration file once, not for every row of the changelists
+config = ConfigParser.ConfigParser()
+config.read(os.path.join(settings.BASE_DIR, "cparte/config"))
+subdomain = config.get("app", "subdomain")
+
+
+class ApproximateCountChangeList(ChangeList):
+    """Changelist of big tables, whose totals are estimated instead of counted"""
+
+    def get_results(self, request):
+        # Both the total of the filtered rows, used by the paginator, and the total of all the rows are estimated
+        self.root_queryset = pagination.approximate(self.root_queryset)
+        self.queryset = pagination.approximate(self.queryset)
+        super(ApproximateCountChangeList, self).get_results(request)
+
+
+class IndexedSearchMixin(object):
+    """Admin whose search looks the terms up in the search index instead of scanning the texts. All the posts that
+    contain the terms are listed, not only the most relevant ones that the search of the app returns"""
+    search_kind = None
+
+    def get_search_results(self, request, queryset, search_term):
+        if not search_term:
+            return queryset, False
+        post_ids = search.get_matching_ids(search_term, self.search_kind)
+        return (queryset.filter(pk__in=post_ids) if post_ids is not None else queryset.none()), False
+
+
+class DeleteEachMixin(object):
+    """Admin whose selected rows are deleted one by one, so the counts and the search index updated by the delete of
+    the posts are kept right. The default action deletes them all at once without calling delete"""
+    actions = ['delete_each']
+
+    def get_actions(self, request):
+        actions = super(DeleteEachMixin, self).get_actions(request)
+        actions.pop('delete_selected', None)
+        return actions
+
+    def delete_each(self, request, queryset):
+        if not self.has_delete_permission(request):
+            raise PermissionDenied
+        deleted = 0
+        for obj in queryset:
+            self.log_deletion(request, obj, force_text(obj))
+            obj.delete()
+            deleted += 1
+        messages.success(request, "%s posts were deleted" % deleted)
+    delete_each.short_description = 'Delete the selected posts'
+
 
 class ChallengeFormSet(BaseInlineFormSet):
 
@@ -227,6 +285,11 @@ class CampaignAdmin(admin.ModelAdmin):
     ordering = ('id',)
     filter_horizontal = ('messages',)
     form = CampaignForm
+    list_select_related = ('initiative',)
+
+    def get_queryset(self, request):
+        qs = super(CampaignAdmin, self).get_queryset(request)
+        return qs.prefetch_related('challenge_set')
 
     def list_challenges(self, obj):
         challenges = obj.challenge_set.all()
@@ -272,6 +335,7 @@ class InitiativeForm(forms.ModelForm):
 class InitiativeAdmin(admin.ModelAdmin):
     list_display = ('id', 'name', 'organizer', 'hashtag', 'account', 'url', 'language', 'social_sharing_message')
     ordering = ('id',)
+    list_select_related = ('account',)
     form = InitiativeForm
 
 
@@ -329,6 +393,10 @@ class MessageInfoAdmin(admin.ModelAdmin):
     list_filter = ['language']
     form = MessageInfoForm
 
+    def get_queryset(self, request):
+        qs = super(MessageInfoAdmin, self).get_queryset(request)
+        return qs.prefetch_related('campaign_set__initiative')
+
     def campaign(self, obj):
         campaigns = obj.campaign_set.all()
         campaign_names = ""
@@ -368,6 +436,7 @@ class AppPostAdmin(admin.ModelAdmin):
     list_display = ('id','datetime', 'text', 'channel', 'url', 'initiative', 'campaign', 'challenge')
     ordering = ('datetime',)
     form = AppPostForm
+    list_select_related = ('channel', 'initiative', 'campaign', 'challenge')
 
     def get_queryset(self, request):
         qs = super(AppPostAdmin, self).get_queryset(request)
@@ -382,39 +451,51 @@ class AppPostAdmin(admin.ModelAdmin):
                                   "listed here. ")
 
 
-class ContributionPostAdmin(admin.ModelAdmin):
+class ContributionPostAdmin(DeleteEachMixin, IndexedSearchMixin, admin.ModelAdmin):
     list_display = ('datetime', 'author', 'zipcode', 'contribution', 'full_text', 'initiative', 'campaign', 'challenge',
-                    'channel', 'votes', 're_posts', 'bookmarks', 'source', 'view')
+                    'channel', 'votes', 're_posts', 'bookmarks', 'source', 'near_duplicates', 'view')
     list_display_links = ('contribution',)
     ordering = ('datetime',)
     list_filter = ['initiative', 'campaign', 'challenge', 'channel']
+    search_fields = ['full_text', 'contribution']
+    search_kind = search.CONTRIBUTIONS
+    list_select_related = ('author', 'initiative', 'campaign', 'challenge', 'channel')
 
     def get_queryset(self, request):
         qs = super(ContributionPostAdmin, self).get_queryset(request)
         return qs.filter(status="PE")
 
+    def get_changelist(self, request, **kwargs):
+        return ApproximateCountChangeList
+
     def view(self, obj):
         return format_html("<a href=\"" + obj.url + "\" target=\"_blank\">Link</a>")
 
     def zipcode(self, obj):
         return obj.author.zipcode
 
+    # Size of the cluster of near-duplicates of the contribution, only for the challenges with free answers
+    def near_duplicates(self, obj):
+        if not duplicates.is_indexed(obj.challenge):
+            return "-"
+        return duplicates.get_index(obj.challenge_id).cluster_size(obj.id)
+    near_duplicates.short_description = 'Near-duplicates'
+
     def has_add_permission(self, request):
         return False
 
 
 class ChannelAdmin(admin.ModelAdmin):
-    list_display = ('id','name', 'enabled', 'status', 'row_actions', 'last_message')
+    list_display = ('id','name', 'enabled', 'status', 'row_actions', 'last_message', 'stream_health',
+                    'lease')
     ordering = ('id',)
+    actions = ['profile_listener']
 
     def get_queryset(self, request):
         qs = super(ChannelAdmin, self).get_queryset(request)
-        return qs
+        return qs.prefetch_related('streampartition_set__account')
 
     def row_actions(self, obj):
-        config = ConfigParser.ConfigParser()
-        config.read(os.path.join(settings.BASE_DIR, "cparte/config"))
-        subdomain = config.get("app","subdomain")
         if subdomain:
             listen_url_href = """{0}/cparte/listen/{1}""".format(subdomain, obj.name)
             hangup_url_href = """{0}/cparte/hangup/{1}""".format(subdomain, obj.name)
@@ -432,25 +513,93 @@ class ChannelAdmin(admin.ModelAdmin):
     row_actions.short_description = 'Actions'
     row_actions.allow_tags = True
 
+    def stream_health(self, obj):
+        partitions = obj.streampartition_set.all()
+        if not obj.status or not partitions:
+            return "-"
+        return "<br>".join(["@%s: %s" % (partition.account.handler, self.partition_health(partition))
+                            for partition in partitions])
+    stream_health.short_description = 'Stream health'
+    stream_health.allow_tags = True
+
+    def partition_health(self, partition):
+        if partition.last_health_check is None:
+            return "-"
+        if partition.stalled:
+            label = """<span class="label label-danger">Stalled</span>"""
+        elif partition.shedding:
+            label = """<span class="label label-warning">Shedding load</span>"""
+        elif partition.percent_full or partition.undelivered_msgs:
+            label = """<span class="label label-warning">Falling behind</span>"""
+        else:
+            label = """<span class="label label-success">Healthy</span>"""
+        if partition.stream_lag is not None:
+            lag = "%.1fs (max %.1fs)" % (partition.stream_lag, partition.max_stream_lag)
+        else:
+            lag = "-"
+        if partition.percent_full is not None:
+            queue = "%s%% full" % partition.percent_full
+        else:
+            queue = "-"
+        if partition.reconnections:
+            reconnections = "%s (last in %.1fs), %s msgs missed" % (partition.reconnections,
+                                                                   partition.last_reconnect_time,
+                                                                   partition.missed_msgs)
+        else:
+            reconnections = "0"
+        deferred = "%s retweets, %s shares, %s chatter" % (partition.deferred_retweets, partition.deferred_shares,
+                                                           partition.deferred_chatter)
+        return """{0} {1:.1f} msgs/min | Lag: {2} | Undelivered: {3} | Queue: {4} | Reconnections: {5} |
+                  Pending: {6} | Deferred: {7} | Checked: {8}""" \
+               .format(label, partition.message_rate or 0, lag, partition.undelivered_msgs, queue, reconnections,
+                       partition.queue_depth or 0, deferred, partition.last_health_check.strftime("%Y-%m-%d %H:%M:%S"))
+
+    def lease(self, obj):
+        partitions = [partition for partition in obj.streampartition_set.all() if partition.lease_owner]
+        if not partitions:
+            return "-"
+        return "<br>".join(["@%s: %s until %s" % (partition.account.handler, partition.lease_owner,
+                                                  timezone.localtime(partition.lease_expires).strftime("%H:%M:%S"))
+                            for partition in partitions])
+    lease.short_description = 'Listeners'
+    lease.allow_tags = True
+
+    def profile_listener(self, request, queryset):
+        seconds = profiler.profiler_settings['seconds']
+        replies = current_app.control.broadcast('start_profiler', arguments={'seconds': seconds}, reply=True,
+                                                timeout=2)
+        if replies:
+            workers = ", ".join([worker for reply in replies for worker in reply.keys()])
+            messages.success(request, "The profiler was turned on during %s seconds in: %s. The profiles will be saved "
+                                      "in %s" % (seconds, workers, profiler.profiler_settings['output_dir']))
+        else:
+            messages.error(request, "None of the workers answered, the profiler couldn't be turned on")
+    profile_listener.short_description = 'Profile the listener and the workers'
+
 
 class AccountAdmin(admin.ModelAdmin):
     list_display = ('id','owner','id_in_channel','handler','url','channel')
     ordering = ('id',)
+    list_select_related = ('channel',)
 
 
 class ChallengeAdmin(admin.ModelAdmin):
     list_display = ('id','name','initiative','campaign','hashtag','style_answer','format_answer','max_length_answer')
     ordering = ('id',)
+    list_select_related = ('campaign__initiative',)
 
     def initiative(self, obj):
         return obj.campaign.initiative.name
 
 
-class SharePostAdmin(admin.ModelAdmin):
+class SharePostAdmin(DeleteEachMixin, IndexedSearchMixin, admin.ModelAdmin):
     list_display = ('id','datetime', 'author', 'text', 'channel', 'url', 'initiative', 'votes', 're_posts', 'bookmarks',
                     'similarity_per', 'view')
     ordering = ('datetime',)
     list_filter = ['initiative', 'channel']
+    search_fields = ['text']
+    search_kind = search.SHARES
+    list_select_related = ('author', 'channel', 'initiative')
 
     def view(self, obj):
         return format_html("<a href=\"" + obj.url + "\" target=\"_blank\">Link</a>")
@@ -458,6 +607,9 @@ class SharePostAdmin(admin.ModelAdmin):
     def has_add_permission(self, request):
         return False
 
+    def get_changelist(self, request, **kwargs):
+        return ApproximateCountChangeList
+
     def similarity_per(self, obj):
         return "%s%%" % obj.similarity
     similarity_per.short_description = 'Similarity'
@@ -0,0 +1,14 @@
+from django.apps import AppConfig
+
+
+class CparteConfig(AppConfig):
+    name = 'cparte'
+
+    def ready(self):
+        from cparte import duplicates, feed, subscriptions
+        # Update the streams when the hashtags change
+        subscriptions.connect_signals()
+        # Index the contributions when they are preserved and remove them when they are discarded
+        duplicates.connect_signals()
+        # Send the preserved contributions to the live feed
+        feed.connect_signals()
@@ -0,0 +1,206 @@
+# ----------------------------------------------
+# Offline benchmark of the post processing
+# pipeline. Synthetic tweets, in the same shape
+# that TwitterListener.get_tweet_dict produces,
+# are pushed through post_manager.manage_post
+# while the messages that the app would send
+# are recorded instead of being published.
+# ----------------------------------------------
+
+from cparte.models import AppPost, Challenge, Channel
+from social_network import Twitter
+
+import bisect
+import channel_middleware
+import datetime
+import json
+import logging
+import post_manager
+import query_budget
+import random
+import time
+
+# Default mix of post types
+DEFAULT_MIX = {'hashtag': 0.6, 'reply': 0.2, 'sharing': 0.1, 'retweet': 0.1}
+GRADES = ["A", "A+", "B", "B-", "C", "D", "F"]
+FREE_ANSWERS = ["More parks", "Better public transport", "Water supply", "Cheaper housing", "Safer streets"]
+INVALID_ANSWERS = ["Excellent", "Not sure", "meh"]
+URL = "https://twitter.com/"
+
+
+class TweetGenerator(object):
+    """Generate reproducible synthetic tweets for the initiatives stored in the db"""
+
+    def __init__(self, initiative_ids, seed=0, num_authors=1000, zipf_exponent=1.1, mix=None,
+                 structured_ratio=0.7, invalid_ratio=0.1):
+        self.random = random.Random(seed)
+        self.num_authors = num_authors
+        self.mix = mix or DEFAULT_MIX
+        self.structured_ratio = structured_ratio
+        self.invalid_ratio = invalid_ratio
+        self.next_id = 700000000000000000
+        self.num_posts = 0
+        self.start_datetime = datetime.datetime(2014, 10, 1, 12, 0)
+        # Cumulative weights of the authors, the author with rank k posts proportionally to 1/k^s
+        self.author_weights = []
+        total = 0.0
+        for rank in range(1, num_authors + 1):
+            total += 1.0 / (rank ** zipf_exponent)
+            self.author_weights.append(total)
+        self.post_types = sorted(self.mix.keys())
+        self.type_weights = []
+        total = 0.0
+        for post_type in self.post_types:
+            total += self.mix[post_type]
+            self.type_weights.append(total)
+        challenges = Challenge.objects.filter(campaign__initiative__in=initiative_ids).\
+            select_related('campaign__initiative').order_by('id')
+        self.structured_challenges = [c for c in challenges if c.style_answer == post_manager.STRUCTURED_ANSWER]
+        self.free_challenges = [c for c in challenges if c.style_answer == post_manager.FREE_ANSWER]
+        self.engagement_posts = list(AppPost.objects.filter(initiative__in=initiative_ids,
+                                                            category=post_manager.ENGAGE_MESSAGE,
+                                                            app_parent_post=None).
+                                     select_related('challenge', 'initiative__account'))
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        post_type = self.post_types[self._pick(self.type_weights)]
+        author = self.get_author(self._pick(self.author_weights))
+        if post_type == "reply" and self.engagement_posts:
+            app_post = self.random.choice(self.engagement_posts)
+            return self.build_post(app_post.initiative.account.handler + " " + self.get_answer(app_post.challenge),
+                                   author, parent_id=app_post.id_in_channel)
+        challenge = self.get_challenge()
+        initiative = challenge.campaign.initiative
+        text = "%s #%s #%s" % (self.get_answer(challenge), challenge.hashtag, initiative.hashtag)
+        if post_type == "sharing":
+            sharing_text = initiative.social_sharing_message or "I just took part in #%s" % initiative.hashtag
+            return self.build_post("%s #%s" % (sharing_text, challenge.hashtag), author, sharing_post=True)
+        elif post_type == "retweet":
+            org_author = self.get_author(self._pick(self.author_weights))
+            org_post = self.build_post(text, org_author)
+            return self.build_post("RT @%s: %s" % (org_author["screen_name"], text), author, org_post=org_post)
+        else:
+            return self.build_post(text, author)
+
+    def _pick(self, cumulative_weights):
+        return bisect.bisect(cumulative_weights, self.random.random() * cumulative_weights[-1])
+
+    def get_author(self, rank):
+        return {"id": str(3000000000 + rank), "name": "Participant %s" % rank, "screen_name": "participant%s" % rank}
+
+    def get_challenge(self):
+        if self.free_challenges and (not self.structured_challenges or self.random.random() >= self.structured_ratio):
+            return self.random.choice(self.free_challenges)
+        return self.random.choice(self.structured_challenges)
+
+    def get_answer(self, challenge):
+        if self.random.random() < self.invalid_ratio:
+            return self.random.choice(INVALID_ANSWERS)
+        if challenge.style_answer == post_manager.STRUCTURED_ANSWER:
+            return self.random.choice(GRADES)
+        return self.random.choice(FREE_ANSWERS)
+
+    def build_post(self, text, author, parent_id=None, sharing_post=False, org_post=None):
+        self.next_id += 1
+        self.num_posts += 1
+        post_id = str(self.next_id)
+        hashtags = [word[1:].lower() for word in text.split() if word.startswith("#")]
+        return {"id": post_id, "text": text, "parent_id": parent_id,
+                "datetime": self.start_datetime + datetime.timedelta(seconds=self.num_posts),
+                "url": URL + author["screen_name"] + "/status/" + post_id, "votes": 0, "re_posts": 0,
+                "bookmarks": 0, "hashtags": hashtags,
+                "source": "Twitter for Websites" if sharing_post else "Twitter Web Client",
+                "sharing_post": sharing_post,
+                "author": {"id": author["id"], "name": author["name"], "screen_name": author["screen_name"],
+                           "print_name": "@" + author["screen_name"], "url": URL + author["screen_name"],
+                           "description": "", "language": "en", "posts_count": 100, "friends": 100,
+                           "followers": 100, "groups": 0},
+                "channel": "twitter", "org_post": org_post}
+
+
+class RecordingSender(object):
+    """Stand-in of Twitter.send_message that records the messages instead of publishing them"""
+
+    def __init__(self):
+        self.next_id = 800000000000000000
+        self.sent = 0
+        self.org_send_message = None
+
+    def send_message(self, message, type_msg, payload, recipient_id, channel_url):
+        self.next_id += 1
+        self.sent += 1
+        post_id = str(self.next_id)
+        return {'delivered': True, 'response': {"id": post_id, "text": message,
+                                                "url": channel_url + "app/status/" + post_id}}
+
+    def __enter__(self):
+        self.org_send_message = Twitter.__dict__['send_message']
+        Twitter.send_message = staticmethod(self.send_message)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        Twitter.send_message = self.org_send_message
+        return False
+
+
+def percentile(values, per):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = int(round(per / 100.0 * (len(ordered) - 1)))
+    return ordered[index]
+
+
+def summarize(values):
+    if not values:
+        return {}
+    return {'mean': sum(values) / float(len(values)), 'p50': percentile(values, 50), 'p90': percentile(values, 90),
+            'p99': percentile(values, 99), 'max': max(values)}
+
+
+def run(num_posts, initiative_ids, channel_name="twitter", **generator_options):
+    channel = Channel.objects.get(name=channel_name)
+    channel.connect("", json.dumps(channel_middleware.get_session_info(initiative_ids)))
+    generator = TweetGenerator(initiative_ids, **generator_options)
+    latencies = []
+    queries = []
+    sql_times = []
+    outcomes = {}
+    org_url_shortener = post_manager.url_shortener_enabled
+    post_manager.url_shortener_enabled = False
+    logging.disable(logging.CRITICAL)  # Logging is not under test
+    try:
+        with RecordingSender() as sender:
+            start = time.time()
+            for _ in range(num_posts):
+                post = generator.next()
+                post_start = time.time()
+                with query_budget.QueryTracker("benchmark", post["id"], enabled=True) as tracker:
+                    output = post_manager.manage_post(post)
+                latencies.append((time.time() - post_start) * 1000)
+                queries.append(tracker.num_queries)
+                sql_times.append(tracker.sql_time)
+                outcome = output.category if output is not None else "ignored"
+                outcomes[outcome] = outcomes.get(outcome, 0) + 1
+            elapsed = time.time() - start
+    finally:
+        logging.disable(logging.NOTSET)
+        post_manager.url_shortener_enabled = org_url_shortener
+    return {'posts': num_posts, 'elapsed_sec': elapsed, 'posts_per_sec': num_posts / elapsed if elapsed else None,
+            'latency_ms': summarize(latencies), 'queries_per_post': summarize(queries),
+            'sql_time_ms_per_post': summarize(sql_times), 'messages_sent': sender.sent, 'outcomes': outcomes}
+
+
+def compare(current, previous):
+    deltas = {}
+    for metric, key in (('posts_per_sec', None), ('latency_ms', 'p50'), ('latency_ms', 'p99'),
+                        ('queries_per_post', 'mean')):
+        old = previous[metric] if key is None else previous[metric].get(key)
+        new = current[metric] if key is None else current[metric].get(key)
+        name = metric if key is None else "%s.%s" % (metric, key)
+        if old:
+            deltas[name] = {'previous': old, 'current': new, 'change_per': (new - old) * 100.0 / old}
+    return deltas
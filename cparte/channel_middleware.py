@@ -1,94 +1,110 @@
 from celery.result import AsyncResult
 from django.utils import timezone
-from cparte.models import Channel, Initiative, Account, Campaign, AppPost, Challenge, ContributionPost
+from cparte.models import Channel, Initiative, Campaign, AppPost, Challenge, ContributionPost, StreamPartition
 from social_network import Twitter, Facebook, GooglePlus
 
 import json
 import logging
+import partitioning
 import post_manager
+import query_budget
+import runtime
 
 logger = logging.getLogger(__name__)
 
 
 def process_post(post, channel_name):
-    channel_name = channel_name.lower()
-    channel = Channel.objects.get(name=channel_name)
-    ts_last_message = channel.last_message
-    now = timezone.now()
-    if ts_last_message is None:
-        channel.update_last_message_ts(now)
-    else:
-        delta = now - ts_last_message
-        # Update last message timestamp every 15 minutes
-        if (delta.seconds/60) >= 15:
-            channel.update_last_message_ts(now)
-    post_manager.manage_post(post)
+    with query_budget.track("manage_post", post["id"]):
+        return post_manager.manage_post(post)
 
 
-def connect(initiative_ids, channel_name):
+def connect(initiative_ids, channel_name, session_info=None, keep_checkpoint=False):
     channel_name = channel_name.lower()
     channel = Channel.objects.get(name=channel_name)
 
-    session_info = get_session_info(initiative_ids)
+    if session_info is None:
+        session_info = get_session_info(initiative_ids)
     if channel_name.lower() == "twitter":
-        task = Twitter.listen.delay(session_info["accounts"], session_info["hashtags"])
-        task_id = task.id
-        logger.info("Start listening Twitter channel")
+        # The terms are split into one stream per account, each one listened by its own task
+        partitions = partitioning.assign(channel, initiative_ids, keep_checkpoint)
+        channel.connect("", json.dumps(session_info))
+        launch_listeners(partitions)
+        logger.info("Start listening Twitter channel through %s streams" % len(partitions))
     elif channel_name.lower() == "facebook":
         Facebook.listen(session_info["accounts"], session_info["hashtags"])  # Add .delay
-        task_id = None
+        channel.connect(None, json.dumps(session_info))
     elif channel_name.lower() == "googleplus":
         GooglePlus.listen(session_info["accounts"], session_info["hashtags"])  # Add .delay
-        task_id = None
+        channel.connect(None, json.dumps(session_info))
     else:
         logger.error("Unknown channel: %s" % channel_name)
         return None
-    channel.connect(task_id, json.dumps(session_info))
 
 
+# Launch a Celery task per partition, unless the partitions are listened by a runtime, which picks them up by itself
+def launch_listeners(partitions):
+    if runtime.runtime_settings['enabled']:
+        return
+    for partition in partitions:
+        task = Twitter.listen.delay(partition.id)
+        StreamPartition.objects.filter(pk=partition.id).update(task_id=task.id)
+
+
+# The initiatives, their accounts, campaigns and challenges are loaded at once
 def get_session_info(initiative_ids):
-    hashtags = None
-    account_ids = []
+    initiatives = Initiative.objects.filter(pk__in=initiative_ids).select_related('account').\
+        prefetch_related('campaign_set__challenge_set')
+    initiatives = dict((initiative.id, initiative) for initiative in initiatives)
+    hashtags = []
+    accounts = []
     for id_initiative in initiative_ids:
-        try:
-            initiative = Initiative.objects.get(pk=id_initiative)
-        except Initiative.DoesNotExist:
+        if id_initiative not in initiatives:
             e_msg = "Does not exist an initiative identified with the id %s" % id_initiative
             logger.critical(e_msg)
             raise Exception(e_msg)
-
-        if hashtags:
-            hashtags.append(initiative.hashtag)
-        else:
-            hashtags = [initiative.hashtag]
-        account_ids.append(initiative.account.id)
-
-        # Add to the array of hashtags the hashtags of the initiative's campaigns
-        for campaign in initiative.campaign_set.all():
-            if campaign.hashtag is not None:
-                hashtags.append(campaign.hashtag)
-            # Add to the array of hashtags the hashtags of the campaign's challenges
-            for challenge in campaign.challenge_set.all():
-                hashtags.append(challenge.hashtag)
-    accounts = get_accounts(account_ids)
+        initiative = initiatives[id_initiative]
+        # The hashtags of the initiative, its campaigns and their challenges
+        for hashtag in partitioning.get_initiative_terms(initiative):
+            if hashtag not in hashtags:
+                hashtags.append(hashtag)
+        accounts.append(initiative.account.id_in_channel)
     session_info = {"initiative_ids": initiative_ids, "hashtags": hashtags, "accounts": accounts}
 
     return session_info
 
 
-def get_accounts(account_ids):
-    accounts = []
-    for id_account in account_ids:
-        try:
-            accounts.append(Account.objects.get(pk=id_account).id_in_channel)
-        except Account.DoesNotExist:
-            e_msg = "The account identified with the id %s does not exist" % id_account
-            logger.critical(e_msg)
-            raise Exception(e_msg)
-    return accounts
+# Apply the changes of the hashtags of the initiatives to the streams of a connected channel. The listeners of the
+# partitions that remain subscribe to their new terms by themselves, the new partitions get their own listener
+def update_subscriptions(channel_name):
+    channel_name = channel_name.lower()
+    try:
+        channel = Channel.objects.get(name=channel_name)
+    except Channel.DoesNotExist:
+        logger.error("Cannot update the subscriptions, channel %s couldn't be found" % channel_name)
+        return None
+    if not channel.status or not channel.session_info or channel_name != "twitter":
+        return None
+    session_info = json.loads(channel.session_info)
+    # The initiatives removed in the meantime aren't listened anymore
+    existing_ids = set(Initiative.objects.filter(pk__in=session_info["initiative_ids"]).values_list('id', flat=True))
+    initiative_ids = [id_initiative for id_initiative in session_info["initiative_ids"] if id_initiative in existing_ids]
+    if not initiative_ids:
+        logger.error("Cannot update the subscriptions of %s, none of its initiatives exists" % channel_name)
+        return None
+    current_ids = set(channel.streampartition_set.values_list('id', flat=True))
+    partitions = partitioning.assign(channel, initiative_ids, keep_checkpoint=True)
+    Channel.objects.filter(pk=channel.pk).update(session_info=json.dumps(get_session_info(initiative_ids)))
+    launch_listeners([partition for partition in partitions if partition.id not in current_ids])
+    logger.info("The subscriptions of %s were updated" % channel_name)
+    return partitions
 
 
 def send_message(channel_name, message, type_msg, payload, recipient_id=None):
+    with query_budget.track("send_message", payload["post_id"]):
+        do_send_message(channel_name, message, type_msg, payload, recipient_id)
+
+
+def do_send_message(channel_name, message, type_msg, payload, recipient_id):
     channel_obj = Channel.objects.get(name=channel_name)
     url = channel_obj.url
 
@@ -150,12 +166,18 @@ def disconnect(channel_name):
     channel_name = channel_name.lower()
     try:
         ch = Channel.objects.get(name=channel_name)
-        task_id = ch.streaming_pid
+        task_ids = [ch.streaming_pid] + list(ch.streampartition_set.values_list('task_id', flat=True))
         ch.disconnect()
-        task = AsyncResult(task_id)
-        if not task.ready():
-            # Force to hangup if the channel wasn't disconnected already
-            task.revoke(terminate=True, signal='SIGTERM')
+        forced = False
+        for task_id in task_ids:
+            if not task_id:
+                continue
+            task = AsyncResult(task_id)
+            if not task.ready():
+                # Force to hangup if the stream wasn't disconnected already
+                task.revoke(terminate=True, signal='SIGTERM')
+                forced = True
+        if forced:
             logger.info("Channel %s was forced to disconnect" % channel_name)
         else:
             logger.info("Channel %s was already disconnected" % channel_name)
@@ -163,8 +185,18 @@ def disconnect(channel_name):
         logger.error("Cannot disconnect, channel %s couldn't be found" % channel_name)
 
 
-# Auto-recovery the channel when it crashes
+# Auto-recovery the channel when it crashes. The channel is reconnected with the session it had, so the new listener
+# resumes from the last message processed
 def auto_recovery(channel_name):
+    channel_name = channel_name.lower()
+    try:
+        session_info = Channel.objects.get(name=channel_name).session_info
+    except Channel.DoesNotExist:
+        logger.error("Cannot recover, channel %s couldn't be found" % channel_name)
+        return None
+    if not session_info:
+        logger.error("Cannot recover the channel %s, its session is unknown" % channel_name)
+        return None
+    session_info = json.loads(session_info)
     disconnect(channel_name)
-    initiative_ids = [1,2]  # Need to be dynamic
-    connect(initiative_ids, channel_name)
\ No newline at end of file
+    connect(session_info["initiative_ids"], channel_name, session_info, keep_checkpoint=True)
\ No newline at end of file
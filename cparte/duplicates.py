@@ -0,0 +1,301 @@
+# ----------------------------------------------
+# Near-duplicate contributions of the challenges
+# with free answers. Each permanent contribution
+# gets a MinHash signature of its text and is
+# put in the buckets of the bands of its
+# signature (LSH), so it is compared only with
+# the posts that share a bucket with it. The
+# similar posts are joined into clusters. The
+# signatures, and the ids of the contributions
+# discarded later, are appended to a file per
+# challenge, from which the index is loaded by
+# every process.
+# ----------------------------------------------
+
+from django.conf import settings
+from cparte.models import ContributionPost, contribution_preserved, contribution_discarded
+
+import ConfigParser
+import errno
+import logging
+import numpy
+import os
+import re
+import tempfile
+import threading
+import uuid
+import zlib
+
+logger = logging.getLogger(__name__)
+
+# Set the parameters of the index from the configuration file
+config = ConfigParser.ConfigParser()
+config.read(os.path.join(settings.BASE_DIR, "cparte/config"))
+
+duplicate_settings = {'num_perm': 128, 'bands': 32, 'shingle_size': 4, 'threshold': 0.6, 'chunk_size': 1000,
+                      'index_dir': os.path.join(settings.BASE_DIR, "duplicates")}
+if config.has_section('duplicates'):
+    # Number of hash functions of the signatures, split in bands of num_perm / bands values
+    duplicate_settings['num_perm'] = config.getint('duplicates', 'num_perm')
+    duplicate_settings['bands'] = config.getint('duplicates', 'bands')
+    # Characters of the pieces in which the texts are split
+    duplicate_settings['shingle_size'] = config.getint('duplicates', 'shingle_size')
+    # Share of the pieces of two texts in common from which they are near-duplicates
+    duplicate_settings['threshold'] = config.getfloat('duplicates', 'threshold')
+    duplicate_settings['chunk_size'] = config.getint('duplicates', 'chunk_size')
+    duplicate_settings['index_dir'] = os.path.join(settings.BASE_DIR, config.get('duplicates', 'index_dir'))
+
+PRIME = (1 << 31) - 1
+lock = threading.Lock()
+indexes = {}
+permutations = {}
+
+
+# Texts that differ only in case, punctuation or spacing are the same text
+def normalize(text):
+    return " ".join(re.findall(r"\w+", text.lower(), re.UNICODE))
+
+
+def get_shingles(text, size):
+    text = normalize(text)
+    if len(text) <= size:
+        return set([text])
+    return set(text[i:i + size] for i in range(len(text) - size + 1))
+
+
+# Hash functions (a * x + b) % PRIME of the signatures, the same in every process
+def get_permutations(num_perm):
+    if num_perm not in permutations:
+        generator = numpy.random.RandomState(1)
+        permutations[num_perm] = (generator.randint(1, PRIME, num_perm).astype(numpy.int64),
+                                  generator.randint(0, PRIME, num_perm).astype(numpy.int64))
+    return permutations[num_perm]
+
+
+def get_signature(text):
+    a, b = get_permutations(duplicate_settings['num_perm'])
+    hashes = numpy.array([zlib.crc32(shingle.encode("utf-8")) & 0xffffffff
+                          for shingle in get_shingles(text, duplicate_settings['shingle_size'])], dtype=numpy.int64)
+    return ((a[:, None] * (hashes % PRIME)[None, :] + b[:, None]) % PRIME).min(axis=1)
+
+
+class DuplicateIndex(object):
+    """LSH index of the signatures of the contributions of a challenge and the clusters of near-duplicates"""
+
+    def __init__(self, challenge_id, index_dir=None):
+        self.challenge_id = challenge_id
+        self.path = os.path.join(index_dir or duplicate_settings['index_dir'], "challenge-%s.txt" % challenge_id)
+        self.bands = duplicate_settings['bands']
+        self.threshold = duplicate_settings['threshold']
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.header = None  # First line of the file, with the generation of the index
+        self.offset = 0  # Bytes of the file already loaded
+        self.signatures = {}
+        self.buckets = {}
+        self.parents = {}
+        self.members = {}  # Posts of each cluster by the post at its root
+
+    def find(self, post_id):
+        root = post_id
+        while self.parents[root] != root:
+            root = self.parents[root]
+        while self.parents[post_id] != root:
+            self.parents[post_id], post_id = root, self.parents[post_id]
+        return root
+
+    def join(self, post_id, other_id):
+        root, other_root = self.find(post_id), self.find(other_id)
+        if root != other_root:
+            if len(self.members[root]) < len(self.members[other_root]):
+                root, other_root = other_root, root
+            self.parents[other_root] = root
+            self.members[root].update(self.members.pop(other_root))
+
+    def get_buckets(self, signature):
+        return [(band, values.tobytes()) for band, values in enumerate(numpy.array_split(signature, self.bands))]
+
+    # Join the post with the posts of its buckets that are similar to it, among the candidates if they are given
+    def join_similar(self, post_id, candidates=None):
+        signature = self.signatures[post_id]
+        similar = set()
+        for bucket in self.get_buckets(signature):
+            similar.update(other_id for other_id in self.buckets[bucket]
+                           if other_id != post_id and (candidates is None or other_id in candidates))
+        for other_id in similar:
+            # The share of equal values of two signatures estimates the share of pieces in common of the texts
+            if numpy.mean(self.signatures[other_id] == signature) >= self.threshold:
+                self.join(post_id, other_id)
+
+    def add(self, post_id, signature):
+        if post_id in self.signatures:
+            return
+        self.signatures[post_id] = signature
+        self.parents[post_id] = post_id
+        self.members[post_id] = set([post_id])
+        for bucket in self.get_buckets(signature):
+            self.buckets.setdefault(bucket, []).append(post_id)
+        self.join_similar(post_id)
+
+    # The post may be the only link between other posts of its cluster, so only the posts of its cluster are joined
+    # again, the other clusters never matched them
+    def remove(self, post_id):
+        if post_id not in self.signatures:
+            return
+        members = self.members.pop(self.find(post_id))
+        members.discard(post_id)
+        for bucket in self.get_buckets(self.signatures.pop(post_id)):
+            self.buckets[bucket].remove(post_id)
+            if not self.buckets[bucket]:
+                del self.buckets[bucket]
+        del self.parents[post_id]
+        for member_id in members:
+            self.parents[member_id] = member_id
+            self.members[member_id] = set([member_id])
+        for member_id in sorted(members):
+            self.join_similar(member_id, members)
+
+    # Load the lines appended to the file since the last load, by this or other processes
+    def refresh(self):
+        with self.lock:
+            if not os.path.exists(self.path):
+                return
+            with open(self.path) as index_file:
+                header = index_file.readline()
+                if header != self.header:
+                    # The index was rebuilt, by this or another process, and replaced the file
+                    self.clear()
+                    self.header = header
+                    self.offset = len(header)
+                index_file.seek(self.offset)
+                lines = index_file.read()
+            # The last line may still be being written
+            lines = lines[:lines.rfind("\n") + 1]
+            self.offset += len(lines)
+            for line in lines.splitlines():
+                if line.startswith("-"):
+                    self.remove(int(line[1:]))
+                else:
+                    values = [int(value) for value in line.split()]
+                    self.add(values[0], numpy.array(values[1:], dtype=numpy.int64))
+
+    def write(self, lines):
+        # The file is created with its header at once, unless another process created it first
+        create_file(self.path, [], replace=False)
+        with open(self.path, "a") as index_file:
+            index_file.write(lines)
+        self.refresh()
+
+    def append(self, posts):
+        self.write(get_lines(posts))
+
+    def discard(self, post_ids):
+        self.write("".join("-%s\n" % post_id for post_id in post_ids))
+
+    def cluster_size(self, post_id):
+        return len(self.members[self.find(post_id)]) if post_id in self.parents else 0
+
+    # Clusters of near-duplicates with at least min_size posts, the biggest first
+    def get_clusters(self, min_size=2):
+        return sorted((sorted(cluster) for cluster in self.members.values() if len(cluster) >= min_size),
+                      key=lambda cluster: (-len(cluster), cluster[0]))
+
+
+def get_lines(posts):
+    return "".join("%s %s\n" % (post_id, " ".join(str(value) for value in get_signature(text)))
+                   for post_id, text in posts)
+
+
+# Write the file with a new generation, and the chunks of lines, into a temporary file that takes its place, so the
+# processes reading the file never see it half written. The file in place is kept unless replace is given
+def create_file(path, chunks, replace=True):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    if not replace and os.path.exists(path):
+        return
+    descriptor, temp_path = tempfile.mkstemp(dir=directory)
+    try:
+        with os.fdopen(descriptor, "w") as temp_file:
+            temp_file.write("# %s\n" % uuid.uuid4().hex)
+            for lines in chunks:
+                temp_file.write(lines)
+        if replace:
+            os.rename(temp_path, path)
+        else:
+            try:
+                os.link(temp_path, path)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def get_index(challenge_id):
+    with lock:
+        if challenge_id not in indexes:
+            indexes[challenge_id] = DuplicateIndex(challenge_id)
+        index = indexes[challenge_id]
+    index.refresh()
+    return index
+
+
+def is_indexed(challenge):
+    return challenge.style_answer == "FR"
+
+
+# The errors are logged, a contribution missing from the index is found again by the next rebuild
+def index_post(post):
+    if not is_indexed(post.challenge):
+        return
+    try:
+        get_index(post.challenge_id).append([(post.id, post.contribution)])
+    except (IOError, OSError, ValueError) as e:
+        logger.error("The contribution %s couldn't be indexed. %s" % (post.id, e))
+
+
+def discard_post(post, post_id):
+    if not is_indexed(post.challenge):
+        return
+    try:
+        get_index(post.challenge_id).discard([post_id])
+    except (IOError, OSError, ValueError) as e:
+        logger.error("The contribution %s couldn't be removed from the index. %s" % (post_id, e))
+
+
+# Lines of the permanent contributions of the challenge, reading them in chunks ordered by id
+def get_chunks(challenge, chunk_size):
+    posts = ContributionPost.objects.filter(challenge=challenge, status="PE")
+    last_id = 0
+    while True:
+        chunk = list(posts.filter(id__gt=last_id).order_by('id').values_list('id', 'contribution')[:chunk_size])
+        yield get_lines(chunk)
+        if len(chunk) < chunk_size:
+            break
+        last_id = chunk[-1][0]
+
+
+# Index again the permanent contributions of the challenge. The file is replaced once it's written, so the processes
+# keep using the previous index meanwhile. The contributions preserved or discarded while the index is rebuilt may be
+# missed
+def rebuild(challenge, chunk_size=None):
+    chunk_size = chunk_size or duplicate_settings['chunk_size']
+    create_file(DuplicateIndex(challenge.id).path, get_chunks(challenge, chunk_size))
+    return get_index(challenge.id)
+
+
+def contribution_was_preserved(sender, post, **kwargs):
+    index_post(post)
+
+
+def contribution_was_discarded(sender, post, post_id, **kwargs):
+    discard_post(post, post_id)
+
+
+def connect_signals():
+    contribution_preserved.connect(contribution_was_preserved, dispatch_uid="duplicates_contribution_preserved")
+    contribution_discarded.connect(contribution_was_discarded, dispatch_uid="duplicates_contribution_discarded")
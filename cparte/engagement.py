@@ -0,0 +1,106 @@
+# ----------------------------------------------
+# Refresh of the re-posts and bookmarks of the
+# posts, which are captured when the posts are
+# received and keep growing afterwards. A
+# periodic task walks the recent posts of the
+# channel from the most recent, looks them up
+# in batches of 100 and writes back only the
+# ones whose numbers changed. The channel keeps
+# the publication time up to which the current
+# pass got, so a pass spans as many runs as the
+# rate limits require, and the next pass starts
+# once the refresh interval passed.
+# ----------------------------------------------
+
+from django.conf import settings
+from django.utils import timezone
+from cparte.models import Channel, ContributionPost, SharePost, AppPost
+from social_network import Twitter
+
+import ConfigParser
+import datetime
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# Set the budget of the refresh from the configuration file
+config = ConfigParser.ConfigParser()
+config.read(os.path.join(settings.BASE_DIR, "cparte/config"))
+
+engagement_settings = {'max_age': 30, 'refresh_interval': 3600, 'max_lookups': 60, 'batch_size': 100}
+if config.has_section('engagement'):
+    # Days after their publication during which the posts are refreshed
+    engagement_settings['max_age'] = config.getint('engagement', 'max_age')
+    # Seconds between the starts of the passes that refresh the recent posts
+    engagement_settings['refresh_interval'] = config.getint('engagement', 'refresh_interval')
+    # Calls to statuses/lookup per run. Twitter allows 180 calls every 15 minutes
+    engagement_settings['max_lookups'] = config.getint('engagement', 'max_lookups')
+
+
+# Recent posts of the channel published before the cursor, the most recent first, as (publication time, model, pk,
+# id in the channel, re-posts, bookmarks)
+def get_due_posts(channel, cursor, limit, now=None):
+    now = now or timezone.now()
+    published_after = now - datetime.timedelta(days=engagement_settings['max_age'])
+    due = []
+    for model in (ContributionPost, SharePost, AppPost):
+        posts = model.objects.filter(channel=channel, datetime__gte=published_after, datetime__lt=cursor)
+        if model is AppPost:
+            posts = posts.filter(delivered=True)
+        rows = posts.order_by('-datetime').values_list('datetime', 'id', 'id_in_channel', 're_posts', 'bookmarks')
+        due.extend((published, model, pk, post_id, re_posts, bookmarks)
+                   for published, pk, post_id, re_posts, bookmarks in rows[:limit])
+    due.sort(key=lambda row: row[0], reverse=True)
+    return due[:limit]
+
+
+# Publication time down to which the first posts were refreshed. The posts published at the same time as the next
+# one, which wasn't refreshed, are left for the next run
+def get_cursor(posts, refreshed, cursor):
+    times = [row[0] for row in posts[:refreshed]]
+    if refreshed < len(posts):
+        times = [published for published in times if published > posts[refreshed][0]]
+    return times[-1] if times else cursor
+
+
+# Write the numbers of the posts that changed. The posts with the same numbers are updated together
+def save_metrics(posts, statuses):
+    changed = {}
+    for _, model, pk, post_id, re_posts, bookmarks in posts:
+        status = statuses.get(post_id)
+        if status is not None and (status.retweet_count, status.favorite_count) != (re_posts, bookmarks):
+            changed.setdefault((model, status.retweet_count, status.favorite_count), []).append(pk)
+    for (model, re_posts, bookmarks), pks in changed.items():
+        model.objects.filter(pk__in=pks).update(re_posts=re_posts, bookmarks=bookmarks)
+    return sum(len(pks) for pks in changed.values())
+
+
+def refresh(channel_name="twitter", max_lookups=None):
+    max_lookups = max_lookups or engagement_settings['max_lookups']
+    batch_size = engagement_settings['batch_size']
+    channel = Channel.objects.get(name=channel_name)
+    now = timezone.now()
+    cursor, started = channel.metrics_cursor, channel.metrics_pass_started
+    if cursor is None:
+        if started is not None and started > now - datetime.timedelta(seconds=engagement_settings['refresh_interval']):
+            return 0
+        # A new pass starts from the most recent posts
+        cursor = started = now
+    limit = max_lookups * batch_size
+    # One post more than the budget tells whether the pass ends in this run
+    posts = get_due_posts(channel, cursor, limit + 1, now)
+    refreshed = updated = 0
+    try:
+        while refreshed < min(len(posts), limit):
+            batch = posts[refreshed:refreshed + batch_size]
+            post_ids = list(set(post_id for _, _, _, post_id, _, _ in batch))
+            statuses = dict((status.id_str, status) for status in Twitter.lookup_posts(post_ids))
+            updated += save_metrics(batch, statuses)
+            refreshed += len(batch)
+    finally:
+        # The batches refreshed are kept even if a lookup fails, e.g. because of the rate limit
+        cursor = None if refreshed == len(posts) else get_cursor(posts, refreshed, cursor)
+        Channel.objects.filter(pk=channel.pk).update(metrics_cursor=cursor, metrics_pass_started=started)
+    logger.info("The metrics of %s posts of %s were refreshed, %s of them changed" % (refreshed, channel_name, updated))
+    return updated
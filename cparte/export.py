@@ -0,0 +1,109 @@
+# ----------------------------------------------
+# Export of the permanent contributions, joined
+# with their author and challenge. The rows are
+# read in chunks ordered by the time in which the
+# contributions were preserved and written out as
+# they are read, so the memory used is the same
+# whatever the size of the table.
+# ----------------------------------------------
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from cparte.models import ContributionPost
+
+import ConfigParser
+import csv
+import datetime
+import json
+import os
+
+# Set the size of the chunks from the configuration file
+config = ConfigParser.ConfigParser()
+config.read(os.path.join(settings.BASE_DIR, "cparte/config"))
+
+export_settings = {'chunk_size': 1000}
+if config.has_section('export'):
+    export_settings['chunk_size'] = config.getint('export', 'chunk_size')
+
+# Columns of the export and the fields they are read from
+COLUMNS = (('id', 'id'), ('id_in_channel', 'id_in_channel'), ('datetime', 'datetime'),
+           ('contribution', 'contribution'), ('full_text', 'full_text'), ('url', 'url'),
+           ('author_id', 'author__id_in_channel'), ('author_screen_name', 'author__screen_name'),
+           ('zipcode', 'author__zipcode'), ('initiative', 'initiative__name'), ('campaign', 'campaign__name'),
+           ('challenge', 'challenge__name'), ('challenge_hashtag', 'challenge__hashtag'), ('votes', 'votes'),
+           ('re_posts', 're_posts'), ('bookmarks', 'bookmarks'), ('source', 'source'),
+           ('preserved_at', 'preserved_at'))
+FORMATS = ("csv", "jsonl")
+SINCE_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+
+# The since timestamp is given in UTC
+def parse_since(since):
+    try:
+        since = datetime.datetime.strptime(since, SINCE_FORMAT)
+    except ValueError:
+        raise ValueError("Invalid timestamp: %s, expected YYYY-MM-DDTHH:MM:SS" % since)
+    return timezone.make_aware(since, timezone.utc) if settings.USE_TZ else since
+
+
+# Rows of the permanent contributions, as dictionaries, preserved at or after since, ordered by the time in which
+# they were preserved. The preserved_at of the last row exported works as the since of the next export; the rows
+# preserved in that same second are exported again. The contributions can also be exported from an id, but that
+# misses the temporal contributions preserved after newer ones, so it doesn't work for incremental exports
+def get_rows(since=None, since_id=None, chunk_size=None):
+    chunk_size = chunk_size or export_settings['chunk_size']
+    posts = ContributionPost.objects.filter(status="PE", preserved_at__isnull=False).order_by('preserved_at', 'id')
+    if since is not None:
+        posts = posts.filter(preserved_at__gte=since)
+    if since_id is not None:
+        posts = posts.filter(id__gt=since_id)
+    fields = [field for _, field in COLUMNS]
+    chunk_posts = posts
+    while True:
+        chunk = list(chunk_posts.values_list(*fields)[:chunk_size])
+        for row in chunk:
+            yield dict(zip([column for column, _ in COLUMNS], row))
+        if len(chunk) < chunk_size:
+            break
+        last_id, last_preserved_at = chunk[-1][0], chunk[-1][-1]
+        chunk_posts = posts.filter(Q(preserved_at__gt=last_preserved_at) |
+                                   Q(preserved_at=last_preserved_at, id__gt=last_id))
+
+
+def to_text(value):
+    if value is None:
+        return ""
+    if isinstance(value, datetime.datetime):
+        return value.strftime(SINCE_FORMAT)
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return str(value)
+
+
+class Echo(object):
+    """File that returns what is written into it, so the csv writer can be used to build the lines"""
+
+    def write(self, value):
+        return value
+
+
+def to_csv(rows):
+    writer = csv.writer(Echo())
+    yield writer.writerow([column for column, _ in COLUMNS])
+    for row in rows:
+        yield writer.writerow([to_text(row[column]) for column, _ in COLUMNS])
+
+
+def to_jsonl(rows):
+    for row in rows:
+        row['datetime'] = to_text(row['datetime'])
+        row['preserved_at'] = to_text(row['preserved_at'])
+        yield json.dumps(row) + "\n"
+
+
+def export(export_format, since=None, since_id=None):
+    if export_format not in FORMATS:
+        raise ValueError("Unknown format: %s" % export_format)
+    rows = get_rows(since, since_id)
+    return to_csv(rows) if export_format == "csv" else to_jsonl(rows)
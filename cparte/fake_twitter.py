@@ -0,0 +1,302 @@
+# ----------------------------------------------
+# Local stand-in of the Twitter REST and Streaming
+# APIs. It serves recorded statuses, accepts the
+# calls the app makes to publish and delete posts,
+# and streams length-delimited messages, gzipped
+# if the client accepts it, at a configurable
+# pace, so the app can be tested and loaded
+# without reaching Twitter.
+# ----------------------------------------------
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from django.conf import settings
+
+import datetime
+import json
+import logging
+import os
+import ssl
+import threading
+import time
+import urlparse
+import zlib
+
+logger = logging.getLogger(__name__)
+
+API_ROOT = "/1.1"
+# Self-signed certificate for localhost. Point the ca_bundle option of the twitter_api section to it
+CERT_FILE = os.path.join(settings.BASE_DIR, "cparte/fixtures/fake_twitter.pem")
+STATUSES_FILE = os.path.join(settings.BASE_DIR, "cparte/fixtures/twitter_statuses.json")
+TWITTER_DATETIME_FORMAT = "%a %b %d %H:%M:%S +0000 %Y"
+
+
+def stall_warning(percent_full):
+    return {"warning": {"code": "FALLING_BEHIND", "message": "Your connection is falling behind and messages are "
+                                                             "being queued for delivery to you. Your queue is now "
+                                                             "over %s%% full." % percent_full,
+                        "percent_full": percent_full}}
+
+
+def limit_notice(track):
+    return {"limit": {"track": track}}
+
+
+def disconnect_notice(code, reason="Disconnected by the fake Twitter server"):
+    return {"disconnect": {"code": code, "stream_name": "participa-fake", "reason": reason}}
+
+
+class StreamSettings(object):
+    """Define what the streaming endpoint delivers in each connection"""
+
+    def __init__(self, messages=None, rate=0, repeat=1, stall_after=None, stall_seconds=0, disconnect_code=None,
+                 keep_alive=False):
+        self.messages = messages or []
+        self.rate = rate                        # Messages per second, 0 means as fast as possible
+        self.repeat = repeat                    # Number of times the list of messages is delivered
+        self.stall_after = stall_after          # Number of messages after which the stream stalls
+        self.stall_seconds = stall_seconds      # Length of the stall
+        self.disconnect_code = disconnect_code  # Disconnect notice sent once the messages were delivered
+        self.keep_alive = keep_alive            # Keep the connection open sending keep-alive new lines at the end
+
+
+class FakeTwitter(object):
+
+    def __init__(self, host="localhost", port=0, certfile=CERT_FILE, statuses_file=STATUSES_FILE):
+        self.host = host
+        self.port = port
+        self.certfile = certfile
+        self.statuses = {}
+        self.users = {}
+        self.updates = []
+        self.direct_messages = []
+        self.destroyed = []
+        self.stream_requests = []
+        self.stream_encodings = []
+        self.stream = StreamSettings()
+        self.next_id = 900000000000000000
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.server = None
+        self.thread = None
+        if statuses_file:
+            self.load_statuses(statuses_file)
+
+    def load_statuses(self, path):
+        with open(path) as f:
+            for status in json.load(f):
+                self.add_status(status)
+
+    def add_status(self, status):
+        self.statuses[status["id_str"]] = status
+        self.users[status["user"]["id_str"]] = status["user"]
+
+    def new_status(self, text, user, in_reply_to_status_id=None):
+        with self.lock:
+            self.next_id += 1
+            status_id = self.next_id
+        parent = self.statuses.get(in_reply_to_status_id) if in_reply_to_status_id else None
+        status = {"id": status_id, "id_str": str(status_id), "text": text,
+                  "created_at": datetime.datetime.utcnow().strftime(TWITTER_DATETIME_FORMAT),
+                  "source": "<a href=\"http://participa.test\" rel=\"nofollow\">Participa</a>",
+                  "in_reply_to_status_id": int(in_reply_to_status_id) if in_reply_to_status_id else None,
+                  "in_reply_to_status_id_str": in_reply_to_status_id,
+                  "in_reply_to_user_id_str": parent["user"]["id_str"] if parent else None,
+                  "retweet_count": 0, "favorite_count": 0, "lang": "en",
+                  "entities": {"hashtags": [{"text": word[1:], "indices": [0, 0]} for word in text.split()
+                                            if word.startswith("#")], "urls": [], "user_mentions": []},
+                  "user": user}
+        self.add_status(status)
+        return status
+
+    @property
+    def address(self):
+        return "%s:%s" % (self.host, self.server.server_address[1])
+
+    def api_settings(self):
+        return {'api_host': self.address, 'stream_host': self.address, 'ca_bundle': self.certfile}
+
+    def start(self):
+        self.stopped.clear()
+        self.server = FakeTwitterHTTPServer((self.host, self.port), FakeTwitterHandler)
+        self.server.fake = self
+        if self.certfile:
+            self.server.socket = ssl.wrap_socket(self.server.socket, certfile=self.certfile, server_side=True)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        logger.info("Fake Twitter listening on %s" % self.address)
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.thread.join()
+            self.server = None
+
+
+class FakeTwitterHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FakeTwitterHandler(BaseHTTPRequestHandler):
+    # The stream is closed by the server, so the body ends when the connection does
+    protocol_version = "HTTP/1.0"
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s" % (self.address_string(), format % args))
+
+    def do_GET(self):
+        self.dispatch(urlparse.parse_qs(urlparse.urlparse(self.path).query))
+
+    def do_POST(self):
+        length = int(self.headers.getheader('content-length') or 0)
+        params = urlparse.parse_qs(self.rfile.read(length)) if length else {}
+        params.update(urlparse.parse_qs(urlparse.urlparse(self.path).query))
+        self.dispatch(params)
+
+    def dispatch(self, params):
+        fake = self.server.fake
+        params = dict((key, values[0]) for key, values in params.items())
+        path = urlparse.urlparse(self.path).path
+        if not path.startswith(API_ROOT):
+            return self.send_error_json(404, 34, "Sorry, that page does not exist")
+        path = path[len(API_ROOT):]
+        if path == "/statuses/filter.json":
+            return self.stream(fake, params)
+        elif path == "/statuses/lookup.json":
+            ids = params.get("id", "").split(",")
+            return self.send_json(200, [fake.statuses[i] for i in ids if i in fake.statuses])
+        elif path == "/search/tweets.json":
+            return self.send_json(200, {"statuses": self.search(fake, params), "search_metadata": {}})
+        elif path == "/statuses/show.json":
+            if params.get("id") in fake.statuses:
+                return self.send_json(200, fake.statuses[params["id"]])
+            return self.send_error_json(404, 144, "No status found with that ID.")
+        elif path == "/statuses/update.json":
+            status = fake.new_status(params.get("status", ""), self.get_account(fake),
+                                     params.get("in_reply_to_status_id"))
+            fake.updates.append(status)
+            return self.send_json(200, status)
+        elif path.startswith("/statuses/destroy/"):
+            status_id = path[len("/statuses/destroy/"):-len(".json")]
+            if status_id in fake.statuses:
+                fake.destroyed.append(status_id)
+                return self.send_json(200, fake.statuses.pop(status_id))
+            return self.send_error_json(404, 144, "No status found with that ID.")
+        elif path == "/direct_messages/new.json":
+            recipient = fake.users.get(params.get("user_id"))
+            if recipient is None:
+                return self.send_error_json(404, 34, "Sorry, that page does not exist")
+            message = {"id": len(fake.direct_messages) + 1, "id_str": str(len(fake.direct_messages) + 1),
+                       "text": params.get("text", ""), "sender": self.get_account(fake), "recipient": recipient,
+                       "created_at": datetime.datetime.utcnow().strftime(TWITTER_DATETIME_FORMAT)}
+            fake.direct_messages.append(message)
+            return self.send_json(200, message)
+        elif path == "/users/lookup.json":
+            ids = params.get("user_id", "").split(",")
+            users = [fake.users[i] for i in ids if i in fake.users]
+            if not users:
+                return self.send_error_json(404, 17, "No user matches for specified terms.")
+            return self.send_json(200, users)
+        elif path == "/users/show.json":
+            user = fake.users.get(params.get("user_id") or params.get("id"))
+            if user is None:
+                return self.send_error_json(404, 50, "User not found.")
+            return self.send_json(200, user)
+        return self.send_error_json(404, 34, "Sorry, that page does not exist")
+
+    def search(self, fake, params):
+        terms = [term.lower().lstrip("#") for term in params.get("q", "").split(" OR ") if term]
+        since_id = int(params.get("since_id", 0))
+        max_id = int(params["max_id"]) if "max_id" in params else None
+        found = []
+        for status in fake.statuses.values():
+            if status["id"] <= since_id or (max_id is not None and status["id"] > max_id):
+                continue
+            words = [word.lower().lstrip("#") for word in status["text"].split()]
+            if any(term in words for term in terms):
+                found.append(status)
+        found.sort(key=lambda status: status["id"], reverse=True)
+        return found[:int(params.get("count", 15))]
+
+    def get_account(self, fake):
+        # Every post published through the fake server appears to come from the same app account
+        return {"id": 2733258272, "id_str": "2733258272", "name": "Participa", "screen_name": "josaldev",
+                "description": None, "lang": "en", "statuses_count": 0, "friends_count": 0, "followers_count": 0,
+                "listed_count": 0}
+
+    def send_json(self, code, body):
+        payload = json.dumps(body)
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json;charset=utf-8")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def send_error_json(self, code, error_code, message):
+        self.send_json(code, {"errors": [{"code": error_code, "message": message}]})
+
+    def stream(self, fake, params):
+        stream_settings = fake.stream
+        fake.stream_requests.append(params)
+        # The stream is compressed if the client accepts it, as Twitter does
+        if "gzip" in (self.headers.getheader('accept-encoding') or ""):
+            self.compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            fake.stream_encodings.append("gzip")
+        else:
+            self.compressor = None
+            fake.stream_encodings.append("identity")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        if self.compressor is not None:
+            self.send_header("Content-Encoding", "gzip")
+        self.end_headers()
+        delay = 1.0 / stream_settings.rate if stream_settings.rate else 0
+        sent = 0
+        try:
+            for _ in range(stream_settings.repeat):
+                for message in stream_settings.messages:
+                    if fake.stopped.is_set():
+                        return
+                    if stream_settings.stall_after is not None and sent == stream_settings.stall_after:
+                        fake.stopped.wait(stream_settings.stall_seconds)
+                    self.write_message(message)
+                    sent += 1
+                    if delay:
+                        time.sleep(delay)
+            if stream_settings.disconnect_code is not None:
+                self.write_message(disconnect_notice(stream_settings.disconnect_code))
+            while stream_settings.keep_alive and not fake.stopped.wait(1):
+                self.write_stream("\r\n")
+        except (IOError, ssl.SSLError):
+            logger.debug("The client closed the stream")
+        else:
+            self.close_stream()
+
+    def close_stream(self):
+        # Clients read the stream in fixed-size chunks, so its end has to be clearly signaled to let them process
+        # the last messages
+        if self.compressor is not None:
+            self.wfile.write(self.compressor.flush())
+        self.wfile.flush()
+        if isinstance(self.connection, ssl.SSLSocket):
+            try:
+                self.connection.unwrap()
+            except (IOError, ssl.SSLError):
+                pass
+
+    def write_message(self, message):
+        payload = message if isinstance(message, basestring) else json.dumps(message)
+        payload += "\r\n"
+        self.write_stream("%s\r\n%s" % (len(payload), payload))
+
+    # Every write is flushed out of the compressor, so the client can decompress the message right away
+    def write_stream(self, data):
+        if self.compressor is not None:
+            data = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.wfile.write(data)
+        self.wfile.flush()
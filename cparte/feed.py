@@ -0,0 +1,266 @@
+# ----------------------------------------------
+# Live feed of the contributions. Each time a
+# contribution is preserved, the contribution
+# and the new counts of its challenge are sent
+# by a thread of the process that saved it,
+# through the broker, to every web process. There
+# a thread relays them to an in-memory feed that
+# all the connected dashboards wait on, so the
+# db isn't polled however many dashboards are
+# open. The last events are kept, so a dashboard
+# that reconnects resumes from the last event it
+# received.
+# ----------------------------------------------
+
+from celery import current_app
+from django.conf import settings
+from django.db.models import Sum
+from kombu import Connection, Exchange, Queue
+from cparte.models import ContributionCount, contribution_preserved
+
+import atexit
+import collections
+import ConfigParser
+import json
+import logging
+import os
+import Queue as queue
+import socket
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# Set the feed from the configuration file
+config = ConfigParser.ConfigParser()
+config.read(os.path.join(settings.BASE_DIR, "cparte/config"))
+
+feed_settings = {'history': 1000, 'heartbeat': 15, 'max_duration': 300, 'retry': 3, 'broker_url': ""}
+if config.has_section('feed'):
+    # Events kept to resume the dashboards that reconnect, also the most events waiting to be sent
+    feed_settings['history'] = config.getint('feed', 'history')
+    # Seconds without events after which a comment is sent to keep the connection open
+    feed_settings['heartbeat'] = config.getfloat('feed', 'heartbeat')
+    # Seconds after which a stream is closed, the browser reconnects and resumes it
+    feed_settings['max_duration'] = config.getfloat('feed', 'max_duration')
+    # Seconds that the browser waits before reconnecting
+    feed_settings['retry'] = config.getfloat('feed', 'retry')
+    # Broker through which the events are sent, the one of celery if blank
+    feed_settings['broker_url'] = config.get('feed', 'broker_url')
+
+exchange = Exchange("cparte.feed", type="fanout", durable=False)
+
+
+class Feed(object):
+    """Last events received by the process, which the streams of the dashboards wait on"""
+
+    def __init__(self, size=None):
+        self.events = collections.deque(maxlen=size or feed_settings['history'])
+        self.condition = threading.Condition()
+        self.sequence = 0
+
+    def publish(self, event_id, event_type, data):
+        with self.condition:
+            self.sequence += 1
+            self.events.append((self.sequence, event_id, event_type, data))
+            self.condition.notify_all()
+
+    # Position from which a stream starts. A stream that resumes from an event that is no longer kept, or that was
+    # received by another process, gets all the events kept
+    def get_position(self, last_event_id=None):
+        with self.condition:
+            if last_event_id is None:
+                return self.sequence
+            for sequence, event_id, _, _ in self.events:
+                if event_id == last_event_id:
+                    return sequence
+            return self.events[0][0] - 1 if self.events else self.sequence
+
+    # Events after the position, waiting up to timeout seconds for one if there is none
+    def wait(self, position, timeout):
+        with self.condition:
+            if self.sequence <= position:
+                self.condition.wait(timeout)
+            return [event for event in self.events if event[0] > position]
+
+
+class Relay(object):
+    """Thread that receives the events from the broker and publishes them in the feed of the process"""
+
+    def __init__(self, feed, broker_url=None):
+        self.feed = feed
+        self.broker_url = broker_url or feed_settings['broker_url']
+        self.ready = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name="feed-relay")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                with get_connection(self.broker_url) as connection:
+                    # Each process gets its own queue, removed when the process disconnects
+                    process_queue = Queue("", exchange=exchange, exclusive=True, auto_delete=True, durable=False)
+                    with connection.Consumer(process_queue, callbacks=[self.receive], accept=["json"]):
+                        self.ready.set()
+                        while not self.stopped.is_set():
+                            try:
+                                connection.drain_events(timeout=1)
+                            except socket.timeout:
+                                pass
+            except Exception as e:
+                self.ready.clear()
+                logger.error("The feed lost the connection to the broker. %s" % e)
+                self.stopped.wait(feed_settings['retry'])
+
+    def receive(self, body, message):
+        self.feed.publish(body['id'], body['type'], body['data'])
+        message.ack()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.thread = None
+
+
+class Publisher(object):
+    """Thread that sends the events to the broker through a connection kept open, so the contributions are saved
+    without waiting on the broker"""
+
+    def __init__(self, broker_url=None, size=None):
+        self.broker_url = broker_url or feed_settings['broker_url']
+        self.events = queue.Queue(maxsize=size or feed_settings['history'])
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name="feed-publisher")
+        self.thread.daemon = True
+        self.thread.start()
+
+    # The events, given as (type, data), are dropped when too many are waiting, e.g. while the broker is down
+    def send(self, events):
+        try:
+            self.events.put_nowait(events)
+        except queue.Full:
+            logger.error("The feed is behind, %s events were dropped" % len(events))
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                with get_connection(self.broker_url) as connection:
+                    producer = connection.Producer()
+                    while not self.stopped.is_set():
+                        try:
+                            events = self.events.get(timeout=1)
+                        except queue.Empty:
+                            continue
+                        publish(producer, events)
+            except Exception as e:
+                logger.error("The events couldn't be sent to the feed. %s" % e)
+                self.stopped.wait(feed_settings['retry'])
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.thread = None
+
+
+def get_connection(broker_url=None):
+    return Connection(broker_url) if broker_url else current_app.connection()
+
+
+local_feed = Feed()
+relay = None
+relay_lock = threading.Lock()
+publisher = None
+publisher_lock = threading.Lock()
+
+
+def get_relay():
+    global relay
+    with relay_lock:
+        if relay is None:
+            relay = Relay(local_feed)
+        relay.start()
+        return relay
+
+
+def get_publisher():
+    global publisher
+    with publisher_lock:
+        if publisher is None:
+            publisher = Publisher()
+        publisher.start()
+        return publisher
+
+
+def send(events):
+    get_publisher().send(events)
+
+
+# The threads are stopped before the interpreter exits, which would tear the modules down under them
+def stop_threads():
+    global relay, publisher
+    for thread in (relay, publisher):
+        if thread is not None:
+            thread.stop()
+    relay = publisher = None
+
+atexit.register(stop_threads)
+
+
+def publish(producer, events):
+    for event_type, data in events:
+        producer.publish({'id': uuid.uuid4().hex, 'type': event_type, 'data': data}, exchange=exchange,
+                         routing_key="", declare=[exchange], serializer="json")
+
+
+def get_counts(challenge_id):
+    counts = ContributionCount.objects.filter(challenge=challenge_id).values_list('status').annotate(total=Sum('count'))
+    return dict(counts)
+
+
+# The contributions are sent once they were written, with the counts of their challenge
+def publish_contribution(sender, post, **kwargs):
+    send([("contribution", {'id': post.id, 'challenge': post.challenge_id, 'contribution': post.contribution,
+                            'text': post.full_text, 'url': post.url, 'datetime': post.datetime.isoformat()}),
+          ("counts", {'challenge': post.challenge_id, 'statuses': get_counts(post.challenge_id)})])
+
+
+def connect_signals():
+    contribution_preserved.connect(publish_contribution, dispatch_uid="feed_contribution_preserved")
+
+
+def format_event(event_id, event_type, data):
+    return "id: %s\nevent: %s\ndata: %s\n\n" % (event_id, event_type, json.dumps(data))
+
+
+# Server-Sent Events of the feed after the last event received by the dashboard, optionally only the ones of a
+# challenge. The stream is closed after max_duration seconds, and the browser opens it again from its last event
+def stream(last_event_id=None, challenge_id=None, heartbeat=None, max_duration=None):
+    heartbeat = heartbeat or feed_settings['heartbeat']
+    get_relay()
+    position = local_feed.get_position(last_event_id)
+    yield "retry: %d\n\n" % (feed_settings['retry'] * 1000)
+    deadline = time.time() + (max_duration or feed_settings['max_duration'])
+    while time.time() < deadline:
+        events = local_feed.wait(position, min(heartbeat, max(deadline - time.time(), 0)))
+        if not events:
+            yield ": keepalive\n\n"
+        for position, event_id, event_type, data in events:
+            if challenge_id is None or data.get('challenge') == challenge_id:
+                yield format_event(event_id, event_type, data)
@@ -0,0 +1,71 @@
+# ----------------------------------------------
+# Counts of the permanent contributions of the
+# challenges by the zipcode that their authors
+# had when they were preserved. The counts are
+# kept up to date as the contributions are
+# preserved or discarded, so the results are
+# broken down by zipcode without joining the
+# contributions with their authors. The history
+# is counted again in chunks by the backfill,
+# which fixes the counts that differ, see
+# recount.
+# ----------------------------------------------
+
+from django.conf import settings
+from cparte.models import ContributionPost, ZipcodeCount
+
+import ConfigParser
+import logging
+import os
+import recount
+
+logger = logging.getLogger(__name__)
+
+# Set the size of the chunks from the configuration file
+config = ConfigParser.ConfigParser()
+config.read(os.path.join(settings.BASE_DIR, "cparte/config"))
+
+geography_settings = {'chunk_size': 1000}
+if config.has_section('geography'):
+    geography_settings['chunk_size'] = config.getint('geography', 'chunk_size')
+
+
+def get_group(challenge_id, zipcode):
+    return challenge_id, zipcode or ""
+
+
+# Count the permanent contributions by the zipcode of their authors when they were preserved, reading them in chunks
+# ordered by id
+def count_contributions(chunk_size=None):
+    return recount.count_in_chunks(ContributionPost.objects.filter(status="PE"), ('challenge_id', 'preserved_zipcode'),
+                                   get_group, chunk_size or geography_settings['chunk_size'])
+
+
+def get_stored_counts():
+    return dict(((challenge_id, zipcode), count) for challenge_id, zipcode, count in
+                ZipcodeCount.objects.exclude(count=0).values_list('challenge_id', 'zipcode', 'count'))
+
+
+# Groups whose stored count differs from the number of contributions, as (group, stored count, counted)
+def verify(chunk_size=None):
+    return recount.check(lambda: count_contributions(chunk_size), get_stored_counts)
+
+
+def backfill(chunk_size=None):
+    differences = recount.check(lambda: count_contributions(chunk_size), get_stored_counts,
+                                lambda key, delta: ZipcodeCount.add(*key, delta=delta))
+    ZipcodeCount.objects.filter(count=0).delete()
+    logger.info("The counts of the contributions by zipcode were backfilled, %s of them were wrong" %
+                len(differences))
+    return differences
+
+
+# Number of permanent contributions of each challenge by zipcode
+def get_counts(challenge_ids=None):
+    counts = ZipcodeCount.objects.exclude(count=0)
+    if challenge_ids is not None:
+        counts = counts.filter(challenge__in=challenge_ids)
+    zipcodes = {}
+    for challenge_id, zipcode, count in counts.values_list('challenge_id', 'zipcode', 'count'):
+        zipcodes.setdefault(challenge_id, {})[zipcode] = count
+    return zipcodes
@@ -0,0 +1,116 @@
+# ----------------------------------------------
+# Lease of the stream of a partition. Only one
+# listener can hold the stream of a set of
+# credentials, so the listeners running in the
+# different nodes compete for a lease stored in
+# the partition row. The holder keeps it alive
+# with heartbeats and the others take it over
+# once it expires.
+# ----------------------------------------------
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+from django.utils import timezone
+from cparte.models import Channel, StreamPartition
+
+import ConfigParser
+import datetime
+import logging
+import os
+import socket
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Set the lease timing from the configuration file
+config = ConfigParser.ConfigParser()
+config.read(os.path.join(settings.BASE_DIR, "cparte/config"))
+
+lease_settings = {'duration': 15, 'heartbeat': 5, 'poll_interval': 2}
+if config.has_section('lease'):
+    lease_settings['duration'] = config.getfloat('lease', 'duration')
+    lease_settings['heartbeat'] = config.getfloat('lease', 'heartbeat')
+    lease_settings['poll_interval'] = config.getfloat('lease', 'poll_interval')
+
+
+def get_owner():
+    return "%s:%s" % (socket.gethostname(), os.getpid())
+
+
+class StreamLease(object):
+    """Lease of the stream of a partition. The expiry is set with the clock of each node, so their clocks have to be
+    synchronized"""
+
+    def __init__(self, partition, owner=None, duration=None, heartbeat=None):
+        self.partition_id = partition.id
+        self.channel_id = partition.channel_id
+        self.owner = owner or get_owner()
+        self.duration = datetime.timedelta(seconds=duration or lease_settings['duration'])
+        self.heartbeat = heartbeat or lease_settings['heartbeat']
+        self.stopped = threading.Event()
+        self.heartbeat_thread = None
+
+    # The status of the channel is checked apart, so the conditional updates don't need to join tables and stay
+    # atomic in every db
+    def channel_on(self):
+        return Channel.objects.filter(pk=self.channel_id, status=True).exists()
+
+    # Take the lease if nobody holds it or it expired. The channel has to be on
+    def acquire(self):
+        if not self.channel_on():
+            return False
+        now = timezone.now()
+        acquired = StreamPartition.objects.filter(pk=self.partition_id).\
+            filter(Q(lease_owner=self.owner) | Q(lease_owner__isnull=True) | Q(lease_expires__lt=now)).\
+            update(lease_owner=self.owner, lease_expires=now + self.duration)
+        if acquired:
+            logger.info("%s got the lease of the stream of the partition %s" % (self.owner, self.partition_id))
+        return acquired == 1
+
+    # Extend the lease. It fails if the lease was taken over or the channel was turned off
+    def renew(self):
+        if not self.channel_on():
+            return False
+        renewed = StreamPartition.objects.filter(pk=self.partition_id, lease_owner=self.owner).\
+            update(lease_expires=timezone.now() + self.duration)
+        return renewed == 1
+
+    def release(self):
+        StreamPartition.objects.filter(pk=self.partition_id, lease_owner=self.owner).update(lease_owner=None,
+                                                                                           lease_expires=None)
+        logger.info("%s released the lease of the stream of the partition %s" % (self.owner, self.partition_id))
+
+    def start_heartbeat(self, on_lost):
+        self.stopped.clear()
+        self.heartbeat_thread = threading.Thread(target=self.beat, args=(on_lost,),
+                                                 name="lease-%s" % self.partition_id)
+        self.heartbeat_thread.daemon = True
+        self.heartbeat_thread.start()
+
+    def stop_heartbeat(self):
+        self.stopped.set()
+        if self.heartbeat_thread is not None and self.heartbeat_thread is not threading.current_thread():
+            self.heartbeat_thread.join(self.heartbeat)
+        self.heartbeat_thread = None
+
+    def beat(self, on_lost):
+        last_renewal = timezone.now()
+        try:
+            while not self.stopped.wait(self.heartbeat):
+                try:
+                    renewed = self.renew()
+                except Exception as e:
+                    logger.error("The lease of the stream of the partition %s couldn't be renewed. %s" %
+                                 (self.partition_id, e))
+                    # The lease is kept while it doesn't expire, the db may come back before that
+                    renewed = timezone.now() - last_renewal < self.duration
+                else:
+                    last_renewal = timezone.now()
+                if not renewed:
+                    logger.critical("%s lost the lease of the stream of the partition %s" %
+                                    (self.owner, self.partition_id))
+                    on_lost()
+                    break
+        finally:
+            connection.close()
@@ -0,0 +1,240 @@
+# ----------------------------------------------
+# Processing queue of the stream with load
+# shedding. The reader of the stream only queues
+# the posts, a worker thread processes them. When
+# the queue passes its high watermark or Twitter
+# warns that the stream is falling behind, only
+# the replies to the app and the answers to the
+# challenges are processed; the rest of the posts
+# are deferred into a spool file and processed
+# once the load drops.
+# ----------------------------------------------
+
+from django.conf import settings
+from django.db import connection
+
+import ConfigParser
+import json
+import logging
+import os
+import Queue
+import threading
+import time
+import write_behind
+
+logger = logging.getLogger(__name__)
+
+# Set the watermarks from the configuration file
+config = ConfigParser.ConfigParser()
+config.read(os.path.join(settings.BASE_DIR, "cparte/config"))
+
+shedding_settings = {'queue_size': 2000, 'high_watermark': 1000, 'low_watermark': 100, 'cooldown': 60,
+                     'replay_batch': 100, 'spool_dir': os.path.join(settings.BASE_DIR, "spool")}
+if config.has_section('load_shedding'):
+    shedding_settings['queue_size'] = config.getint('load_shedding', 'queue_size')
+    shedding_settings['high_watermark'] = config.getint('load_shedding', 'high_watermark')
+    shedding_settings['low_watermark'] = config.getint('load_shedding', 'low_watermark')
+    # Seconds without falling behind warnings before the shedding stops
+    shedding_settings['cooldown'] = config.getfloat('load_shedding', 'cooldown')
+    shedding_settings['replay_batch'] = config.getint('load_shedding', 'replay_batch')
+    shedding_settings['spool_dir'] = os.path.join(settings.BASE_DIR, config.get('load_shedding', 'spool_dir'))
+
+# Classes of deferrable posts
+RETWEETS = "retweets"
+SHARES = "shares"    # Posted through the social sharing buttons
+CHATTER = "chatter"  # Neither replies to the app nor answers to challenges
+
+
+# Class of the post if it can be deferred, None if it has to be processed right away
+def classify(status, accounts, challenge_hashtags):
+    if getattr(status, 'retweeted_status', None) is not None:
+        return RETWEETS
+    if status.source == "Twitter for Websites":
+        return SHARES
+    if status.in_reply_to_user_id_str in accounts:
+        return None
+    for hashtag in status.entities['hashtags']:
+        if hashtag['text'].lower().strip() in challenge_hashtags:
+            return None
+    return CHATTER
+
+
+class Spool(object):
+    """File where the deferred posts wait, one JSON per line"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def append(self, data):
+        with self.lock:
+            directory = os.path.dirname(self.path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(self.path, "a") as spool_file:
+                spool_file.write(json.dumps(data) + "\n")
+
+    def is_empty(self):
+        return not os.path.exists(self.path) and not os.path.exists(self.path + ".replay")
+
+    # Take the posts out of the spool. The file is renamed first, so the posts deferred meanwhile go to a new one.
+    # The position up to which its posts were processed is kept next to it, and it is removed once all of them were
+    def replay(self, process, batch):
+        replay_path = self.path + ".replay"
+        offset_path = replay_path + ".offset"
+        with self.lock:
+            if not os.path.exists(replay_path):
+                if not os.path.exists(self.path):
+                    return 0
+                os.rename(self.path, replay_path)
+        offset = 0
+        if os.path.exists(offset_path):
+            with open(offset_path) as offset_file:
+                offset = int(offset_file.read() or 0)
+        lines = []
+        with open(replay_path) as replay_file:
+            replay_file.seek(offset)
+            while len(lines) < batch:
+                line = replay_file.readline()
+                if not line:
+                    break
+                lines.append(line)
+            offset = replay_file.tell()
+            finished = not replay_file.readline()
+        for line in lines:
+            process(json.loads(line))
+        if finished:
+            os.remove(replay_path)
+            if os.path.exists(offset_path):
+                os.remove(offset_path)
+        else:
+            with open(offset_path, "w") as offset_file:
+                offset_file.write(str(offset))
+        return len(lines)
+
+
+class ProcessingQueue(object):
+    """Queue between the reader of the stream of a partition and the thread that processes its posts"""
+
+    def __init__(self, partition_id, process, load, size=None, high_watermark=None, low_watermark=None, pool=None):
+        self.partition_id = partition_id
+        self.process = process
+        self.load = load  # Rebuild a post from its JSON in the spool
+        # The posts are processed by a pool of threads shared with other queues, if there is one. They are still
+        # processed one after another, in the order they were received
+        self.pool = pool
+        self.queue = Queue.Queue(size or shedding_settings['queue_size'])
+        self.high_watermark = high_watermark if high_watermark is not None else shedding_settings['high_watermark']
+        self.low_watermark = low_watermark if low_watermark is not None else shedding_settings['low_watermark']
+        self.spool = Spool(os.path.join(shedding_settings['spool_dir'], "partition-%s.jsonl" % partition_id))
+        self.lock = threading.Lock()
+        self.shedding = False
+        self.last_warning = None
+        self.deferred = {RETWEETS: 0, SHARES: 0, CHATTER: 0}
+        self.replayed = 0
+        self.stopped = threading.Event()
+        self.worker = None
+
+    def depth(self):
+        return self.queue.qsize()
+
+    # Queue the post, or defer it if it is not worth processing while shedding load. Posts with no class are always
+    # queued
+    def put(self, status, post_class=None):
+        self.update_mode()
+        if self.shedding and post_class is not None:
+            self.spool.append(status._json)
+            with self.lock:
+                self.deferred[post_class] += 1
+            return False
+        self.queue.put(status)
+        return True
+
+    # Twitter warned that the stream is falling behind
+    def record_warning(self):
+        self.last_warning = time.time()
+        self.update_mode()
+
+    def update_mode(self):
+        depth = self.depth()
+        warned = self.last_warning is not None and time.time() - self.last_warning < shedding_settings['cooldown']
+        if not self.shedding and (depth >= self.high_watermark or warned):
+            self.shedding = True
+            logger.warning("The stream of the partition %s is shedding load, %s posts are waiting to be processed" %
+                           (self.partition_id, depth))
+        elif self.shedding and depth <= self.low_watermark and not warned:
+            self.shedding = False
+            logger.info("The stream of the partition %s stopped shedding load. Deferred posts: %s" %
+                        (self.partition_id, self.deferred))
+
+    def get_stats(self):
+        with self.lock:
+            return {'queue_depth': self.depth(), 'shedding': self.shedding,
+                    'deferred_retweets': self.deferred[RETWEETS], 'deferred_shares': self.deferred[SHARES],
+                    'deferred_chatter': self.deferred[CHATTER]}
+
+    def start(self):
+        if self.worker is not None and self.worker.is_alive():
+            return
+        self.stopped.clear()
+        self.worker = threading.Thread(target=self.work, name="processing-%s" % self.partition_id)
+        self.worker.daemon = True
+        self.worker.start()
+
+    # The posts still queued are spooled, so they are processed by the next listener of the stream, and the rows
+    # of the processed ones still buffered are written
+    def stop(self):
+        self.stopped.set()
+        if self.worker is not None and self.worker is not threading.current_thread():
+            self.worker.join()
+        self.worker = None
+        while True:
+            try:
+                status = self.queue.get_nowait()
+            except Queue.Empty:
+                break
+            self.spool.append(status._json)
+        write_behind.flush()
+
+    def work(self):
+        try:
+            while not self.stopped.is_set():
+                self.step(timeout=1)
+        finally:
+            connection.close()
+
+    # Process the next post. Whenever the load is low, a batch of the deferred posts is processed too, so they are
+    # not kept waiting until the stream goes quiet
+    def step(self, timeout=None):
+        try:
+            status = self.queue.get(timeout=timeout)
+        except Queue.Empty:
+            self.replay()
+            return False
+        try:
+            self.run(status)
+        except Exception as e:
+            logger.error("The post %s of the partition %s couldn't be processed. %s" %
+                         (status.id_str, self.partition_id, e))
+        self.replay()
+        return True
+
+    def replay(self):
+        self.update_mode()
+        if self.shedding or self.depth() > self.low_watermark or self.spool.is_empty():
+            return 0
+        replayed = self.spool.replay(self.process_deferred, shedding_settings['replay_batch'])
+        self.replayed += replayed
+        logger.info("%s deferred posts of the partition %s were processed" % (replayed, self.partition_id))
+        return replayed
+
+    def run(self, status):
+        if self.pool is not None:
+            return self.pool.apply(self.process, (status,))
+        return self.process(status)
+
+    def process_deferred(self, data):
+        try:
+            self.run(self.load(data))
+        except Exception as e:
+            logger.error("A deferred post of the partition %s couldn't be processed. %s" % (self.partition_id, e))
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from optparse import make_option
+from cparte import geography
+
+
+class Command(BaseCommand):
+    help = "Count the permanent contributions by the zipcode of their authors when they were preserved and fix " \
+           "the stored counts that differ"
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', type="int", default=None, help="Contributions read from the db at a time"),
+        make_option('--verify', action="store_true", default=False, help="Only report the counts that differ"),
+    )
+
+    def handle(self, *args, **options):
+        if options['verify']:
+            differences = geography.verify(options['chunk_size'])
+        else:
+            differences = geography.backfill(options['chunk_size'])
+        for (challenge_id, zipcode), stored, counted in differences:
+            self.stdout.write("Challenge %s, zipcode %s: stored %s, counted %s" %
+                              (challenge_id, zipcode or "-", stored, counted))
+        if options['verify']:
+            self.stdout.write("%s counts differ" % len(differences))
+        else:
+            self.stdout.write("%s counts were fixed" % len(differences))
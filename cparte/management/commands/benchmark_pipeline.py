@@ -0,0 +1,77 @@
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from optparse import make_option
+from cparte import benchmark
+
+import json
+import subprocess
+import time
+
+
+class Command(BaseCommand):
+    help = "Run the offline benchmark of the post processing pipeline against a throwaway database"
+    option_list = BaseCommand.option_list + (
+        make_option('--posts', type='int', default=1000, help="Number of synthetic posts to process"),
+        make_option('--seed', type='int', default=0, help="Seed of the synthetic post generator"),
+        make_option('--authors', type='int', default=1000, help="Number of distinct authors"),
+        make_option('--zipf', type='float', default=1.1, help="Exponent of the Zipf distribution of the authors"),
+        make_option('--mix', default="hashtag=0.6,reply=0.2,sharing=0.1,retweet=0.1",
+                    help="Proportion of each type of post"),
+        make_option('--structured', type='float', default=0.7,
+                    help="Proportion of posts answering structured challenges"),
+        make_option('--invalid', type='float', default=0.1, help="Proportion of answers in an incorrect format"),
+        make_option('--initiatives', default="1", help="Comma-separated ids of the initiatives to post to"),
+        make_option('--fixture', default="cparte.json", help="Fixture loaded into the benchmark database"),
+        make_option('--output', default="pipeline_benchmark.json", help="File where the results are saved"),
+        make_option('--compare', default=None, help="Results of a previous run to compare with"),
+    )
+
+    def handle(self, *args, **options):
+        try:
+            mix = dict((name, float(value)) for name, value in
+                       (item.split("=") for item in options['mix'].split(",")))
+            initiative_ids = [int(i) for i in options['initiatives'].split(",")]
+        except ValueError:
+            raise CommandError("Wrong format of --mix or --initiatives")
+
+        # Run against a throwaway database so the real one is never touched
+        old_db_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            call_command('loaddata', options['fixture'], verbosity=0)
+            results = benchmark.run(options['posts'], initiative_ids, seed=options['seed'],
+                                    num_authors=options['authors'], zipf_exponent=options['zipf'], mix=mix,
+                                    structured_ratio=options['structured'], invalid_ratio=options['invalid'])
+        finally:
+            connection.creation.destroy_test_db(old_db_name, verbosity=0)
+
+        results['commit'] = self.get_commit()
+        results['timestamp'] = time.strftime("%Y-%m-%dT%H:%M:%S")
+        results['parameters'] = {'posts': options['posts'], 'seed': options['seed'], 'authors': options['authors'],
+                                 'zipf': options['zipf'], 'mix': mix, 'structured': options['structured'],
+                                 'invalid': options['invalid'], 'initiatives': initiative_ids,
+                                 'fixture': options['fixture'], 'db_engine': connection.settings_dict['ENGINE']}
+        if options['compare']:
+            with open(options['compare']) as f:
+                results['comparison'] = benchmark.compare(results, json.load(f))
+        with open(options['output'], 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+        self.stdout.write("%s posts in %.2f s (%.1f posts/sec)" % (results['posts'], results['elapsed_sec'],
+                                                                  results['posts_per_sec']))
+        self.stdout.write("Latency (ms): p50 %.2f, p90 %.2f, p99 %.2f" % (results['latency_ms']['p50'],
+                                                                          results['latency_ms']['p90'],
+                                                                          results['latency_ms']['p99']))
+        self.stdout.write("Queries per post: mean %.1f, max %s" % (results['queries_per_post']['mean'],
+                                                                   results['queries_per_post']['max']))
+        for name, delta in sorted(results.get('comparison', {}).items()):
+            self.stdout.write("%s: %s -> %s (%+.1f%%)" % (name, delta['previous'], delta['current'],
+                                                           delta['change_per']))
+        self.stdout.write("Results saved in %s" % options['output'])
+
+    def get_commit(self):
+        try:
+            return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.STDOUT).strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+from cparte import export
+
+
+class Command(BaseCommand):
+    help = "Export the permanent contributions, with their author and challenge, as CSV or JSON lines"
+    option_list = BaseCommand.option_list + (
+        make_option('--format', default="csv", help="csv or jsonl"),
+        make_option('--since', default=None, help="Export only the contributions preserved since this UTC "
+                                                  "timestamp, YYYY-MM-DDTHH:MM:SS. Use the preserved_at of the last "
+                                                  "contribution exported for incremental exports"),
+        make_option('--since-id', type="int", default=None,
+                    help="Export only the contributions with a greater id. It misses the temporal contributions "
+                         "preserved after newer ones"),
+        make_option('--output', default=None, help="File to write, the standard output by default"),
+    )
+
+    def handle(self, *args, **options):
+        try:
+            since = export.parse_since(options['since']) if options['since'] else None
+            lines = export.export(options['format'], since, options['since_id'])
+        except ValueError as e:
+            raise CommandError(str(e))
+        if options['output']:
+            with open(options['output'], "w") as output:
+                for line in lines:
+                    output.write(line)
+        else:
+            for line in lines:
+                self.stdout.write(line, ending="")
@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand
+from optparse import make_option
+from cparte import fake_twitter
+
+import json
+import time
+
+
+class Command(BaseCommand):
+    help = "Run a local stand-in of the Twitter REST and Streaming APIs for functional and load tests"
+    option_list = BaseCommand.option_list + (
+        make_option('--port', type='int', default=8443, help="Port where the server listens"),
+        make_option('--statuses', default=fake_twitter.STATUSES_FILE, help="File with the recorded statuses"),
+        make_option('--stream', default=None,
+                    help="File with the messages to stream, by default the recorded statuses are streamed"),
+        make_option('--rate', type='float', default=0, help="Messages per second, 0 for as fast as possible"),
+        make_option('--repeat', type='int', default=1, help="Number of times the messages are streamed"),
+        make_option('--stall-after', type='int', default=None, help="Stall the stream after this many messages"),
+        make_option('--stall-seconds', type='float', default=0, help="Length of the stall"),
+        make_option('--disconnect-code', type='int', default=None,
+                    help="Send a disconnect notice with this code at the end of the stream"),
+        make_option('--keep-alive', action='store_true', default=False,
+                    help="Keep the stream open once the messages were delivered"),
+    )
+
+    def handle(self, *args, **options):
+        server = fake_twitter.FakeTwitter(port=options['port'], statuses_file=options['statuses'])
+        if options['stream']:
+            with open(options['stream']) as f:
+                messages = json.load(f)
+        else:
+            messages = sorted(server.statuses.values(), key=lambda status: status["id"])
+        server.stream = fake_twitter.StreamSettings(messages=messages, rate=options['rate'], repeat=options['repeat'],
+                                                    stall_after=options['stall_after'],
+                                                    stall_seconds=options['stall_seconds'],
+                                                    disconnect_code=options['disconnect_code'],
+                                                    keep_alive=options['keep_alive'])
+        server.start()
+        settings = server.api_settings()
+        self.stdout.write("Fake Twitter running on %s. Set the following options in the twitter_api section of "
+                          "cparte/config to use it:" % server.address)
+        for option in sorted(settings):
+            self.stdout.write("%s = %s" % (option, settings[option]))
+        self.stdout.write("and start the processes with REQUESTS_CA_BUNDLE=%s" % settings['ca_bundle'])
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            server.stop()
+            self.stdout.write("Published posts: %s, direct messages: %s, deleted posts: %s" %
+                              (len(server.updates), len(server.direct_messages), len(server.destroyed)))
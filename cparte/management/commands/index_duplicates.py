@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+from cparte import duplicates
+from cparte.models import Challenge
+
+
+class Command(BaseCommand):
+    help = "Index again the permanent contributions of the challenges with free answers and report their " \
+           "near-duplicates"
+    option_list = BaseCommand.option_list + (
+        make_option('--challenge', type="int", default=None, help="Index only this challenge"),
+        make_option('--chunk-size', type="int", default=None, help="Contributions read from the db at a time"),
+    )
+
+    def handle(self, *args, **options):
+        challenges = [challenge for challenge in Challenge.objects.order_by('id') if duplicates.is_indexed(challenge)]
+        if options['challenge'] is not None:
+            challenges = [challenge for challenge in challenges if challenge.id == options['challenge']]
+            if not challenges:
+                raise CommandError("The challenge %s doesn't exist or doesn't have free answers" %
+                                   options['challenge'])
+        for challenge in challenges:
+            index = duplicates.rebuild(challenge, options['chunk_size'])
+            clusters = index.get_clusters()
+            self.stdout.write("Challenge %s: %s contributions, %s clusters of near-duplicates" %
+                              (challenge.id, len(index.signatures), len(clusters)))
+            for cluster in clusters:
+                self.stdout.write("  %s" % ", ".join(str(post_id) for post_id in cluster))
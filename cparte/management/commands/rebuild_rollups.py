@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from optparse import make_option
+from cparte import rollups
+
+
+class Command(BaseCommand):
+    help = "Count the contributions of the challenges from scratch and fix the stored counts that differ"
+    option_list = BaseCommand.option_list + (
+        make_option('--verify', action="store_true", default=False, help="Only report the counts that differ"),
+    )
+
+    def handle(self, *args, **options):
+        differences = rollups.verify() if options['verify'] else rollups.rebuild()
+        for (challenge_id, status, source, day), stored, counted in differences:
+            self.stdout.write("Challenge %s, %s, %s, %s: stored %s, counted %s" %
+                              (challenge_id, status, source or "-", day, stored, counted))
+        if options['verify']:
+            self.stdout.write("%s counts differ" % len(differences))
+        else:
+            self.stdout.write("%s counts were fixed" % len(differences))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from optparse import make_option
+from cparte import search
+
+
+class Command(BaseCommand):
+    help = "Index again the permanent contributions and the share posts for the search"
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', type="int", default=None, help="Posts read from the db at a time"),
+    )
+
+    def handle(self, *args, **options):
+        self.stdout.write("%s posts were indexed" % search.rebuild(options['chunk_size']))
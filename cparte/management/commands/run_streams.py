@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+from cparte import profiler
+from cparte.runtime import StreamRuntime
+
+import signal
+
+
+class Command(BaseCommand):
+    help = "Run the listeners of all the partitions of the channel in this process. Set enabled in the runtime " \
+           "section of the config so connecting the channel doesn't launch Celery tasks"
+    option_list = BaseCommand.option_list + (
+        make_option('--channel', default="twitter", help="Channel to listen"),
+        make_option('--db-threads', type="int", default=None, help="Threads that process the posts"),
+    )
+
+    def handle(self, *args, **options):
+        channel_name = options['channel'].lower()
+        if channel_name != "twitter":
+            raise CommandError("There is no runtime for the channel %s" % channel_name)
+        runtime = StreamRuntime(channel_name, options['db_threads'])
+        signal.signal(signal.SIGTERM, lambda signum, frame: runtime.stop())
+        # The listeners run outside the workers, so the trigger of the profiler is installed here instead of by the
+        # signals of the workers
+        profiler.register()
+        profiler.install_trigger()
+        self.stdout.write("Running the listeners of %s" % channel_name)
+        try:
+            runtime.run()
+        except KeyboardInterrupt:
+            runtime.stop()
+            runtime.shutdown()
+        self.stdout.write("Listeners of %s stopped" % channel_name)
@@ -0,0 +1,55 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from optparse import make_option
+from cparte.models import StreamPartition
+from cparte.social_network import TwitterStandby
+
+import multiprocessing
+
+
+def run_standby(partition_id):
+    standby = TwitterStandby(partition_id)
+    try:
+        standby.run(keep_waiting=True)
+    except KeyboardInterrupt:
+        standby.stop()
+
+
+class Command(BaseCommand):
+    help = "Run listeners that wait warm for the lease of the streams of the channel's partitions and take them " \
+           "over when the listeners holding them fail. Run one in each node"
+    option_list = BaseCommand.option_list + (
+        make_option('--channel', default="twitter", help="Channel to listen"),
+        make_option('--partition', type="int", default=None, help="Id of the only partition to listen"),
+    )
+
+    def handle(self, *args, **options):
+        channel_name = options['channel'].lower()
+        if channel_name != "twitter":
+            raise CommandError("There is no standby listener for the channel %s" % channel_name)
+        if options['partition'] is not None:
+            partition_ids = [options['partition']]
+        else:
+            partition_ids = list(StreamPartition.objects.filter(channel__name=channel_name).
+                                 values_list('id', flat=True))
+        if not partition_ids:
+            raise CommandError("The channel %s has no partitions yet, connect it first" % channel_name)
+        if len(partition_ids) == 1:
+            self.stdout.write("Standby listener waiting for the stream of the partition %s" % partition_ids[0])
+            run_standby(partition_ids[0])
+        else:
+            # One process per partition, the connection to the db can't be shared with the children
+            connection.close()
+            processes = [multiprocessing.Process(target=run_standby, args=(partition_id,))
+                         for partition_id in partition_ids]
+            for process in processes:
+                process.start()
+            self.stdout.write("Standby listeners waiting for the streams of the partitions %s" %
+                              ", ".join([str(partition_id) for partition_id in partition_ids]))
+            try:
+                for process in processes:
+                    process.join()
+            except KeyboardInterrupt:
+                for process in processes:
+                    process.join()
+        self.stdout.write("Standby listeners of %s stopped" % channel_name)
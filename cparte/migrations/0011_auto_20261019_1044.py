@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cparte', '0007_auto_20141201_0443'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StreamPartition',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('initiative_ids', models.TextField(default=b'[]')),
+                ('hashtags', models.TextField(default=b'[]')),
+                ('follow', models.TextField(default=b'[]')),
+                ('task_id', models.CharField(max_length=50, null=True, editable=False)),
+                ('message_rate', models.FloatField(null=True, editable=False)),
+                ('stream_lag', models.FloatField(null=True, editable=False)),
+                ('max_stream_lag', models.FloatField(null=True, editable=False)),
+                ('undelivered_msgs', models.IntegerField(default=0, editable=False)),
+                ('percent_full', models.IntegerField(null=True, editable=False)),
+                ('stalled', models.BooleanField(default=False, editable=False)),
+                ('last_health_check', models.DateTimeField(null=True, editable=False)),
+                ('last_post_id', models.CharField(max_length=50, null=True, editable=False)),
+                ('reconnections', models.IntegerField(default=0, editable=False)),
+                ('last_reconnect_time', models.FloatField(null=True, editable=False)),
+                ('missed_msgs', models.IntegerField(default=0, editable=False)),
+                ('lease_owner', models.CharField(max_length=100, null=True, editable=False)),
+                ('lease_expires', models.DateTimeField(null=True, editable=False)),
+                ('account', models.ForeignKey(to='cparte.Account')),
+                ('channel', models.ForeignKey(to='cparte.Channel')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='streampartition',
+            unique_together=set([('channel', 'account')]),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cparte', '0011_auto_20261019_1044'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='channel',
+            name='resubscribe_at',
+            field=models.DateTimeField(null=True, editable=False),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='streampartition',
+            name='version',
+            field=models.IntegerField(default=0, editable=False),
+            preserve_default=True,
+        ),
+    ]
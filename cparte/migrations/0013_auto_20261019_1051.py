@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cparte', '0012_auto_20261019_1048'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='streampartition',
+            name='deferred_chatter',
+            field=models.IntegerField(default=0, editable=False),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='streampartition',
+            name='deferred_retweets',
+            field=models.IntegerField(default=0, editable=False),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='streampartition',
+            name='deferred_shares',
+            field=models.IntegerField(default=0, editable=False),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='streampartition',
+            name='queue_depth',
+            field=models.IntegerField(null=True, editable=False),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='streampartition',
+            name='shedding',
+            field=models.BooleanField(default=False, editable=False),
+            preserve_default=True,
+        ),
+    ]
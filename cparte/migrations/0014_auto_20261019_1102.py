@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cparte', '0013_auto_20261019_1051'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='channel',
+            name='metrics_cursor',
+            field=models.DateTimeField(null=True, editable=False),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='channel',
+            name='metrics_pass_started',
+            field=models.DateTimeField(null=True, editable=False),
+            preserve_default=True,
+        ),
+    ]
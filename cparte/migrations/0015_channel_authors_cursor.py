@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cparte', '0014_auto_20261019_1102'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='channel',
+            name='authors_cursor',
+            field=models.IntegerField(default=0, editable=False),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cparte', '0015_channel_authors_cursor'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='contributionpost',
+            index_together=set([('datetime', 'id')]),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cparte', '0016_auto_20261019_1105'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ContributionCount',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('status', models.CharField(max_length=3, choices=[(b'TE', b'Temporal'), (b'PE', b'Permanent'), (b'DI', b'Discarded')])),
+                ('source', models.CharField(default=b'', max_length=100)),
+                ('day', models.DateField()),
+                ('count', models.IntegerField(default=0)),
+                ('challenge', models.ForeignKey(to='cparte.Challenge')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='contributioncount',
+            unique_together=set([('challenge', 'status', 'source', 'day')]),
+        ),
+    ]
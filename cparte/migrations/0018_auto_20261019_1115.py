@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cparte', '0017_auto_20261019_1110'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ZipcodeCount',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('zipcode', models.CharField(default=b'', max_length=10)),
+                ('count', models.IntegerField(default=0)),
+                ('challenge', models.ForeignKey(to='cparte.Challenge')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='zipcodecount',
+            unique_together=set([('challenge', 'zipcode')]),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cparte', '0018_auto_20261019_1115'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchEntry',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('term', models.CharField(max_length=50)),
+                ('kind', models.CharField(max_length=2, choices=[(b'CP', b'Contribution'), (b'SP', b'Share')])),
+                ('post_id', models.IntegerField()),
+                ('frequency', models.IntegerField()),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterIndexTogether(
+            name='searchentry',
+            index_together=set([('term', 'kind', 'post_id'), ('kind', 'post_id')]),
+        ),
+    ]
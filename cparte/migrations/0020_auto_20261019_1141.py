@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.db.models import F
+
+
+# The time in which the existing permanent contributions were preserved is unknown, their datetime is taken instead
+def set_preserved_at(apps, schema_editor):
+    ContributionPost = apps.get_model('cparte', 'ContributionPost')
+    ContributionPost.objects.filter(status="PE").update(preserved_at=F('datetime'))
+
+
+def unset_preserved_at(apps, schema_editor):
+    pass  # The field is removed
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cparte', '0019_auto_20261019_1120'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='contributionpost',
+            name='preserved_at',
+            field=models.DateTimeField(null=True, editable=False),
+            preserve_default=True,
+        ),
+        migrations.AlterIndexTogether(
+            name='contributionpost',
+            index_together=set([('datetime', 'id'), ('preserved_at', 'id')]),
+        ),
+        migrations.RunPython(set_preserved_at, unset_preserved_at),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cparte', '0020_auto_20261019_1141'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='contributioncount',
+            name='revision',
+            field=models.IntegerField(default=0),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+# The zipcode that the authors had when the existing permanent contributions were preserved is unknown, their
+# current zipcode is taken instead
+def set_preserved_zipcode(apps, schema_editor):
+    Author = apps.get_model('cparte', 'Author')
+    ContributionPost = apps.get_model('cparte', 'ContributionPost')
+    for zipcode in Author.objects.values_list('zipcode', flat=True).distinct():
+        ContributionPost.objects.filter(status="PE", author__zipcode=zipcode).update(preserved_zipcode=zipcode or "")
+
+
+def unset_preserved_zipcode(apps, schema_editor):
+    pass  # The field is removed
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cparte', '0021_contributioncount_revision'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='contributionpost',
+            name='preserved_zipcode',
+            field=models.CharField(max_length=10, null=True, editable=False),
+            preserve_default=True,
+        ),
+        migrations.RunPython(set_preserved_zipcode, unset_preserved_zipcode),
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cparte', '0022_contributionpost_preserved_zipcode'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PostClaim',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('id_in_channel', models.CharField(unique=True, max_length=50)),
+                ('claimed_at', models.DateTimeField(db_index=True)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+    ]
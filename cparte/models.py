@@ -1,4 +1,14 @@
-from django.db import models
+from django.db import models, transaction, IntegrityError
+from django.dispatch import Signal
+from django.utils import timezone
+
+import json
+import re
+
+# Sent once a contribution became permanent and was written
+contribution_preserved = Signal(providing_args=["post"])
+# Sent once a permanent contribution stopped being it or was deleted, which clears the id of the post
+contribution_discarded = Signal(providing_args=["post", "post_id"])
 
 LANGUAGES = (
     ('en', 'English'),
@@ -18,6 +28,14 @@ class Channel(models.Model):
     streaming_pid = models.CharField(max_length=50, editable=False, null=True)
     session_info = models.TextField(editable=False, null=True)
     last_message = models.DateTimeField(null=True, editable=False)  # Last message timestamp
+    # When the pending changes of the hashtags will be applied to the streams
+    resubscribe_at = models.DateTimeField(null=True, editable=False)
+    # Primary key of the last author whose profile was refreshed
+    authors_cursor = models.IntegerField(default=0, editable=False)
+    # Publication time of the last post whose re-posts and bookmarks were refreshed, null between the passes
+    metrics_cursor = models.DateTimeField(null=True, editable=False)
+    # When the last pass over the recent posts started
+    metrics_pass_started = models.DateTimeField(null=True, editable=False)
 
     def __unicode__(self):
         return self.name
@@ -34,11 +52,11 @@ class Channel(models.Model):
             self.session_info = ""
             self.status = False
             self.last_message = None
+            self.resubscribe_at = None
             self.save()
-
-    def update_last_message_ts(self, timestamp):
-        self.last_message = timestamp
-        self.save()
+            self.streampartition_set.update(task_id=None, lease_owner=None, lease_expires=None, message_rate=None,
+                                            stream_lag=None, max_stream_lag=None, undelivered_msgs=0,
+                                            percent_full=None, stalled=False, queue_depth=None, shedding=False)
 
 
 class Account(models.Model):
@@ -56,6 +74,64 @@ class Account(models.Model):
         return self.owner
 
 
+# Part of the terms that the channel listens. Each partition is streamed through its own connection, opened with
+# the credentials of its account
+class StreamPartition(models.Model):
+    channel = models.ForeignKey(Channel)
+    account = models.ForeignKey(Account)
+    initiative_ids = models.TextField(default="[]")  # JSON lists
+    hashtags = models.TextField(default="[]")
+    follow = models.TextField(default="[]")
+    version = models.IntegerField(default=0, editable=False)  # Increased every time the terms of the channel change
+    task_id = models.CharField(max_length=50, null=True, editable=False)
+    # Health of the stream, written periodically by the listener
+    message_rate = models.FloatField(null=True, editable=False)  # Messages per minute
+    stream_lag = models.FloatField(null=True, editable=False)  # Average seconds between creation and processing
+    max_stream_lag = models.FloatField(null=True, editable=False)
+    undelivered_msgs = models.IntegerField(default=0, editable=False)  # Reported by the limit notices
+    percent_full = models.IntegerField(null=True, editable=False)  # Reported by the stall warnings
+    stalled = models.BooleanField(default=False, editable=False)
+    last_health_check = models.DateTimeField(null=True, editable=False)
+    last_post_id = models.CharField(max_length=50, null=True, editable=False)  # Checkpoint to recover after failures
+    reconnections = models.IntegerField(default=0, editable=False)
+    last_reconnect_time = models.FloatField(null=True, editable=False)  # Seconds
+    missed_msgs = models.IntegerField(default=0, editable=False)  # Messages published while the stream was down
+    # Load shedding: posts waiting to be processed and posts deferred while falling behind
+    queue_depth = models.IntegerField(null=True, editable=False)
+    shedding = models.BooleanField(default=False, editable=False)
+    deferred_retweets = models.IntegerField(default=0, editable=False)
+    deferred_shares = models.IntegerField(default=0, editable=False)
+    deferred_chatter = models.IntegerField(default=0, editable=False)
+    # Listener that holds the stream and until when
+    lease_owner = models.CharField(max_length=100, null=True, editable=False)
+    lease_expires = models.DateTimeField(null=True, editable=False)
+
+    class Meta:
+        unique_together = ('channel', 'account')
+
+    def __unicode__(self):
+        return "%s (%s)" % (self.channel.name, self.account.handler)
+
+    def get_initiative_ids(self):
+        return json.loads(self.initiative_ids)
+
+    def get_hashtags(self):
+        return json.loads(self.hashtags)
+
+    def get_follow(self):
+        return json.loads(self.follow)
+
+
+# Post that the streams of several partitions may have delivered but none of them matches by the rules applied here.
+# The stream that claims it first processes it, the claims are removed after a while
+class PostClaim(models.Model):
+    id_in_channel = models.CharField(max_length=50, unique=True)
+    claimed_at = models.DateTimeField(db_index=True)
+
+    def __unicode__(self):
+        return self.id_in_channel
+
+
 class Message(models.Model):
     name = models.CharField(max_length=50)
     body = models.TextField()
@@ -225,10 +301,87 @@ class ContributionPost(models.Model):
     STATUS = (('TE', 'Temporal'), ('PE', 'Permanent'), ('DI', 'Discarded'))
     status = models.CharField(max_length=3, choices=STATUS)
     source = models.CharField(max_length=100, null=True)
+    # When the contribution became permanent, the cursor of the incremental exports. Temporal contributions are
+    # preserved after newer ones, so neither their id nor their datetime work as cursor
+    preserved_at = models.DateTimeField(null=True, editable=False)
+    # Zipcode of the author when the contribution was preserved, the one in which it's counted
+    preserved_zipcode = models.CharField(max_length=10, null=True, editable=False)
+
+    class Meta:
+        # The lists of contributions are paginated by datetime and id, the exports by preservation time and id
+        index_together = [('datetime', 'id'), ('preserved_at', 'id')]
+
+    def __init__(self, *args, **kwargs):
+        super(ContributionPost, self).__init__(*args, **kwargs)
+        # Group of the counts in which the stored post is counted, None while it isn't stored
+        self.counted_in = self.get_count_key() if self.pk else None
 
     def __unicode__(self):
         return self.url
 
+    def get_count_key(self):
+        return self.challenge_id, self.status, self.source or "", get_count_day(self.datetime)
+
+    # The counts of the contributions are updated in the same transaction as the post
+    def save(self, *args, **kwargs):
+        preserved = discarded = False
+        if self.status == "PE" and (self.counted_in is None or self.counted_in[1] != "PE"):
+            self.preserved_at = timezone.now()
+            self.preserved_zipcode = self.author.zipcode or ""
+        with transaction.atomic():
+            super(ContributionPost, self).save(*args, **kwargs)
+            count_key = self.get_count_key()
+            if count_key != self.counted_in:
+                # A stored post that changes its status is a revision of both groups, a new post isn't
+                revision = 1 if self.counted_in is not None else 0
+                if self.counted_in is not None:
+                    ContributionCount.add(*self.counted_in, delta=-1, revision=revision)
+                ContributionCount.add(*count_key, delta=1, revision=revision)
+                self.count_zipcode(self.counted_in, count_key)
+                self.index_terms(self.counted_in, count_key)
+                preserved = count_key[1] == "PE" and (self.counted_in is None or self.counted_in[1] != "PE")
+                discarded = count_key[1] != "PE" and self.counted_in is not None and self.counted_in[1] == "PE"
+                self.counted_in = count_key
+        if preserved:
+            contribution_preserved.send(sender=ContributionPost, post=self)
+        if discarded:
+            contribution_discarded.send(sender=ContributionPost, post=self, post_id=self.pk)
+
+    def delete(self, *args, **kwargs):
+        post_id = self.pk
+        discarded = self.counted_in is not None and self.counted_in[1] == "PE"
+        with transaction.atomic():
+            # Before the post is deleted, which clears its id
+            if self.counted_in is not None:
+                ContributionCount.add(*self.counted_in, delta=-1, revision=1)
+                self.count_zipcode(self.counted_in, None)
+                self.index_terms(self.counted_in, None)
+            super(ContributionPost, self).delete(*args, **kwargs)
+            self.counted_in = None
+        if discarded:
+            contribution_discarded.send(sender=ContributionPost, post=self, post_id=post_id)
+
+    # Only the permanent contributions are counted by zipcode, in the zipcode of the author when they are preserved,
+    # which is kept with them so they are discounted from the same zipcode after the author moves
+    def count_zipcode(self, counted_in, count_key):
+        counted_challenge = counted_in[0] if counted_in is not None and counted_in[1] == "PE" else None
+        challenge = count_key[0] if count_key is not None and count_key[1] == "PE" else None
+        if counted_challenge != challenge:
+            zipcode = self.preserved_zipcode or ""
+            if counted_challenge is not None:
+                ZipcodeCount.add(counted_challenge, zipcode, -1)
+            if challenge is not None:
+                ZipcodeCount.add(challenge, zipcode, 1)
+
+    # Only the permanent contributions can be searched
+    def index_terms(self, counted_in, count_key):
+        was_permanent = counted_in is not None and counted_in[1] == "PE"
+        is_permanent = count_key is not None and count_key[1] == "PE"
+        if was_permanent and not is_permanent:
+            SearchEntry.remove_post("CP", self.pk)
+        elif is_permanent and not was_permanent:
+            SearchEntry.add_posts("CP", [(self.pk, self.full_text, self.contribution)])
+
     def preserve(self):
         self.status = "PE"
         self.save()
@@ -244,6 +397,70 @@ class ContributionPost(models.Model):
             return False
 
 
+# The contributions are counted by the day, in UTC, in which they were published
+def get_count_day(post_datetime):
+    if timezone.is_aware(post_datetime):
+        post_datetime = timezone.make_naive(post_datetime, timezone.utc)
+    return post_datetime.date()
+
+
+class ContributionCount(models.Model):
+    """Number of contributions of a challenge with the same status and source published the same day"""
+    challenge = models.ForeignKey(Challenge)
+    status = models.CharField(max_length=3, choices=ContributionPost.STATUS)
+    source = models.CharField(max_length=100, default="")
+    day = models.DateField()
+    count = models.IntegerField(default=0)
+    # Times that stored contributions entered or left the group, so the caches built from the contributions notice
+    # the changes that don't alter the total count
+    revision = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('challenge', 'status', 'source', 'day')
+
+    def __unicode__(self):
+        return "%s %s %s %s: %s" % (self.challenge_id, self.status, self.source, self.day, self.count)
+
+    @classmethod
+    def add(cls, challenge_id, status, source, day, delta, revision=0):
+        add_to_count(cls, delta, revision, challenge_id=challenge_id, status=status, source=source, day=day)
+
+
+class ZipcodeCount(models.Model):
+    """Number of permanent contributions of a challenge whose authors live in the same zipcode"""
+    challenge = models.ForeignKey(Challenge)
+    zipcode = models.CharField(max_length=10, default="")  # Blank for the authors without zipcode
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('challenge', 'zipcode')
+
+    def __unicode__(self):
+        return "%s %s: %s" % (self.challenge_id, self.zipcode, self.count)
+
+    @classmethod
+    def add(cls, challenge_id, zipcode, delta):
+        add_to_count(cls, delta, challenge_id=challenge_id, zipcode=zipcode)
+
+
+# Add delta to the count of the group, which is created the first time a contribution falls into it
+def add_to_count(model, delta, revision=0, **group):
+    fields = {'count': delta}
+    changes = {'count': models.F('count') + delta}
+    if revision:
+        fields['revision'] = revision
+        changes['revision'] = models.F('revision') + revision
+    counts = model.objects.filter(**group)
+    if counts.update(**changes):
+        return
+    try:
+        with transaction.atomic():
+            model.objects.create(**dict(group, **fields))
+    except IntegrityError:
+        # Another process created the group in the meantime
+        counts.update(**changes)
+
+
 class AppPost(models.Model):
     id_in_channel = models.CharField(max_length=50)
     datetime = models.DateTimeField()
@@ -289,4 +506,59 @@ class SharePost(models.Model):
     votes = models.IntegerField(default=0)      # e.g. +1 in Google+, like in Facebook
     re_posts = models.IntegerField(default=0)   # e.g. Share in Facebook, RT in Twitter
     bookmarks = models.IntegerField(default=0)  # e.g. Favourite in Twitter
-    similarity = models.IntegerField(default=0)
\ No newline at end of file
+    similarity = models.IntegerField(default=0)
+
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            is_new = self.pk is None
+            super(SharePost, self).save(*args, **kwargs)
+            if is_new:
+                SearchEntry.add_posts("SP", [(self.pk, self.text)])
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            SearchEntry.remove_post("SP", self.pk)
+            super(SharePost, self).delete(*args, **kwargs)
+
+
+class SearchEntry(models.Model):
+    """Occurrences of a term in a post, the inverted index of the search of the posts"""
+    KINDS = (('CP', 'Contribution'), ('SP', 'Share'))
+    term = models.CharField(max_length=50)
+    kind = models.CharField(max_length=2, choices=KINDS)
+    post_id = models.IntegerField()
+    frequency = models.IntegerField()
+
+    TERM = re.compile(r"\w+", re.UNICODE)
+
+    class Meta:
+        # The posts are looked up by term to search them and by post to remove them
+        index_together = [('term', 'kind', 'post_id'), ('kind', 'post_id')]
+
+    def __unicode__(self):
+        return "%s %s %s: %s" % (self.term, self.kind, self.post_id, self.frequency)
+
+    # Number of occurrences of each term in the texts, the ones of the text in which it occurs the most
+    @classmethod
+    def get_terms(cls, *texts):
+        terms = {}
+        for text in texts:
+            text_terms = {}
+            for term in cls.TERM.findall((text or "").lower()):
+                if 1 < len(term) <= 50:
+                    text_terms[term] = text_terms.get(term, 0) + 1
+            for term, frequency in text_terms.items():
+                terms[term] = max(terms.get(term, 0), frequency)
+        return terms
+
+    # Index the posts given as (id, text, ...) with a single insert
+    @classmethod
+    def add_posts(cls, kind, posts):
+        entries = [cls(term=term, kind=kind, post_id=post[0], frequency=frequency)
+                   for post in posts for term, frequency in cls.get_terms(*post[1:]).items()]
+        if entries:
+            cls.objects.bulk_create(entries)
+
+    @classmethod
+    def remove_post(cls, kind, post_id):
+        cls.objects.filter(kind=kind, post_id=post_id).delete()
@@ -0,0 +1,122 @@
+# ----------------------------------------------
+# Pagination of the lists of posts. The pages are
+# cut by the position of their last post (keyset
+# pagination) instead of an offset, so reading
+# any page costs the same whatever the size of
+# the table, and the totals are counted once in a
+# while and kept in the cache. The totals of big
+# tables are estimated by the db instead.
+# ----------------------------------------------
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import Q
+from django.db.models.query import QuerySet
+from django.db.models.sql.datastructures import EmptyResultSet
+from django.utils import timezone
+
+import ConfigParser
+import datetime
+import hashlib
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# Set the size of the pages from the configuration file
+config = ConfigParser.ConfigParser()
+config.read(os.path.join(settings.BASE_DIR, "cparte/config"))
+
+pagination_settings = {'page_size': 50, 'count_timeout': 300, 'approximate_count_threshold': 100000}
+if config.has_section('pagination'):
+    pagination_settings['page_size'] = config.getint('pagination', 'page_size')
+    # Seconds during which the total of a list is taken from the cache
+    pagination_settings['count_timeout'] = config.getint('pagination', 'count_timeout')
+    # Totals estimated above this number of rows are not counted
+    pagination_settings['approximate_count_threshold'] = config.getint('pagination', 'approximate_count_threshold')
+
+CURSOR_DATETIME_FORMAT = "%Y%m%d%H%M%S%f"
+
+
+# The position of a post in the list is given by its datetime and its id, which breaks the ties
+def encode_cursor(post):
+    post_datetime = timezone.make_naive(post.datetime, timezone.utc) if timezone.is_aware(post.datetime) \
+        else post.datetime
+    return "%s-%s" % (post_datetime.strftime(CURSOR_DATETIME_FORMAT), post.id)
+
+
+def decode_cursor(cursor):
+    try:
+        encoded_datetime, post_id = cursor.split("-")
+        post_datetime = datetime.datetime.strptime(encoded_datetime, CURSOR_DATETIME_FORMAT)
+        if settings.USE_TZ:
+            post_datetime = timezone.make_aware(post_datetime, timezone.utc)
+        return post_datetime, int(post_id)
+    except (AttributeError, ValueError):
+        raise ValueError("Invalid cursor: %s" % cursor)
+
+
+# Return the posts that follow the cursor, newest first, and the cursor of the next page or None if it is the last
+def get_page(queryset, cursor=None, page_size=None):
+    page_size = page_size or pagination_settings['page_size']
+    queryset = queryset.order_by('-datetime', '-id')
+    if cursor:
+        post_datetime, post_id = decode_cursor(cursor)
+        queryset = queryset.filter(Q(datetime__lt=post_datetime) | Q(datetime=post_datetime, id__lt=post_id))
+    posts = list(queryset[:page_size + 1])
+    if len(posts) > page_size:
+        posts = posts[:page_size]
+        return posts, encode_cursor(posts[-1])
+    return posts, None
+
+
+# Number of rows of the queryset, counted again only once the count in the cache expires
+def get_cached_count(queryset, timeout=None):
+    timeout = timeout if timeout is not None else pagination_settings['count_timeout']
+    key = "cparte-count-%s" % hashlib.md5(str(queryset.query)).hexdigest()
+    count = cache.get(key)
+    if count is None:
+        count = queryset.count()
+        cache.set(key, count, timeout)
+    return count
+
+
+# Number of rows of the queryset estimated by the query planner of the db, None if the db can't estimate it
+def estimate_count(queryset):
+    try:
+        sql, params = queryset.order_by().values_list('pk').query.sql_with_params()
+    except EmptyResultSet:
+        # The queryset is known to be empty without querying the db, e.g. after none()
+        return 0
+    cursor = connection.cursor()
+    try:
+        if connection.vendor == "mysql":
+            cursor.execute("EXPLAIN " + sql, params)
+            columns = [column[0] for column in cursor.description]
+            return cursor.fetchone()[columns.index('rows')]
+        elif connection.vendor == "postgresql":
+            cursor.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+            plan = cursor.fetchone()[0]
+            if isinstance(plan, basestring):
+                plan = json.loads(plan)
+            return plan[0]['Plan']['Plan Rows']
+    except Exception as e:
+        logger.warning("The number of rows couldn't be estimated. %s" % e)
+    return None
+
+
+class ApproximateCountQuerySet(QuerySet):
+    """Queryset whose count is estimated by the db when it is above the threshold and counted otherwise"""
+
+    def count(self):
+        if self._result_cache is None:
+            estimate = estimate_count(self)
+            if estimate is not None and estimate >= pagination_settings['approximate_count_threshold']:
+                return int(estimate)
+        return super(ApproximateCountQuerySet, self).count()
+
+
+def approximate(queryset):
+    return queryset._clone(klass=ApproximateCountQuerySet)
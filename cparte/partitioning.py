@@ -0,0 +1,178 @@
+# ----------------------------------------------
+# Split of the terms that a channel listens into
+# partitions, one per account, so each partition
+# is streamed through its own connection and
+# process. Twitter caps the number of terms and
+# users of each connection, so initiatives that
+# don't fit in the partition of their account
+# are moved to the partition with more room.
+# ----------------------------------------------
+
+from django.conf import settings
+from django.db import transaction, IntegrityError
+from django.db.models import F
+from django.utils import timezone
+from cparte.models import Initiative, PostClaim, StreamPartition
+
+import ConfigParser
+import datetime
+import json
+import logging
+import os
+import re
+
+logger = logging.getLogger(__name__)
+
+# Set the limits from the configuration file
+config = ConfigParser.ConfigParser()
+config.read(os.path.join(settings.BASE_DIR, "cparte/config"))
+
+partition_settings = {'max_track_terms': 400, 'max_follow_ids': 5000, 'claim_timeout': 600}
+if config.has_section('partitioning'):
+    partition_settings['max_track_terms'] = config.getint('partitioning', 'max_track_terms')
+    partition_settings['max_follow_ids'] = config.getint('partitioning', 'max_follow_ids')
+    if config.has_option('partitioning', 'claim_timeout'):
+        # Seconds during which the claims of the posts that no partition matches are kept
+        partition_settings['claim_timeout'] = config.getint('partitioning', 'claim_timeout')
+
+# Changes of the terms are applied after coalescing them during a window, and the stream with the new terms has to
+# connect within a timeout before the old stream is closed
+subscription_settings = {'coalesce_window': 5, 'connect_timeout': 30}
+if config.has_section('subscriptions'):
+    subscription_settings['coalesce_window'] = config.getfloat('subscriptions', 'coalesce_window')
+    subscription_settings['connect_timeout'] = config.getfloat('subscriptions', 'connect_timeout')
+
+
+# Hashtags of the initiative, its campaigns and their challenges
+def get_initiative_terms(initiative):
+    terms = [initiative.hashtag]
+    for campaign in initiative.campaign_set.all():
+        if campaign.hashtag:
+            terms.append(campaign.hashtag)
+        for challenge in campaign.challenge_set.all():
+            terms.append(challenge.hashtag)
+    unique_terms = []
+    for term in terms:
+        term = term.lower()
+        if term not in unique_terms:
+            unique_terms.append(term)
+    return unique_terms
+
+
+# Assign the initiatives to the accounts. The initiatives stay in the account where they were before (previous maps
+# initiative ids to account ids) or go to their own account, unless they don't fit there
+def build_partitions(initiative_ids, previous=None):
+    previous = previous or {}
+    initiatives = Initiative.objects.filter(pk__in=initiative_ids).select_related('account').\
+        prefetch_related('campaign_set__challenge_set')
+    initiatives = dict((initiative.id, initiative) for initiative in initiatives)
+    for id_initiative in initiative_ids:
+        if id_initiative not in initiatives:
+            e_msg = "Does not exist an initiative identified with the id %s" % id_initiative
+            logger.critical(e_msg)
+            raise Exception(e_msg)
+    partitions = {}
+    for initiative in initiatives.values():
+        partitions[initiative.account.id] = {'account': initiative.account, 'initiative_ids': [], 'hashtags': [],
+                                             'follow': []}
+    terms = dict((initiative.id, get_initiative_terms(initiative)) for initiative in initiatives.values())
+    # The initiatives that were already assigned go first, then the largest ones
+    ordered = sorted(initiatives.values(), key=lambda initiative: (initiative.id not in previous,
+                                                                   -len(terms[initiative.id]), initiative.id))
+    for initiative in ordered:
+        candidates = [previous.get(initiative.id), initiative.account.id]
+        candidates += sorted(partitions.keys(), key=lambda key: (len(partitions[key]['hashtags']), key))
+        for account_id in candidates:
+            if account_id in partitions and fits(partitions[account_id], terms[initiative.id], initiative.account):
+                break
+        else:
+            account_id = initiative.account.id
+            logger.critical("The terms of the initiative %s don't fit in any stream. Twitter listens up to %s terms "
+                            "per stream" % (initiative.name, partition_settings['max_track_terms']))
+        add_initiative(partitions[account_id], initiative, terms[initiative.id])
+    return [partitions[key] for key in sorted(partitions.keys()) if partitions[key]['initiative_ids']]
+
+
+def fits(partition, terms, account):
+    num_terms = len(set(partition['hashtags']) | set(terms))
+    num_follow = len(set(partition['follow']) | set([account.id_in_channel]))
+    return num_terms <= partition_settings['max_track_terms'] and \
+        num_follow <= partition_settings['max_follow_ids']
+
+
+def add_initiative(partition, initiative, terms):
+    partition['initiative_ids'].append(initiative.id)
+    for term in terms:
+        if term not in partition['hashtags']:
+            partition['hashtags'].append(term)
+    if initiative.account.id_in_channel not in partition['follow']:
+        partition['follow'].append(initiative.account.id_in_channel)
+
+
+# Save the partitions of the channel, keeping the checkpoints of the partitions that remain. Partitions whose
+# accounts aren't used anymore are removed. When the terms change, the version of the partitions is increased so
+# their listeners subscribe to the new terms
+def assign(channel, initiative_ids, keep_checkpoint=False):
+    current = dict((partition.account_id, partition) for partition in channel.streampartition_set.all())
+    previous = {}
+    for partition in current.values():
+        for id_initiative in partition.get_initiative_ids():
+            previous[id_initiative] = partition.account_id
+    partitions = []
+    changed = False
+    for built in build_partitions(initiative_ids, previous):
+        partition = current.pop(built['account'].id, None) or StreamPartition(channel=channel,
+                                                                               account=built['account'])
+        terms = (json.dumps(sorted(built['initiative_ids'])), json.dumps(built['hashtags']),
+                 json.dumps(built['follow']))
+        if partition.id is None or terms != (partition.initiative_ids, partition.hashtags, partition.follow):
+            changed = True
+        partition.initiative_ids, partition.hashtags, partition.follow = terms
+        if not keep_checkpoint:
+            partition.last_post_id = None
+        partition.save()
+        partitions.append(partition)
+    if current:
+        changed = True
+        StreamPartition.objects.filter(pk__in=[removed.id for removed in current.values()]).delete()
+    if changed:
+        StreamPartition.objects.filter(channel=channel).update(version=F('version') + 1)
+        for partition in partitions:
+            partition.version += 1
+    logger.info("The terms of %s were split into %s partitions" % (channel.name, len(partitions)))
+    return partitions
+
+
+# Whether the post wasn't claimed yet by another stream. The expired claims are removed first
+def claim_post(post_id):
+    now = timezone.now()
+    PostClaim.objects.filter(claimed_at__lt=now - datetime.timedelta(seconds=partition_settings['claim_timeout'])).\
+        delete()
+    try:
+        with transaction.atomic():
+            PostClaim.objects.create(id_in_channel=post_id, claimed_at=now)
+        return True
+    except IntegrityError:
+        return False
+
+
+class PartitionOwnership(object):
+    """Decide which partition processes the posts that match the terms of several partitions. The first partition
+    whose terms or users match the post owns it, so the posts delivered by more than one stream are processed once.
+    The posts that no partition matches here are processed by the first stream that claims them"""
+
+    def __init__(self, partitions, own_id):
+        self.own_id = own_id
+        self.partitions = [(partition.id, set(partition.get_hashtags()), set(partition.get_follow()))
+                           for partition in sorted(partitions, key=lambda partition: partition.id)]
+
+    def owns(self, post_id, text, hashtags, user_ids):
+        if len(self.partitions) < 2:
+            return True
+        words = set(re.findall(r"\w+", text.lower(), re.UNICODE)) | set(hashtags)
+        user_ids = set(user_ids)
+        for partition_id, terms, follow in self.partitions:
+            if words & terms or user_ids & follow:
+                return partition_id == self.own_id
+        # Matched by the rules of Twitter, not by the ones applied here, so it isn't known which streams delivered it
+        return claim_post(post_id)
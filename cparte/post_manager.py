@@ -17,6 +17,7 @@ import re
 import os
 import time
 import traceback
+import write_behind
 
 logger = get_task_logger(__name__)
 
@@ -95,6 +96,7 @@ def do_manage(post, author_obj):
     else:
         try:
             # Searching for the post in the app db
+            write_behind.sync(models.AppPost, parent_post_id)
             app_parent_post = models.AppPost.objects.get(id_in_channel=parent_post_id)
             # Check whether the category of the root post is engagement (EN).
             # Posts in this category are intended to engage the public into the initiative challenges
@@ -104,6 +106,7 @@ def do_manage(post, author_obj):
         except models.AppPost.DoesNotExist:
             # Check if the post is a reply to social sharing post
             try:
+                write_behind.sync(models.SharePost, parent_post_id)
                 social_sharing_post = models.SharePost.objects.get(id_in_channel=parent_post_id)
                 within_initiative = True
                 challenge = social_sharing_post.challenge
@@ -250,6 +253,7 @@ def preserve_temporal_post(post, author_obj, extra_info, app_parent_post):
     campaign = app_parent_post.campaign
     challenge = app_parent_post.challenge
     post_db = get_contribution_post(app_parent_post)
+    post_db.challenge = challenge  # The same challenge, already read, which is needed again once the post is preserved
     post_db.preserve()
     message = campaign.messages.get(category="thanks_contribution")
     send_reply(post, campaign.initiative, challenge, message)
@@ -262,10 +266,11 @@ def update_contribution(post, author_obj, app_parent_post):
     challenge = app_parent_post.challenge
     try:
         # Permanent Post
-        old_post = models.ContributionPost.objects.get(challenge=challenge, author=author_obj.id, status="PE")
+        posts = models.ContributionPost.objects.filter(challenge=challenge, author=author_obj.id).\
+            select_related('challenge')  # The challenge is read again once the posts are preserved or discarded
+        old_post = posts.get(status="PE")
         # Temporal Post
-        new_post = models.ContributionPost.objects.filter(challenge=challenge, author=author_obj.id, status="TE").\
-                   order_by('-datetime').first()
+        new_post = posts.filter(status="TE").order_by('-datetime').first()
         new_post.preserve()  # Preserve the newest (temporal)
         old_post.discard()  # Discard the oldest (permanent)
         discard_temporal_post(author_obj, challenge)  # Discard the remaining temporal posts related to 'challenge'
@@ -457,7 +462,7 @@ def discard_temporal_post(author_obj, challenge):
 def preserve_author_temporal_posts(author, channel):
     author_obj = get_author_obj(author, channel)
     try:
-        temp_posts = models.ContributionPost.objects.filter(author=author_obj.id, status='TE')
+        temp_posts = models.ContributionPost.objects.filter(author=author_obj.id, status='TE').select_related('challenge')
         for post in temp_posts:
             try:
                 app_post = models.AppPost.objects.get(contribution_parent_post=post.id, answered=False)
@@ -608,9 +613,9 @@ def extract_attached_txt(txt_org_post, txt_repost):
 
 
 def save_sharing_post(post, author_obj, challenge):
-    if not models.SharePost.objects.filter(id_in_channel=post["id"]).exists():
+    if not is_saved(models.SharePost, post["id"]):
         if author_obj is None:
-            author_obj = register_new_author(post["author"], post["channel"])
+            author_obj = register_new_author(post["author"], post["channel"], deferred=True)
         channel_obj = get_channel_obj(post["channel"])
         campaign = challenge.campaign
         initiative = campaign.initiative
@@ -621,12 +626,12 @@ def save_sharing_post(post, author_obj, challenge):
                                         author=author_obj, initiative=initiative,
                                         campaign=campaign, challenge=challenge, channel=channel_obj, votes=post["votes"],
                                         re_posts=post["re_posts"], bookmarks=post["bookmarks"], similarity=similarity)
-        post_to_save.save(force_insert=True)
+        write_behind.insert(post_to_save)
 
 
 # Save app posts placed directly through the channel clients
 def save_app_post(post, initiative, challenge):
-    if not models.AppPost.objects.filter(id_in_channel=post["id"]).exists():
+    if not is_saved(models.AppPost, post["id"]):
         campaign = challenge.campaign
         channel_obj = get_channel_obj(post["channel"])
         app_post = models.AppPost(id_in_channel=post["id"], datetime=timezone.make_aware(post["datetime"], timezone.get_default_timezone()),
@@ -634,7 +639,15 @@ def save_app_post(post, initiative, challenge):
                                   campaign=campaign, contribution_parent_post=None, challenge=challenge, channel=channel_obj,
                                   votes=post["votes"], re_posts=post["re_posts"], bookmarks=post["bookmarks"],
                                   delivered=True, category="EN", payload=None, recipient_id=None, answered=False)
-        app_post.save(force_insert=True)
+        write_behind.insert(app_post)
+
+
+# Check whether the post was already saved. With the write-behind enabled the posts already saved are skipped
+# when the buffer is written, all at once
+def is_saved(model, post_id):
+    if write_behind.writer_settings['enabled']:
+        return write_behind.is_pending(model, post_id)
+    return model.objects.filter(id_in_channel=post_id).exists()
 
 
 def get_channel_obj(channel_name):
@@ -648,17 +661,21 @@ def get_channel_obj(channel_name):
 def get_author_obj(author, channel_name):
     try:
         channel = get_channel_obj(channel_name)
+        write_behind.sync(Author, (channel.id, author["id"]))
         return Author.objects.get(id_in_channel=author["id"], channel=channel.id)
     except Author.DoesNotExist:
         return None
 
 
-def register_new_author(author, channel_name):
+# The insert of the author can be deferred only if the caller doesn't need its primary key
+def register_new_author(author, channel_name, deferred=False):
     channel = get_channel_obj(channel_name)
     new_author = Author(name=author["name"], screen_name=author["screen_name"], id_in_channel=author["id"],
                         channel=channel, friends=author["friends"], followers=author["followers"],
                         url=author["url"], description=author["description"], language=author["language"],
                         posts_count=author["posts_count"])
+    if deferred:
+        return write_behind.insert(new_author)
     new_author.save(force_insert=True)
     return new_author
 
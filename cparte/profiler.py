@@ -0,0 +1,162 @@
+# ----------------------------------------------
+# Sampling profiler for the long-running listener
+# and worker processes. Nothing runs while it is
+# off: the interval timer is only armed while a
+# profile is being taken. Stacks are written in
+# the collapsed format read by flamegraph tools.
+# ----------------------------------------------
+
+from celery.signals import worker_init, worker_process_init
+from celery.worker.control import Panel
+from django.conf import settings
+
+import ConfigParser
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Set settings from the configuration file
+config = ConfigParser.ConfigParser()
+config.read(os.path.join(settings.BASE_DIR, "cparte/config"))
+
+profiler_settings = {'output_dir': os.path.join(settings.BASE_DIR, "profiles"), 'interval': 0.01, 'mode': "cpu",
+                     'seconds': 30}
+if config.has_section('profiler'):
+    profiler_settings['output_dir'] = os.path.join(settings.BASE_DIR, config.get('profiler', 'output_dir'))
+    profiler_settings['interval'] = config.getfloat('profiler', 'interval')
+    profiler_settings['mode'] = config.get('profiler', 'mode')
+    profiler_settings['seconds'] = config.getint('profiler', 'seconds')
+
+# Signal used to ask a process to start profiling itself
+TRIGGER_SIGNAL = signal.SIGUSR2
+# cpu samples the time spent running, wall samples the elapsed time (including the time spent waiting for I/O)
+TIMERS = {'cpu': (signal.ITIMER_PROF, signal.SIGPROF), 'wall': (signal.ITIMER_REAL, signal.SIGALRM)}
+
+
+class SamplingProfiler(object):
+
+    def __init__(self, interval=None, mode=None, output_dir=None):
+        self.interval = interval or profiler_settings['interval']
+        self.timer, self.signum = TIMERS[mode or profiler_settings['mode']]
+        self.output_dir = output_dir or profiler_settings['output_dir']
+        self.stacks = {}
+        self.running = False
+        self.stop_timer = None
+        self.output_file = None
+
+    def start(self, seconds):
+        if self.running:
+            logger.info("The profiler is already running in the process %s" % os.getpid())
+            return False
+        self.stacks = {}
+        self.running = True
+        signal.signal(self.signum, self._sample)
+        signal.siginterrupt(self.signum, False)  # Don't break the blocking reads of the stream
+        signal.setitimer(self.timer, self.interval, self.interval)
+        self.stop_timer = threading.Timer(seconds, self.stop)
+        self.stop_timer.daemon = True
+        self.stop_timer.start()
+        logger.info("Profiling the process %s during %s seconds" % (os.getpid(), seconds))
+        return True
+
+    def stop(self):
+        if not self.running:
+            return None
+        signal.setitimer(self.timer, 0, 0)
+        self.running = False
+        if self.stop_timer:
+            self.stop_timer.cancel()
+        self.output_file = self.save()
+        logger.info("Profile of the process %s saved in %s" % (os.getpid(), self.output_file))
+        return self.output_file
+
+    def _sample(self, signum, frame):
+        for thread_id, thread_frame in sys._current_frames().items():
+            stack = []
+            while thread_frame is not None:
+                code = thread_frame.f_code
+                if code is not self._sample.__func__.__code__:
+                    stack.append("%s:%s" % (os.path.basename(code.co_filename), code.co_name))
+                thread_frame = thread_frame.f_back
+            if stack:
+                stack.reverse()
+                key = ";".join(stack)
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def save(self):
+        if not os.path.isdir(self.output_dir):
+            os.makedirs(self.output_dir)
+        file_name = "profile-%s-%s-%s.folded" % (socket.gethostname(), os.getpid(), time.strftime("%Y%m%d%H%M%S"))
+        path = os.path.join(self.output_dir, file_name)
+        with open(path, "w") as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write("%s %s\n" % (stack, count))
+        return path
+
+
+profiler = None
+
+
+def get_profiler():
+    global profiler
+    if profiler is None:
+        profiler = SamplingProfiler()
+    return profiler
+
+
+def get_request_file():
+    return os.path.join(profiler_settings['output_dir'], ".request")
+
+
+def request_profile(seconds):
+    if not os.path.isdir(profiler_settings['output_dir']):
+        os.makedirs(profiler_settings['output_dir'])
+    with open(get_request_file(), "w") as f:
+        f.write(str(seconds))
+
+
+def on_trigger(signum, frame):
+    try:
+        with open(get_request_file()) as f:
+            seconds = float(f.read().strip())
+    except (IOError, ValueError):
+        seconds = profiler_settings['seconds']
+    get_profiler().start(seconds)
+
+
+def install_trigger(**kwargs):
+    signal.signal(TRIGGER_SIGNAL, on_trigger)
+    signal.siginterrupt(TRIGGER_SIGNAL, False)
+
+
+# Remote control command, e.g. celery -A participa control start_profiler --arguments '{"seconds": 60}'
+def start_profiler(state, seconds=None, **kwargs):
+    seconds = seconds or profiler_settings['seconds']
+    request_profile(seconds)
+    pool_pids = []
+    try:
+        pool_pids = state.consumer.pool.info.get('processes', [])
+    except AttributeError:
+        pass
+    for pid in pool_pids:
+        try:
+            os.kill(pid, TRIGGER_SIGNAL)
+        except OSError as e:
+            logger.error("The process %s couldn't be asked to start profiling. %s" % (pid, e))
+    get_profiler().start(seconds)
+    return {'ok': "profiling %s processes during %s seconds, output in %s" %
+                  (len(pool_pids) + 1, seconds, profiler_settings['output_dir'])}
+
+
+# Install the trigger in the main process of the workers and in each process of their pools, and register the
+# remote control command. Called by the celery app of participa
+def register():
+    worker_init.connect(install_trigger)
+    worker_process_init.connect(install_trigger)
+    Panel.register(start_profiler)
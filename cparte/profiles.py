@@ -0,0 +1,88 @@
+# ----------------------------------------------
+# Refresh of the profiles of the authors, which
+# are captured when the authors are registered.
+# A periodic task walks the authors of the
+# channel from a cursor, looks them up in batches
+# of 100 and writes back only the profiles that
+# changed, so after some runs every author was
+# refreshed while keeping within the rate limits.
+# ----------------------------------------------
+
+from django.conf import settings
+from django.db import transaction
+from cparte.models import Author, Channel
+from social_network import Twitter
+
+import ConfigParser
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# Set the budget of the refresh from the configuration file
+config = ConfigParser.ConfigParser()
+config.read(os.path.join(settings.BASE_DIR, "cparte/config"))
+
+profile_settings = {'max_lookups': 60, 'batch_size': 100}
+if config.has_section('profiles'):
+    # Calls to users/lookup per run. Twitter allows 180 calls every 15 minutes
+    profile_settings['max_lookups'] = config.getint('profiles', 'max_lookups')
+
+# Fields of the author refreshed from the attributes of the user of Twitter
+PROFILE_FIELDS = (('friends', 'friends_count'), ('followers', 'followers_count'),
+                  ('posts_count', 'statuses_count'), ('description', 'description'))
+
+
+# Profile of the user as values of the fields of the author
+def get_profile(user):
+    return tuple(getattr(user, attribute) for _, attribute in PROFILE_FIELDS)
+
+
+# Write the profiles that changed in one transaction. The authors with the same profile are updated together
+def save_profiles(changed):
+    if not changed:
+        return 0
+    authors = {}
+    for pk, profile in changed:
+        authors.setdefault(profile, []).append(pk)
+    fields = [field for field, _ in PROFILE_FIELDS]
+    with transaction.atomic():
+        for profile, pks in authors.items():
+            Author.objects.filter(pk__in=pks).update(**dict(zip(fields, profile)))
+    return len(changed)
+
+
+# Refresh the next batch of authors after the cursor and return the new cursor, 0 once all of them were refreshed
+def refresh_batch(channel, cursor):
+    fields = [field for field, _ in PROFILE_FIELDS]
+    authors = list(Author.objects.filter(channel=channel, pk__gt=cursor).order_by('pk').
+                   values_list('id', 'id_in_channel', *fields)[:profile_settings['batch_size']])
+    if not authors:
+        return 0, 0
+    users = dict((user.id_str, user) for user in Twitter.lookup_users([author[1] for author in authors]))
+    changed = []
+    for author in authors:
+        user = users.get(author[1])
+        if user is not None and get_profile(user) != tuple(author[2:]):
+            changed.append((author[0], get_profile(user)))
+    return authors[-1][0], save_profiles(changed)
+
+
+def refresh(channel_name="twitter", max_lookups=None):
+    max_lookups = max_lookups or profile_settings['max_lookups']
+    channel = Channel.objects.get(name=channel_name)
+    cursor = channel.authors_cursor
+    updated = 0
+    try:
+        for _ in range(max_lookups):
+            cursor, changed = refresh_batch(channel, cursor)
+            updated += changed
+            if cursor == 0:
+                break
+    finally:
+        # The batches refreshed are kept even if a lookup fails, e.g. because of the rate limit
+        Channel.objects.filter(pk=channel.pk).update(authors_cursor=cursor)
+    logger.info("The profiles of the authors of %s were refreshed up to the author %s, %s of them changed" %
+                (channel_name, cursor, updated))
+    return updated
+
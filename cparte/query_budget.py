@@ -0,0 +1,79 @@
+# ----------------------------------------------
+# Per-post accounting of the ORM queries. It
+# counts the queries and the SQL time spent while
+# processing a post and flags the posts that go
+# beyond the budget set in the configuration file.
+# ----------------------------------------------
+
+from django.conf import settings
+from django.db import connection
+
+import ConfigParser
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# Set the budget from the configuration file
+config = ConfigParser.ConfigParser()
+config.read(os.path.join(settings.BASE_DIR, "cparte/config"))
+
+budget = {'enabled': False, 'max_queries': None, 'max_sql_time': None}
+if config.has_section('query_budget'):
+    budget['enabled'] = config.getboolean('query_budget', 'enabled')
+    budget['max_queries'] = config.getint('query_budget', 'max_queries')
+    budget['max_sql_time'] = config.getfloat('query_budget', 'max_sql_time')  # In milliseconds
+
+
+class QueryTracker(object):
+    """Context manager that counts the queries executed inside its block"""
+
+    def __init__(self, label, post_id=None, enabled=None):
+        self.label = label
+        self.post_id = post_id
+        self.enabled = budget['enabled'] if enabled is None else enabled
+        self.num_queries = 0
+        self.sql_time = 0.0
+        self.over_budget = False
+        self._old_debug_cursor = None
+        self._start = 0
+
+    def __enter__(self):
+        if self.enabled:
+            self._old_debug_cursor = connection.use_debug_cursor
+            # The debug cursor is the one that records the queries, it has to be forced when DEBUG is off
+            connection.use_debug_cursor = True
+            self._start = len(connection.queries)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not self.enabled:
+            return False
+        executed = connection.queries[self._start:]
+        self.num_queries = len(executed)
+        self.sql_time = sum(float(query['time']) for query in executed) * 1000
+        connection.use_debug_cursor = self._old_debug_cursor
+        if not self._old_debug_cursor and not settings.DEBUG:
+            # Nobody else is reading the recorded queries, drop them so a long-running process doesn't grow forever
+            del connection.queries[self._start:]
+        self.check_budget()
+        return False
+
+    def check_budget(self):
+        max_queries = budget['max_queries']
+        max_sql_time = budget['max_sql_time']
+        if max_queries is not None and self.num_queries > max_queries:
+            self.over_budget = True
+        if max_sql_time is not None and self.sql_time > max_sql_time:
+            self.over_budget = True
+        if self.over_budget:
+            logger.warning("%s of the post %s exceeded the query budget: %s queries in %.2f ms (budget: %s queries, "
+                           "%s ms)" % (self.label, self.post_id, self.num_queries, self.sql_time, max_queries,
+                                       max_sql_time))
+        else:
+            logger.info("%s of the post %s run %s queries in %.2f ms" % (self.label, self.post_id, self.num_queries,
+                                                                        self.sql_time))
+
+
+def track(label, post_id=None):
+    return QueryTracker(label, post_id)
@@ -0,0 +1,45 @@
+# ----------------------------------------------
+# Check of the counts that the contributions
+# keep up to date as they are saved. The
+# contributions are counted again in chunks and
+# compared with the stored counts, and the ones
+# that differ are fixed by adding the
+# difference. Both are read in one transaction,
+# so under repeatable read, the isolation that
+# MySQL uses by default, they come from the same
+# snapshot and the changes committed meanwhile
+# are kept. Under read committed, e.g. the
+# default of PostgreSQL, the commands that fix
+# the counts must run with the streams stopped.
+# ----------------------------------------------
+
+from django.db import transaction
+
+
+# Count the contributions by the key that get_key returns from the fields, reading them in chunks ordered by id
+def count_in_chunks(posts, fields, get_key, chunk_size):
+    counts = {}
+    last_id = 0
+    while True:
+        chunk = list(posts.filter(id__gt=last_id).order_by('id').values_list('id', *fields)[:chunk_size])
+        for row in chunk:
+            key = get_key(*row[1:])
+            counts[key] = counts.get(key, 0) + 1
+        if len(chunk) < chunk_size:
+            break
+        last_id = chunk[-1][0]
+    return counts
+
+
+# Groups whose stored count differs from the number of contributions, as (group, stored count, counted). With add,
+# the differences are added to the stored counts in the same transaction
+def check(count_contributions, get_stored_counts, add=None):
+    with transaction.atomic():
+        stored = get_stored_counts()
+        counted = count_contributions()
+        differences = sorted((key, stored.get(key, 0), counted.get(key, 0)) for key in set(counted) | set(stored)
+                             if stored.get(key, 0) != counted.get(key, 0))
+        if add is not None:
+            for key, stored_count, counted_count in differences:
+                add(key, counted_count - stored_count)
+    return differences
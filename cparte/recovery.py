@@ -0,0 +1,246 @@
+# ----------------------------------------------
+# Reconnection of the streams. Each class of
+# error is retried with the backoff recommended
+# by Twitter, the messages published while the
+# stream was down are recovered from the last
+# checkpoint, and the time to reconnect and the
+# number of missed messages are recorded.
+# ----------------------------------------------
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import F
+from cparte.models import StreamPartition
+
+import collections
+import ConfigParser
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Error classes
+NETWORK = "network"        # TCP/IP errors, timeouts and connections closed by the server
+HTTP = "http"              # HTTP errors
+RATE_LIMIT = "rate_limit"  # HTTP 420, the client is connecting too often
+
+# Set the backoff from the configuration file. The defaults are the ones recommended by Twitter: back off linearly
+# from 250ms up to 16s for network errors, exponentially from 5s up to 320s for HTTP errors and exponentially from
+# 1 minute for HTTP 420 errors
+config = ConfigParser.ConfigParser()
+config.read(os.path.join(settings.BASE_DIR, "cparte/config"))
+
+recovery_settings = {'network_start': 0.25, 'network_cap': 16, 'http_start': 5, 'http_cap': 320,
+                     'rate_limit_start': 60, 'rate_limit_cap': 960, 'stable_after': 60, 'backfill': True,
+                     'max_backfill': 1000}
+if config.has_section('recovery'):
+    for option in recovery_settings.keys():
+        if config.has_option('recovery', option):
+            if isinstance(recovery_settings[option], bool):
+                recovery_settings[option] = config.getboolean('recovery', option)
+            elif isinstance(recovery_settings[option], int):
+                recovery_settings[option] = config.getint('recovery', option)
+            else:
+                recovery_settings[option] = config.getfloat('recovery', option)
+
+
+class Backoff(object):
+    """Delays to wait before the successive reconnection attempts"""
+
+    def __init__(self, start, cap, linear=False):
+        self.start = start
+        self.cap = cap
+        self.linear = linear
+        self.delay = None
+
+    def next(self):
+        if self.delay is None:
+            self.delay = self.start
+        elif self.linear:
+            self.delay = min(self.delay + self.start, self.cap)
+        else:
+            self.delay = min(self.delay * 2, self.cap)
+        return self.delay
+
+    def reset(self):
+        self.delay = None
+
+
+def get_error_class(status_code=None):
+    if status_code is None:
+        return NETWORK
+    elif status_code == 420:
+        return RATE_LIMIT
+    else:
+        return HTTP
+
+
+class RecoveryController(object):
+    """Decide when the stream of a partition has to be reconnected and keep track of its outages"""
+
+    def __init__(self, partition_id, health=None):
+        self.partition_id = partition_id
+        self.health = health
+        self.backoffs = {NETWORK: Backoff(recovery_settings['network_start'], recovery_settings['network_cap'],
+                                          linear=True),
+                         HTTP: Backoff(recovery_settings['http_start'], recovery_settings['http_cap']),
+                         RATE_LIMIT: Backoff(recovery_settings['rate_limit_start'],
+                                             recovery_settings['rate_limit_cap'])}
+        self.stopped = threading.Event()
+        self.connected_at = None
+        self.failed_at = None
+        self.message_rate = None
+        self.checkpoint = None
+        # Ids of the recovered messages, oldest first. Only the last max_backfill are kept, the stream delivers again
+        # the messages published right before it connected, if any
+        self.backfilled_ids = collections.OrderedDict()
+        self.backfiller = None
+        # Ids of the messages delivered by the stream while the backfill runs, which the backfill skips
+        self.backfilling = False
+        self.streamed_ids = set()
+        self.lock = threading.Lock()
+        self.overlapping = False
+        self.overlap_ids = set()
+        self.reconnections = 0
+        self.time_to_reconnect = None
+        self.missed = 0
+
+    @property
+    def running(self):
+        return not self.stopped.is_set()
+
+    def stop(self):
+        self.stopped.set()
+
+    # Load the id of the last message processed before the listener was restarted
+    def load_checkpoint(self):
+        self.checkpoint = StreamPartition.objects.filter(pk=self.partition_id).\
+            values_list('last_post_id', flat=True).first()
+        return self.checkpoint
+
+    # Wait before reconnecting. Return False if the stream was stopped in the meantime
+    def on_failure(self, error_class, reason=""):
+        # The backoff starts over only if the connection was stable, so a flapping connection keeps backing off
+        if self.connected_at is not None and time.time() - self.connected_at >= recovery_settings['stable_after']:
+            for backoff in self.backoffs.values():
+                backoff.reset()
+        self.connected_at = None
+        if self.failed_at is None:
+            self.failed_at = time.time()
+            if self.health is not None:
+                self.message_rate = self.health.current_rate()
+                self.checkpoint = self.health.last_post_id or self.checkpoint
+        delay = self.backoffs[error_class].next()
+        logger.warning("The stream of the partition %s failed (%s error). %s Reconnecting in %s seconds" %
+                       (self.partition_id, error_class, reason, delay))
+        self.stopped.wait(delay)
+        return self.running
+
+    # Called once the stream is connected again. Messages are recovered through backfill, which must return the
+    # number of messages that it recovered, or None if they couldn't be recovered. In the background the backfill
+    # runs in its own thread and None is returned, so the reader of the stream goes on reading, otherwise Twitter
+    # disconnects it as stalled
+    def on_connect(self, backfill=None, background=False):
+        self.connected_at = time.time()
+        if self.failed_at is None:
+            return None
+        self.time_to_reconnect = time.time() - self.failed_at
+        self.failed_at = None
+        self.reconnections += 1
+        if backfill is None or not recovery_settings['backfill'] or not self.checkpoint:
+            backfill = None
+        elif self.backfiller is not None and self.backfiller.is_alive():
+            logger.warning("The messages missed by the stream of the partition %s are still being recovered, the ones "
+                           "missed now are estimated" % self.partition_id)
+            backfill = None
+        else:
+            self.start_backfill()
+        if backfill is not None and background:
+            self.backfiller = threading.Thread(target=self.recover_in_background,
+                                               args=(backfill, self.checkpoint, self.time_to_reconnect,
+                                                     self.message_rate), name="backfill-%s" % self.partition_id)
+            self.backfiller.daemon = True
+            self.backfiller.start()
+            return None
+        return self.recover(backfill, self.checkpoint, self.time_to_reconnect, self.message_rate)
+
+    def recover(self, backfill, checkpoint, time_to_reconnect, message_rate):
+        recovered = None
+        if backfill is not None:
+            try:
+                recovered = backfill(checkpoint)
+            except Exception as e:
+                logger.error("The messages missed by the stream of the partition %s couldn't be recovered. %s" %
+                             (self.partition_id, e))
+            finally:
+                self.end_backfill()
+        if recovered is not None:
+            missed = recovered
+        else:
+            # Estimate them from the rate of messages before the failure
+            missed = int(round((message_rate or 0) * time_to_reconnect / 60.0))
+        self.missed += missed
+        logger.info("The stream of the partition %s was reconnected in %.2f seconds, %s messages were %s" %
+                    (self.partition_id, time_to_reconnect, missed, "recovered" if recovered is not None else "missed"))
+        StreamPartition.objects.filter(pk=self.partition_id).update(reconnections=F('reconnections') + 1,
+                                                                    last_reconnect_time=time_to_reconnect,
+                                                                    missed_msgs=F('missed_msgs') + missed)
+        return missed
+
+    def recover_in_background(self, *args):
+        try:
+            self.recover(*args)
+        except Exception as e:
+            logger.error("The reconnection of the stream of the partition %s couldn't be recorded. %s" %
+                         (self.partition_id, e))
+        finally:
+            connection.close()
+
+    def start_backfill(self):
+        with self.lock:
+            self.backfilling = True
+            self.streamed_ids = set()
+
+    def end_backfill(self):
+        with self.lock:
+            self.backfilling = False
+            self.streamed_ids = set()
+
+    # Whether the backfill has to process the recovered message, which it doesn't if the stream, that is read while
+    # the backfill runs, delivered it first
+    def claim_backfilled(self, post_id):
+        with self.lock:
+            if post_id in self.streamed_ids:
+                return False
+            self.backfilled_ids[post_id] = True
+            while len(self.backfilled_ids) > recovery_settings['max_backfill']:
+                self.backfilled_ids.popitem(last=False)
+            return True
+
+    # While the stream is replaced by one with new terms both streams are open, so the messages delivered by both
+    # have to be processed once
+    def start_overlap(self):
+        with self.lock:
+            self.overlap_ids = set()
+            self.overlapping = True
+
+    def end_overlap(self):
+        with self.lock:
+            self.overlapping = False
+
+    # Messages recovered by the backfill are skipped if the stream delivers them again, and so are the messages
+    # delivered twice while two streams overlap
+    def already_processed(self, post_id):
+        with self.lock:
+            if post_id in self.backfilled_ids:
+                del self.backfilled_ids[post_id]
+                return True
+            if post_id in self.overlap_ids:
+                return True
+            if self.overlapping:
+                self.overlap_ids.add(post_id)
+            if self.backfilling:
+                self.streamed_ids.add(post_id)
+        return False
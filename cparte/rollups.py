@@ -0,0 +1,79 @@
+# ----------------------------------------------
+# Counts of the contributions of the challenges
+# by status, source and day. The counts are kept
+# up to date by the contributions as they are
+# saved, so the summaries of the challenges are
+# read from a few rows instead of counting the
+# contributions. The counts can be recomputed
+# from the contributions to check and fix them,
+# see recount.
+# ----------------------------------------------
+
+from django.conf import settings
+from django.db.models import Sum
+from cparte.models import ContributionPost, ContributionCount, get_count_day
+
+import ConfigParser
+import logging
+import os
+import recount
+
+logger = logging.getLogger(__name__)
+
+# Set the size of the chunks from the configuration file
+config = ConfigParser.ConfigParser()
+config.read(os.path.join(settings.BASE_DIR, "cparte/config"))
+
+rollup_settings = {'chunk_size': 1000}
+if config.has_section('rollups'):
+    rollup_settings['chunk_size'] = config.getint('rollups', 'chunk_size')
+
+
+def get_group(challenge_id, status, source, post_datetime):
+    return challenge_id, status, source or "", get_count_day(post_datetime)
+
+
+# Count the contributions from scratch, reading them in chunks ordered by id
+def count_contributions(chunk_size=None):
+    return recount.count_in_chunks(ContributionPost.objects.all(), ('challenge_id', 'status', 'source', 'datetime'),
+                                   get_group, chunk_size or rollup_settings['chunk_size'])
+
+
+def get_stored_counts():
+    rows = ContributionCount.objects.exclude(count=0).values_list('challenge_id', 'status', 'source', 'day', 'count')
+    return dict((tuple(row[:4]), row[4]) for row in rows)
+
+
+# Groups whose stored count differs from the number of contributions, as (group, stored count, counted)
+def verify(chunk_size=None):
+    return recount.check(lambda: count_contributions(chunk_size), get_stored_counts)
+
+
+# The empty groups are removed, unless they hold revisions, which would go back otherwise
+def rebuild(chunk_size=None):
+    differences = recount.check(lambda: count_contributions(chunk_size), get_stored_counts,
+                                lambda key, delta: ContributionCount.add(*key, delta=delta))
+    ContributionCount.objects.filter(count=0, revision=0).delete()
+    logger.info("The counts of the contributions were rebuilt, %s of them were wrong" % len(differences))
+    return differences
+
+
+# Summary of the contributions of each challenge: the number of them in each status and the number of permanent
+# contributions by source and day
+def get_summary(challenge_ids=None):
+    counts = ContributionCount.objects.all()
+    if challenge_ids is not None:
+        counts = counts.filter(challenge__in=challenge_ids)
+    summary = {}
+    for challenge_id, status, count in counts.values_list('challenge', 'status').annotate(total=Sum('count')):
+        summary.setdefault(challenge_id, new_summary())['statuses'][status] = count
+    permanent = counts.filter(status="PE")
+    for challenge_id, source, count in permanent.values_list('challenge', 'source').annotate(total=Sum('count')):
+        summary.setdefault(challenge_id, new_summary())['sources'][source] = count
+    for challenge_id, day, count in permanent.values_list('challenge', 'day').annotate(total=Sum('count')):
+        summary.setdefault(challenge_id, new_summary())['days'][day.isoformat()] = count
+    return summary
+
+
+def new_summary():
+    return {'statuses': {}, 'sources': {}, 'days': {}}
@@ -0,0 +1,96 @@
+# ----------------------------------------------
+# Runtime that hosts the listeners of all the
+# partitions of a channel in one process, each
+# one in its own thread, instead of taking a
+# Celery worker per stream. The posts of every
+# stream are processed by a pool of threads
+# shared by all of them, which bounds the number
+# of connections to the db.
+# ----------------------------------------------
+
+from django.conf import settings
+from django.db import connection
+from multiprocessing.pool import ThreadPool
+from cparte.models import StreamPartition
+from social_network import TwitterStandby
+
+import ConfigParser
+import lease
+import logging
+import os
+import threading
+import traceback
+import write_behind
+
+logger = logging.getLogger(__name__)
+
+# Set the runtime from the configuration file
+config = ConfigParser.ConfigParser()
+config.read(os.path.join(settings.BASE_DIR, "cparte/config"))
+
+runtime_settings = {'enabled': False, 'db_threads': 4}
+if config.has_section('runtime'):
+    # When enabled, connecting a channel doesn't launch Celery tasks, the runtime picks its partitions up
+    runtime_settings['enabled'] = config.getboolean('runtime', 'enabled')
+    runtime_settings['db_threads'] = config.getint('runtime', 'db_threads')
+
+
+class StreamRuntime(object):
+    """Listeners of the partitions of a channel running as threads of one process"""
+
+    def __init__(self, channel_name="twitter", db_threads=None):
+        self.channel_name = channel_name.lower()
+        self.pool = ThreadPool(db_threads or runtime_settings['db_threads'])
+        self.listeners = {}  # Partition id -> (standby listener, thread)
+        self.stopped = threading.Event()
+
+    # Start the listeners of the new partitions. The listeners of removed partitions stop by themselves
+    def sync(self):
+        for partition_id, (standby, thread) in self.listeners.items():
+            if not thread.is_alive():
+                del self.listeners[partition_id]
+        partition_ids = StreamPartition.objects.filter(channel__name=self.channel_name).values_list('id', flat=True)
+        for partition_id in partition_ids:
+            if partition_id not in self.listeners:
+                self.start_listener(partition_id)
+        return sorted(self.listeners.keys())
+
+    def start_listener(self, partition_id):
+        standby = TwitterStandby(partition_id, pool=self.pool)
+        thread = threading.Thread(target=self.run_listener, args=(standby,), name="listener-%s" % partition_id)
+        thread.daemon = True
+        thread.start()
+        self.listeners[partition_id] = (standby, thread)
+        logger.info("The runtime started the listener of the partition %s" % partition_id)
+
+    def run_listener(self, standby):
+        try:
+            standby.run(keep_waiting=True)
+        except Exception:
+            logger.error(traceback.format_exc())
+        finally:
+            connection.close()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.sync()
+            except Exception as e:
+                logger.error("The listeners of %s couldn't be synchronized. %s" % (self.channel_name, e))
+            self.stopped.wait(lease.lease_settings['poll_interval'])
+        self.shutdown()
+
+    def stop(self):
+        self.stopped.set()
+
+    # The listeners release their leases and spool the posts they didn't process, so nothing is lost
+    def shutdown(self):
+        for standby, thread in self.listeners.values():
+            standby.stop()
+        for standby, thread in self.listeners.values():
+            thread.join()
+        self.listeners = {}
+        self.pool.close()
+        self.pool.join()
+        write_behind.flush()
+        logger.info("The runtime of %s stopped" % self.channel_name)
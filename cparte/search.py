@@ -0,0 +1,139 @@
+# ----------------------------------------------
+# Search of the permanent contributions and the
+# share posts. The terms of the posts are kept in
+# an inverted index, updated as the posts are
+# saved and as the contributions are preserved
+# or discarded. The posts that contain all the
+# terms searched are ranked by the db, weighting
+# each term by how rare it is (tf-idf).
+# ----------------------------------------------
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Count
+from cparte.models import ContributionPost, SearchEntry, SharePost
+
+import ConfigParser
+import hashlib
+import logging
+import math
+import os
+import pagination
+
+logger = logging.getLogger(__name__)
+
+# Set the limits of the search from the configuration file
+config = ConfigParser.ConfigParser()
+config.read(os.path.join(settings.BASE_DIR, "cparte/config"))
+
+search_settings = {'max_results': 100, 'frequency_timeout': 3600, 'chunk_size': 1000}
+if config.has_section('search'):
+    search_settings['max_results'] = config.getint('search', 'max_results')
+    # Seconds during which the number of posts that contain a term is taken from the cache
+    search_settings['frequency_timeout'] = config.getint('search', 'frequency_timeout')
+    search_settings['chunk_size'] = config.getint('search', 'chunk_size')
+
+CONTRIBUTIONS = "CP"
+SHARES = "SP"
+
+
+def get_frequency_key(term):
+    return "cparte-search-%s" % hashlib.md5(term.encode("utf-8")).hexdigest()
+
+
+# Number of posts that contain each term, counted again only once the numbers in the cache expire
+def get_document_frequencies(terms):
+    cached = cache.get_many([get_frequency_key(term) for term in terms])
+    frequencies = dict((term, cached[get_frequency_key(term)]) for term in terms if get_frequency_key(term) in cached)
+    missing = [term for term in terms if term not in frequencies]
+    if missing:
+        counted = dict((term, 0) for term in missing)
+        counted.update(SearchEntry.objects.filter(term__in=missing).values_list('term').annotate(posts=Count('id')))
+        cache.set_many(dict((get_frequency_key(term), count) for term, count in counted.items()),
+                       search_settings['frequency_timeout'])
+        frequencies.update(counted)
+    return frequencies
+
+
+def count_posts():
+    return pagination.get_cached_count(ContributionPost.objects.filter(status="PE"),
+                                       search_settings['frequency_timeout']) + \
+        pagination.get_cached_count(SharePost.objects.all(), search_settings['frequency_timeout'])
+
+
+# Posts that contain all the terms of the query, as (kind, id, score), the most relevant first
+def search(query, kinds=None, limit=None):
+    limit = min(limit or search_settings['max_results'], search_settings['max_results'])
+    terms = SearchEntry.get_terms(query).keys()
+    if not terms:
+        return []
+    frequencies = get_document_frequencies(terms)
+    if not all(frequencies.values()):
+        return []
+    total = max(count_posts(), max(frequencies.values()))
+    weights = [(term, math.log(1.0 + float(total) / frequencies[term])) for term in terms]
+    quote = connection.ops.quote_name
+    sql = "SELECT %s, %s, SUM(%s * CASE %s %s END) AS score FROM %s WHERE %s IN (%s)" % \
+          (quote('kind'), quote('post_id'), quote('frequency'), quote('term'),
+           " ".join("WHEN %s THEN %s" for _ in weights), quote(SearchEntry._meta.db_table), quote('term'),
+           ", ".join("%s" for _ in terms))
+    params = [value for weight in weights for value in weight] + terms
+    if kinds:
+        sql += " AND %s IN (%s)" % (quote('kind'), ", ".join("%s" for _ in kinds))
+        params += list(kinds)
+    sql += " GROUP BY %s, %s HAVING COUNT(DISTINCT %s) = %%s ORDER BY score DESC, %s DESC LIMIT %%s" % \
+           (quote('kind'), quote('post_id'), quote('term'), quote('post_id'))
+    params += [len(terms), limit]
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
+    return [(kind, post_id, score) for kind, post_id, score in cursor.fetchall()]
+
+
+# Ids of the posts of the kind that contain all the terms of the query, neither ranked nor limited, as a queryset
+# that the db runs as a subquery. None if the query has no terms
+def get_matching_ids(query, kind):
+    terms = SearchEntry.get_terms(query).keys()
+    if not terms:
+        return None
+    return SearchEntry.objects.filter(kind=kind, term__in=terms).values('post_id').\
+        annotate(matched=Count('term', distinct=True)).filter(matched=len(terms)).values_list('post_id', flat=True)
+
+
+# Results of the search with their posts, as dictionaries
+def get_results(query, kinds=None, limit=None):
+    results = search(query, kinds, limit)
+    posts = {}
+    for kind, model in ((CONTRIBUTIONS, ContributionPost), (SHARES, SharePost)):
+        post_ids = [post_id for result_kind, post_id, _ in results if result_kind == kind]
+        if post_ids:
+            posts[kind] = model.objects.in_bulk(post_ids)
+    rows = []
+    for kind, post_id, score in results:
+        post = posts[kind].get(post_id)
+        if post is not None:
+            rows.append({'kind': dict(SearchEntry.KINDS)[kind].lower(), 'id': post_id, 'score': round(score, 4),
+                         'text': post.full_text if kind == CONTRIBUTIONS else post.text, 'url': post.url,
+                         'datetime': post.datetime.isoformat(), 'challenge': post.challenge_id})
+    return rows
+
+
+# Index again all the permanent contributions and the share posts, reading them in chunks ordered by id
+def rebuild(chunk_size=None):
+    chunk_size = chunk_size or search_settings['chunk_size']
+    indexed = 0
+    with transaction.atomic():
+        SearchEntry.objects.all().delete()
+        for kind, posts, fields in ((CONTRIBUTIONS, ContributionPost.objects.filter(status="PE"),
+                                     ('id', 'full_text', 'contribution')),
+                                    (SHARES, SharePost.objects.all(), ('id', 'text'))):
+            last_id = 0
+            while True:
+                chunk = list(posts.filter(id__gt=last_id).order_by('id').values_list(*fields)[:chunk_size])
+                SearchEntry.add_posts(kind, chunk)
+                indexed += len(chunk)
+                if len(chunk) < chunk_size:
+                    break
+                last_id = chunk[-1][0]
+    logger.info("The search index was rebuilt with %s posts" % indexed)
+    return indexed
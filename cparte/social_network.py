@@ -1,16 +1,24 @@
 from django.conf import settings
 from celery import current_app
 from celery.contrib.methods import task_method
+from django.db import connection
 
 import abc
 import ast
 import channel_middleware
 import ConfigParser
+import lease
+import load_shedding
 import logging
 import models
 import os
+import partitioning
 import re
+import recovery
 import signal
+import stream_health
+import stream_reader
+import threading
 import traceback
 import tweepy
 
@@ -20,6 +28,20 @@ json = import_simplejson()
 
 logger = logging.getLogger(__name__)
 
+# Set the Twitter endpoints from the configuration file. They point to Twitter unless they are changed to use a
+# stand-in, such as the one in fake_twitter
+config = ConfigParser.ConfigParser()
+config.read(os.path.join(settings.BASE_DIR, "cparte/config"))
+
+api_settings = {'api_host': 'api.twitter.com', 'stream_host': 'stream.twitter.com', 'ca_bundle': None}
+for option in api_settings.keys():
+    if config.has_option('twitter_api', option) and config.get('twitter_api', option):
+        api_settings[option] = config.get('twitter_api', option)
+if api_settings['ca_bundle']:
+    api_settings['ca_bundle'] = os.path.join(settings.BASE_DIR, api_settings['ca_bundle'])
+# Ask for the stream compressed with gzip, it takes less bandwidth at the cost of decompressing it
+api_settings['gzip'] = config.has_option('twitter_api', 'gzip') and config.getboolean('twitter_api', 'gzip')
+
 
 # ----------------------------------------------------------
 # Abstract Class. All Social Networks must inherit from it.
@@ -95,23 +117,29 @@ class Twitter(SocialNetwork):
                                       config.get('twitter_api', 'token_secret'))
         return auth_handler
 
+    @staticmethod
+    def get_api(auth_handler, wait_on_rate_limit=True):
+        return tweepy.API(auth_handler=auth_handler, host=api_settings['api_host'],
+                          wait_on_rate_limit=wait_on_rate_limit, wait_on_rate_limit_notify=wait_on_rate_limit)
+
+    @staticmethod
+    def authenticate_account(account):
+        auth_handler = tweepy.OAuthHandler(account.consumer_key, account.consumer_secret)
+        auth_handler.set_access_token(account.token, account.token_secret)
+        return auth_handler
+
     @current_app.task(filter=task_method)
-    def listen(accounts, hashtags):
-        auth_handler = Twitter.authenticate()
-        listener = TwitterListener()
-        #stream = tweepy.Stream(auth_handler, listener)
-        stream = TwitterClientWrapper(auth_handler, listener)
-        try:
-            stream.filter(follow=accounts, track=hashtags, stall_warnings=True)
-        except Exception as e:
-            logger.error(traceback.format_exc())
-            channel_middleware.auto_recovery("Twitter")
+    def listen(partition_id):
+        # The task competes for the stream of the partition with the standby listeners and gives up once the channel
+        # is turned off
+        standby = TwitterStandby(partition_id)
+        standby.run(keep_waiting=False)
 
     @staticmethod
     def send_message(message, type_msg, payload, recipient_id, channel_url):
         auth_writer = Twitter.auth_initiative_writer(payload["initiative_id"])
         if auth_writer:
-            api = tweepy.API(auth_handler=auth_writer, wait_on_rate_limit=True, wait_on_rate_limit_notify=True)
+            api = Twitter.get_api(auth_writer)
             try:
                 # Public Posts
                 if type_msg == "PU":
@@ -138,13 +166,13 @@ class Twitter(SocialNetwork):
     @staticmethod
     def get_post(id_post):
         auth_handler = Twitter.authenticate()
-        api = tweepy.API(auth_handler=auth_handler, wait_on_rate_limit=True, wait_on_rate_limit_notify=True)
+        api = Twitter.get_api(auth_handler)
         return api.get_status(id_post)
 
     @staticmethod
     def delete_post(post):
         auth_handler = Twitter.authenticate()
-        api = tweepy.API(auth_handler=auth_handler, wait_on_rate_limit=True, wait_on_rate_limit_notify=True)
+        api = Twitter.get_api(auth_handler)
         try:
             return api.destroy_status(post["id"])
         except tweepy.TweepError, e:
@@ -153,9 +181,72 @@ class Twitter(SocialNetwork):
     @staticmethod
     def get_info_user(id_user):
         auth_handler = Twitter.authenticate()
-        api = tweepy.API(auth_handler=auth_handler, wait_on_rate_limit=True, wait_on_rate_limit_notify=True)
+        api = Twitter.get_api(auth_handler)
         return api.get_user(id_user)
 
+    # Get the posts identified by post_ids, up to 100 per call. The posts that were deleted are not returned
+    @staticmethod
+    def lookup_posts(post_ids):
+        auth_handler = Twitter.authenticate()
+        api = Twitter.get_api(auth_handler)
+        return api.statuses_lookup(post_ids, trim_user=True)
+
+    # Get the users identified by user_ids, up to 100 per call. The users that were suspended or deleted are not
+    # returned
+    @staticmethod
+    def lookup_users(user_ids):
+        auth_handler = Twitter.authenticate()
+        api = Twitter.get_api(auth_handler)
+        try:
+            return api.lookup_users(user_ids=user_ids, include_entities=False)
+        except tweepy.TweepError as e:
+            # Twitter answers with 404 when none of the users exists anymore
+            if e.response is not None and e.response.status_code == 404:
+                return []
+            raise
+
+    # Search the recent posts, published after the post since_id, that contain any of the terms. They are returned
+    # from the oldest to the newest, up to max_posts. The search returns the newest posts first, so it goes on until
+    # the post since_id to keep the oldest ones, which the stream will never deliver. The search fails instead of
+    # waiting up to 15 minutes if it is rate limited
+    @staticmethod
+    def search_since(terms, since_id, max_posts):
+        auth_handler = Twitter.authenticate()
+        api = Twitter.get_api(auth_handler, wait_on_rate_limit=False)
+        statuses = {}
+        truncated = False
+        for query in Twitter.build_search_queries(terms):
+            max_id = None
+            while True:
+                page = api.search(q=query, since_id=since_id, max_id=max_id, count=100, result_type="recent")
+                for status in page:
+                    statuses[status.id_str] = status
+                if len(statuses) > max_posts:
+                    truncated = True
+                    for status in sorted(statuses.values(), key=lambda status: status.id)[max_posts:]:
+                        del statuses[status.id_str]
+                if len(page) < 100:
+                    break
+                max_id = min([status.id for status in page]) - 1
+        if truncated:
+            logger.warning("More than %s posts were published after the post %s, the newer ones aren't recovered" %
+                           (max_posts, since_id))
+        return sorted(statuses.values(), key=lambda status: status.id)
+
+    # The search queries of Twitter are limited to 500 characters
+    @staticmethod
+    def build_search_queries(terms, max_length=500):
+        queries = []
+        query = ""
+        for term in terms:
+            if query and len(query) + len(" OR ") + len(term) > max_length:
+                queries.append(query)
+                query = ""
+            query = query + " OR " + term if query else term
+        if query:
+            queries.append(query)
+        return queries
+
     @staticmethod
     def auth_initiative_writer(initiative_id):
         try:
@@ -173,17 +264,239 @@ class Twitter(SocialNetwork):
         return {"id": post.id_str, "text": post.text, "url": url + post.author.screen_name + "/status/" + post.id_str}
 
 
+# Listener that waits, with the stream ready to be opened, until it gets the lease of the channel. Several of them
+# can run in different nodes so that one takes over the stream within seconds when the node that holds it fails
+class TwitterStandby(object):
+
+    def __init__(self, partition_id, pool=None):
+        self.partition_id = partition_id
+        self.pool = pool  # Threads shared by the listeners of a runtime to process their posts
+        self.partition = None
+        self.partitions_key = None
+        self.lease = None
+        self.listener = None
+        self.stream = None
+        self.stopped = threading.Event()
+        self.watcher = None
+        self.watching = threading.Event()
+        self.queue = None
+
+    def warm_up(self, partition):
+        # The listener needs the terms of every partition of the channel to tell which posts belong to its partition
+        partitions = list(models.StreamPartition.objects.filter(channel=partition.channel_id))
+        partitions_key = [(p.id, p.account_id, p.hashtags, p.follow) for p in partitions]
+        if self.stream is not None and partitions_key == self.partitions_key:
+            return
+        self.partition = partition
+        self.partitions_key = partitions_key
+        if self.lease is None:
+            self.lease = lease.StreamLease(partition)
+        if self.queue is None:
+            self.queue = load_shedding.ProcessingQueue(partition.id, self.process_status, self.load_status,
+                                                       pool=self.pool)
+        ownership = partitioning.PartitionOwnership(partitions, partition.id)
+        self.listener = TwitterListener(partition, ownership, queue=self.queue)
+        self.stream = TwitterClientWrapper(Twitter.authenticate_account(partition.account), self.listener)
+        # The listeners hosted by a runtime are stopped through the handler of the runtime
+        if threading.current_thread().name == "MainThread":
+            signal.signal(signal.SIGTERM, self.signal_term_handler)
+
+    def run(self, keep_waiting=True):
+        while not self.stopped.is_set():
+            partition = models.StreamPartition.objects.select_related('channel', 'account').\
+                filter(pk=self.partition_id).first()
+            if partition is None:
+                logger.info("The partition %s was removed, its listener stops" % self.partition_id)
+                return
+            if partition.channel.status:
+                self.warm_up(partition)
+                if self.lease.acquire():
+                    self.listen()
+                    self.stream = None  # The next time the stream is opened from scratch
+                    if not keep_waiting:
+                        return
+                    continue
+            elif not keep_waiting:
+                return
+            self.stopped.wait(lease.lease_settings['poll_interval'])
+
+    def listen(self):
+        listener = self.listener
+        listener.recovery.load_checkpoint()
+        self.lease.start_heartbeat(self.on_lease_lost)
+        self.start_watching()
+        self.queue.start()
+        try:
+            while listener.recovery.running and not self.stopped.is_set():
+                stream = self.stream
+                try:
+                    if stream.running:
+                        # The stream was opened in the background to subscribe to new terms
+                        self.wait_stream(stream)
+                    else:
+                        stream.filter(follow=self.partition.get_follow(), track=self.partition.get_hashtags(),
+                                      stall_warnings=True)
+                except Exception as e:
+                    if self.stream is not stream:
+                        continue  # The stream was closed because it was replaced by one subscribed to new terms
+                    logger.error(traceback.format_exc())
+                    # Reconnect the same stream, instead of starting a new listener, after the backoff
+                    listener.recovery.on_failure(recovery.NETWORK, e)
+                else:
+                    if self.stream is stream:
+                        break  # The stream was disconnected on purpose
+        finally:
+            self.stop_watching()
+            self.queue.stop()
+            listener.health.stop()
+            self.lease.stop_heartbeat()
+            self.lease.release()
+
+    def wait_stream(self, stream):
+        while stream.thread.is_alive():
+            stream.thread.join(1)
+        if stream.listener.exception is not None:
+            raise stream.listener.exception
+
+    def start_watching(self):
+        self.watching.set()
+        self.watcher = threading.Thread(target=self.watch, name="subscription-%s" % self.partition_id)
+        self.watcher.daemon = True
+        self.watcher.start()
+
+    def stop_watching(self):
+        self.watching.clear()
+        if self.watcher is not None and self.watcher is not threading.current_thread():
+            self.watcher.join(lease.lease_settings['poll_interval'])
+        self.watcher = None
+
+    # Follow the version of the partition while the stream is open, so changes of its terms are applied
+    def watch(self):
+        try:
+            while self.watching.is_set() and not self.stopped.wait(lease.lease_settings['poll_interval']):
+                if not self.watching.is_set():
+                    break
+                try:
+                    version = models.StreamPartition.objects.filter(pk=self.partition_id).\
+                        values_list('version', flat=True).first()
+                    if version is None:
+                        logger.info("The partition %s was removed, its stream is closed" % self.partition_id)
+                        self.on_lease_lost()
+                        break
+                    if version != self.partition.version:
+                        self.resubscribe()
+                except Exception as e:
+                    logger.error("The subscriptions of the partition %s couldn't be updated. %s" %
+                                 (self.partition_id, e))
+        finally:
+            connection.close()
+
+    # Make-before-break: the stream with the new terms is opened before closing the current one, so no message is
+    # lost while switching. If it doesn't connect the current stream is kept and the switch is retried later
+    def resubscribe(self):
+        partition = models.StreamPartition.objects.select_related('channel', 'account').get(pk=self.partition_id)
+        partitions = list(models.StreamPartition.objects.filter(channel=partition.channel_id))
+        old_stream, old_listener = self.stream, self.listener
+        ownership = partitioning.PartitionOwnership(partitions, partition.id)
+        listener = TwitterListener(partition, ownership, old_listener.recovery, self.queue)
+        stream = TwitterClientWrapper(Twitter.authenticate_account(partition.account), listener)
+        old_listener.recovery.start_overlap()
+        try:
+            stream.filter(follow=partition.get_follow(), track=partition.get_hashtags(), stall_warnings=True,
+                          async=True)
+            if not listener.connected.wait(partitioning.subscription_settings['connect_timeout']):
+                logger.error("The stream of the partition %s with the new terms didn't connect, the current one is "
+                             "kept" % self.partition_id)
+                stream.disconnect()
+                return False
+            self.partition, self.listener, self.stream = partition, listener, stream
+            self.partitions_key = [(p.id, p.account_id, p.hashtags, p.follow) for p in partitions]
+            old_stream.disconnect()
+        finally:
+            old_listener.recovery.end_overlap()
+        logger.info("The stream of the partition %s subscribed to its new terms" % self.partition_id)
+        return True
+
+    # The posts are processed by the listener of the current stream
+    def process_status(self, status):
+        return self.listener.process_status(status)
+
+    def load_status(self, data):
+        return tweepy.Status.parse(self.listener.api, data)
+
+    # Another listener took the stream over or the channel was turned off
+    def on_lease_lost(self):
+        self.listener.recovery.stop()
+        self.stream.disconnect()
+
+    def stop(self):
+        self.stopped.set()
+        if self.listener is not None:
+            self.listener.recovery.stop()
+        if self.stream is not None:
+            self.stream.disconnect()
+
+    def signal_term_handler(self, signal, frame):
+        logger.info("Stopping the twitter listener...")
+        self.stop()
+
+
 # Tweepy Stream Class Wrapper
 # Created to define a handler to manage the SIGTERM signal sent by
 # celery task revoke
 class TwitterClientWrapper(tweepy.Stream):
 
     def __init__(self, auth_handler, listener):
-        super(TwitterClientWrapper, self).__init__(auth_handler, listener)
-        signal.signal(signal.SIGTERM, self.signal_term_handler)
+        # The backoff of tweepy is turned off because the listener's recovery controller applies it. A stream that
+        # doesn't receive anything, not even keep-alives, during the stall timeout is reconnected
+        headers = {'Accept-Encoding': "gzip"} if api_settings['gzip'] else None
+        super(TwitterClientWrapper, self).__init__(auth_handler, listener, verify=api_settings['ca_bundle'] or True,
+                                                   timeout=stream_health.health_settings['stall_timeout'],
+                                                   retry_time=0, retry_420=0, snooze_time=0, headers=headers)
+        self.reader = None
+        self.thread = None
+        # Signal handlers can only be set from the main thread. The streams opened by the watcher of the
+        # subscriptions are stopped through the handler of the standby listener
+        if threading.current_thread().name == "MainThread":
+            signal.signal(signal.SIGTERM, self.signal_term_handler)
+
+    def _start(self, async):
+        # filter() always sets the host to stream.twitter.com, so the configured one is set right before connecting
+        self.host = api_settings['stream_host']
+        if async:
+            # The stream opened in the background is read by a thread of its own, which the standby listener waits on
+            self.running = True
+            self.thread = threading.Thread(target=self._run)
+            self.thread.start()
+        else:
+            super(TwitterClientWrapper, self)._start(async)
+
+    # The messages are cut out of the stream by their length, instead of reading it line by line, and handed to the
+    # listener as they are received
+    def _read_loop(self, resp):
+        gzipped = resp.headers.get('content-encoding', "").lower() == "gzip"
+        self.reader = stream_reader.FrameReader(gzipped)
+        while self.running:
+            chunk = resp.raw.read(self.chunk_size, decode_content=False)
+            if not chunk:
+                self.on_closed(resp)
+                return
+            messages, keep_alives = self.reader.feed(chunk)
+            for _ in range(keep_alives):
+                self.listener.keep_alive()
+            for message in messages:
+                if not self.running:
+                    return
+                self._data(message)
+
+    def on_closed(self, resp):
+        # The server closed the connection, so the stream is reconnected after the backoff
+        if self.running and self.listener.recovery.on_failure(recovery.NETWORK, "The connection was closed.") is False:
+            self.running = False
 
     def signal_term_handler(self, signal, frame):
         logger.info("Disconnecting twitter streaming...")
+        self.listener.recovery.stop()
         self.disconnect()
         # self._thread.join()  # Not sure why this works (self._thread shouldn't exist). Magic!
 
@@ -191,8 +504,55 @@ class TwitterClientWrapper(tweepy.Stream):
 class TwitterListener(tweepy.StreamListener):
     url = "https://twitter.com/"
 
-    def __init__(self):
+    def __init__(self, partition=None, ownership=None, recovery_controller=None, queue=None):
         super(TwitterListener, self).__init__()
+        self.partition = partition
+        self.ownership = ownership
+        if partition is not None:
+            self.track = partition.get_hashtags()
+            self.health = stream_health.get_tracker(partition.id, partition.channel_id)
+        else:
+            self.track = []
+            self.health = stream_health.get_tracker(None)
+        # The listener that replaces another one to subscribe to new terms goes on with its recovery controller
+        self.recovery = recovery_controller or recovery.RecoveryController(self.health.partition_id, self.health)
+        # Without a processing queue the posts are processed as they are read
+        self.queue = queue
+        if queue is not None:
+            self.health.queue = queue
+            self.app_accounts = set(models.Account.objects.values_list('id_in_channel', flat=True))
+            initiative_ids = partition.get_initiative_ids() if partition is not None else []
+            self.challenge_hashtags = set([hashtag.lower() for hashtag in models.Challenge.objects.filter(
+                campaign__initiative__in=initiative_ids).values_list('hashtag', flat=True)])
+        self.connected = threading.Event()
+        self.exception = None
+
+    def on_connect(self):
+        self.recovery.on_connect(self.backfill, background=True)
+        self.health.start()
+        self.connected.set()
+
+    # Called by the streams opened in the background before they raise the exception that stops them
+    def on_exception(self, exception):
+        self.exception = exception
+
+    # Process the posts published since the checkpoint and return how many they were. With a processing queue they
+    # are queued behind the ones read from the stream
+    def backfill(self, since_id):
+        if not self.track:
+            return None
+        statuses = Twitter.search_since(self.track, since_id, recovery.recovery_settings['max_backfill'])
+        for status in statuses:
+            self.health.record_message(status.created_at, status.id_str)
+            if self.recovery.claim_backfilled(status.id_str) and self.owns(status):
+                if self.queue is not None:
+                    self.queue.put(status, load_shedding.classify(status, self.app_accounts, self.challenge_hashtags))
+                else:
+                    self.process_status(status)
+        return len(statuses)
+
+    def keep_alive(self):
+        self.health.record_keep_alive()
 
     def on_data(self, raw_data):
         try:
@@ -234,6 +594,29 @@ class TwitterListener(tweepy.StreamListener):
 
 
     def on_status(self, status):
+        self.health.record_message(status.created_at, status.id_str)
+        if self.recovery.already_processed(status.id_str) or not self.owns(status):
+            return True
+        if self.queue is not None:
+            self.queue.put(status, load_shedding.classify(status, self.app_accounts, self.challenge_hashtags))
+            return True
+        return self.process_status(status)
+
+    # Check whether the post has to be processed by this listener or by the one of another partition
+    def owns(self, status):
+        if self.ownership is None:
+            return True
+        user_ids = [status.author.id_str, status.in_reply_to_user_id_str]
+        retweeted_status = getattr(status, 'retweeted_status', None)
+        if retweeted_status is not None:
+            user_ids.append(retweeted_status.author.id_str)
+        # Twitter also matches the terms against the expanded urls and the mentioned users
+        entities = status.entities
+        text = " ".join([status.text] + [url.get('expanded_url') or "" for url in entities.get('urls', [])] +
+                        [mention['screen_name'] for mention in entities.get('user_mentions', [])])
+        return self.ownership.owns(status.id_str, text, self.build_hashtags_array(status), user_ids)
+
+    def process_status(self, status):
         try:
             if status.retweeted_status:
                 retweet = self.get_tweet_dict(status.retweeted_status)
@@ -301,11 +684,13 @@ class TwitterListener(tweepy.StreamListener):
 
         logger.critical("Error %s (%s) in the firehose. For further explanation check: %s" %
                         (str(error_code), error_title, url_error_explanations))
-        return True  # To continue listening
+        # Wait before continue listening
+        return self.recovery.on_failure(recovery.get_error_class(error_code), "Error %s." % error_code)
 
     def on_timeout(self):
         logger.warning("Got timeout from the firehose")
-        return True  # To continue listening
+        # Wait before continue listening
+        return self.recovery.on_failure(recovery.NETWORK, "Timeout.")
 
     def on_disconnect(self, notice):
         notice_name = ""
@@ -349,8 +734,16 @@ class TwitterListener(tweepy.StreamListener):
             logger.critical("Error in the method on_disconnect. Message: %s" % e)
         return True  # To continue listening
 
+    def on_limit(self, track):
+        self.health.record_limit(track)
+        return True  # To continue listening
+
     def on_warning(self, notice):
         logger.warning("Got the following warning message: %s" % notice["message"])
+        if "percent_full" in notice:
+            self.health.record_stall_warning(notice["percent_full"])
+        if notice.get("code") == "FALLING_BEHIND" and self.queue is not None:
+            self.queue.record_warning()
 
 #---------------------------------
 # Facebook Client
@@ -0,0 +1,194 @@
+# ----------------------------------------------
+# In-memory health of the channel streams. The
+# listener records every message, keep-alive,
+# limit notice and stall warning here, and a
+# watchdog thread writes a summary into the
+# partition row with a single UPDATE every few
+# seconds and flags the stream when it goes quiet.
+# ----------------------------------------------
+
+from django.conf import settings
+from django.utils import timezone
+from cparte.models import Channel, StreamPartition
+
+import ConfigParser
+import datetime
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Set the thresholds from the configuration file
+config = ConfigParser.ConfigParser()
+config.read(os.path.join(settings.BASE_DIR, "cparte/config"))
+
+health_settings = {'flush_interval': 10, 'check_interval': 5, 'stall_timeout': 90, 'max_lag': 60}
+if config.has_section('stream_health'):
+    health_settings['flush_interval'] = config.getfloat('stream_health', 'flush_interval')
+    health_settings['check_interval'] = config.getfloat('stream_health', 'check_interval')
+    # Twitter sends a keep-alive every 30 seconds, so a stream that was silent during 90 seconds is stalled
+    health_settings['stall_timeout'] = config.getfloat('stream_health', 'stall_timeout')
+    health_settings['max_lag'] = config.getfloat('stream_health', 'max_lag')
+
+
+class StreamHealth(object):
+    """Health counters of the stream of a partition"""
+
+    def __init__(self, partition_id, channel_id=None, flush_interval=None, check_interval=None, stall_timeout=None):
+        self.partition_id = partition_id
+        self.channel_id = channel_id
+        self.flush_interval = flush_interval or health_settings['flush_interval']
+        self.check_interval = check_interval or health_settings['check_interval']
+        self.stall_timeout = stall_timeout or health_settings['stall_timeout']
+        self.lock = threading.Lock()
+        self.watchdog = None
+        self.stopped = threading.Event()
+        self.last_post_id = None
+        self.queue = None  # Processing queue of the stream, its depth and deferred posts are flushed too
+        self.reset()
+
+    def reset(self):
+        now = time.time()
+        self.connected_at = now
+        self.last_activity = now
+        self.last_flush = now
+        self.last_message = None
+        self.flushed_last_message = None
+        self.stalled = False
+        self.undelivered = 0
+        self.percent_full = None
+        self.message_rate = None
+        self.lag = None
+        self.max_lag = None
+        self._reset_window()
+
+    def _reset_window(self):
+        self.num_messages = 0
+        self.lag_sum = 0.0
+        self.window_max_lag = None
+
+    # Called for every message of the stream
+    def record_message(self, created_at, post_id=None):
+        lag = get_lag(created_at)
+        with self.lock:
+            self.last_activity = time.time()
+            self.last_message = timezone.now()
+            self.num_messages += 1
+            # The id of the newest message works as a checkpoint to recover the messages missed in case of failures
+            if post_id is not None and (self.last_post_id is None or int(post_id) > int(self.last_post_id)):
+                self.last_post_id = post_id
+            if lag is not None:
+                self.lag_sum += lag
+                if self.window_max_lag is None or lag > self.window_max_lag:
+                    self.window_max_lag = lag
+        if lag is not None and lag > health_settings['max_lag']:
+            logger.warning("The stream of the partition %s is falling behind, a message arrived %.1f seconds after "
+                           "being created" % (self.partition_id, lag))
+
+    # Messages per minute received since the last flush
+    def current_rate(self):
+        elapsed = time.time() - self.last_flush
+        if self.num_messages and elapsed > 0:
+            return self.num_messages * 60.0 / elapsed
+        return self.message_rate
+
+    def record_keep_alive(self):
+        self.last_activity = time.time()
+
+    # Number of messages that matched the filter but weren't delivered since the connection was opened
+    def record_limit(self, undelivered):
+        with self.lock:
+            self.last_activity = time.time()
+            self.undelivered = max(self.undelivered, undelivered)
+
+    def record_stall_warning(self, percent_full):
+        with self.lock:
+            self.last_activity = time.time()
+            self.percent_full = percent_full
+        logger.warning("The queue of messages of the partition %s in the server is %s%% full" %
+                       (self.partition_id, percent_full))
+
+    def start(self):
+        self.reset()
+        if self.watchdog is not None and self.watchdog.is_alive():
+            return
+        self.stopped.clear()
+        self.watchdog = threading.Thread(target=self.watch, name="stream-health-%s" % self.partition_id)
+        self.watchdog.daemon = True
+        self.watchdog.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.watchdog is not None and self.watchdog is not threading.current_thread():
+            self.watchdog.join(self.check_interval)
+        self.watchdog = None
+
+    def watch(self):
+        while not self.stopped.wait(self.check_interval):
+            try:
+                self.check()
+            except Exception as e:
+                logger.error("The health of the stream of the partition %s couldn't be checked. %s" %
+                             (self.partition_id, e))
+
+    # Detect stalls and write the health into the db when it is time to
+    def check(self, now=None):
+        now = now or time.time()
+        silence = now - self.last_activity
+        if not self.stalled and silence >= self.stall_timeout:
+            self.stalled = True
+            logger.critical("The stream of the partition %s is stalled, nothing was received during the last %d "
+                            "seconds" % (self.partition_id, silence))
+            return self.flush(now)
+        elif self.stalled and silence < self.stall_timeout:
+            self.stalled = False
+            logger.info("The stream of the partition %s is receiving data again" % self.partition_id)
+            return self.flush(now)
+        elif now - self.last_flush >= self.flush_interval:
+            return self.flush(now)
+
+    def flush(self, now=None):
+        now = now or time.time()
+        with self.lock:
+            elapsed = now - self.last_flush
+            self.message_rate = self.num_messages * 60.0 / elapsed if elapsed > 0 else None
+            self.lag = self.lag_sum / self.num_messages if self.num_messages else None
+            self.max_lag = self.window_max_lag
+            self.last_flush = now
+            self._reset_window()
+            values = {'message_rate': self.message_rate, 'stream_lag': self.lag, 'max_stream_lag': self.max_lag,
+                      'undelivered_msgs': self.undelivered, 'percent_full': self.percent_full,
+                      'stalled': self.stalled, 'last_health_check': timezone.now()}
+            if self.last_post_id is not None:
+                values['last_post_id'] = self.last_post_id
+            if self.queue is not None:
+                values.update(self.queue.get_stats())
+            last_message = self.last_message
+        StreamPartition.objects.filter(pk=self.partition_id).update(**values)
+        if last_message != self.flushed_last_message and self.channel_id is not None:
+            Channel.objects.filter(pk=self.channel_id).update(last_message=last_message)
+            self.flushed_last_message = last_message
+        return values
+
+
+trackers = {}
+trackers_lock = threading.Lock()
+
+
+def get_tracker(partition_id, channel_id=None):
+    with trackers_lock:
+        if partition_id not in trackers:
+            trackers[partition_id] = StreamHealth(partition_id, channel_id)
+        return trackers[partition_id]
+
+
+# Seconds between the creation of the message and its processing
+def get_lag(created_at):
+    if not isinstance(created_at, datetime.datetime):
+        return None
+    if timezone.is_aware(created_at):
+        created_at = timezone.make_naive(created_at, timezone.utc)
+    # The timestamps of the posts are in UTC
+    return (datetime.datetime.utcnow() - created_at).total_seconds()
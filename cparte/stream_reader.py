@@ -0,0 +1,51 @@
+# ----------------------------------------------
+# Reader of the length-delimited streams of
+# Twitter. Every message is preceded by its
+# length, so the messages are cut out of the
+# buffer without scanning their content. Streams
+# compressed with gzip are decompressed as the
+# chunks arrive.
+# ----------------------------------------------
+
+import zlib
+
+
+class FrameReader(object):
+    """Split the chunks of a stream into its messages"""
+
+    def __init__(self, gzipped=False):
+        # 16 + MAX_WBITS makes zlib expect the gzip header
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) if gzipped else None
+        self.buffer = ""
+        self.length = None  # Length of the message being read, None while reading its length
+        self.received = 0   # Bytes received, compressed if the stream is compressed
+
+    # Return the messages completed with the chunk and the number of keep-alive new lines found before them
+    def feed(self, chunk):
+        self.received += len(chunk)
+        if self.decompressor is not None:
+            chunk = self.decompressor.decompress(chunk)
+        buf = self.buffer + chunk if self.buffer else chunk
+        messages = []
+        keep_alives = 0
+        pos = 0
+        while True:
+            if self.length is None:
+                end = buf.find("\n", pos)
+                if end < 0:
+                    break
+                prefix = buf[pos:end].strip()
+                pos = end + 1
+                if not prefix:
+                    keep_alives += 1
+                    continue
+                if not prefix.isdigit():
+                    raise ValueError("Expecting the length of a message, found %r" % prefix[:20])
+                self.length = int(prefix)
+            if len(buf) - pos < self.length:
+                break
+            messages.append(buf[pos:pos + self.length])
+            pos += self.length
+            self.length = None
+        self.buffer = buf[pos:]
+        return messages, keep_alives
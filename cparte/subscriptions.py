@@ -0,0 +1,49 @@
+# ----------------------------------------------
+# Live updates of the hashtags listened by the
+# streams. Changes of initiatives, campaigns and
+# challenges are detected through model signals
+# and coalesced during a short window, so a burst
+# of edits in the admin reconnects the streams
+# only once.
+# ----------------------------------------------
+
+from django.db.models import Q
+from django.db.models.signals import post_save, post_delete
+from django.utils import timezone
+from cparte.models import Channel, Initiative, Campaign, Challenge
+
+import datetime
+import logging
+import partitioning
+import tasks
+
+logger = logging.getLogger(__name__)
+
+
+# Schedule the update of the subscriptions of the connected channels, unless one is already scheduled. An update
+# that is overdue is scheduled again, in case its task was lost
+def schedule_update():
+    window = partitioning.subscription_settings['coalesce_window']
+    for channel_id, channel_name in Channel.objects.filter(status=True).values_list('id', 'name'):
+        now = timezone.now()
+        scheduled = Channel.objects.filter(pk=channel_id).\
+            filter(Q(resubscribe_at__isnull=True) | Q(resubscribe_at__lt=now)).\
+            update(resubscribe_at=now + datetime.timedelta(seconds=window))
+        if scheduled:
+            logger.info("The subscriptions of %s will be updated in %s seconds" % (channel_name, window))
+            tasks.update_subscriptions.apply_async((channel_name,), countdown=window)
+
+
+def hashtags_changed(sender, instance, **kwargs):
+    if kwargs.get('raw'):
+        return  # Loaded from a fixture
+    try:
+        schedule_update()
+    except Exception as e:
+        logger.error("The update of the subscriptions couldn't be scheduled. %s" % e)
+
+
+def connect_signals():
+    for model in (Initiative, Campaign, Challenge):
+        post_save.connect(hashtags_changed, sender=model, dispatch_uid="subscriptions_%s_saved" % model.__name__)
+        post_delete.connect(hashtags_changed, sender=model, dispatch_uid="subscriptions_%s_deleted" % model.__name__)
@@ -0,0 +1,157 @@
+# ----------------------------------------------
+# Distribution of the answers of the structured
+# challenges. The permanent contributions are
+# read in chunks, their answers are normalized
+# and turned into integer codes, and the counts
+# and trends are computed over the codes. The
+# tally of each challenge is kept in the cache
+# with the last contribution it includes, so a
+# refresh only reads the newer contributions,
+# and with the revision of the counts of the
+# permanent contributions, so it's computed
+# again when older ones are preserved or
+# discarded.
+# ----------------------------------------------
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Sum
+from django.utils import timezone
+from cparte.models import Challenge, ContributionPost, ContributionCount
+
+import ConfigParser
+import datetime
+import logging
+import numpy
+import os
+
+logger = logging.getLogger(__name__)
+
+# Set the size of the chunks and the buckets of the trends from the configuration file
+config = ConfigParser.ConfigParser()
+config.read(os.path.join(settings.BASE_DIR, "cparte/config"))
+
+tally_settings = {'chunk_size': 1000, 'bucket_size': 86400, 'cache_timeout': 86400}
+if config.has_section('tally'):
+    tally_settings['chunk_size'] = config.getint('tally', 'chunk_size')
+    # Seconds covered by each point of the trends
+    tally_settings['bucket_size'] = config.getint('tally', 'bucket_size')
+    # Seconds during which the tally of a challenge is kept in the cache
+    tally_settings['cache_timeout'] = config.getint('tally', 'cache_timeout')
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+# Answers that differ only in case or spacing are the same answer, e.g. "b-" and "B -"
+def normalize(answer):
+    return "".join(answer.split()).upper()
+
+
+def to_timestamps(datetimes):
+    naive = [timezone.make_naive(value, timezone.utc) if timezone.is_aware(value) else value for value in datetimes]
+    return numpy.array(naive, dtype='datetime64[s]').astype(numpy.int64)
+
+
+class Tally(object):
+    """Counts of the answers of a challenge, overall and by bucket of time"""
+
+    def __init__(self, challenge_id, bucket_size, revision=0):
+        self.challenge_id = challenge_id
+        self.bucket_size = bucket_size
+        self.revision = revision  # Revision of the permanent contributions when the tally was started
+        self.last_id = 0
+        self.answers = []  # Answer of each code
+        self.codes = {}
+        self.counts = numpy.zeros(0, dtype=numpy.int64)
+        self.trend = {}  # Counts by code of each bucket, by the timestamp in which the bucket starts
+
+    def total(self):
+        return int(self.counts.sum())
+
+    def encode(self, answers):
+        uniques, inverse = numpy.unique(numpy.array([normalize(answer) for answer in answers]), return_inverse=True)
+        for answer in uniques:
+            if answer not in self.codes:
+                self.codes[answer] = len(self.answers)
+                self.answers.append(answer)
+        return numpy.array([self.codes[answer] for answer in uniques], dtype=numpy.int64)[inverse]
+
+    # Add a chunk of contributions given as (id, answer, datetime), ordered by id
+    def add(self, rows):
+        if not rows:
+            return
+        ids, answers, datetimes = zip(*rows)
+        codes = self.encode(answers)
+        self.counts = numpy.bincount(codes, minlength=len(self.answers)) + \
+            numpy.append(self.counts, numpy.zeros(len(self.answers) - len(self.counts), dtype=numpy.int64))
+        buckets = to_timestamps(datetimes) // self.bucket_size
+        # Each pair of bucket and code is counted once by combining both into a single number
+        pairs, pair_counts = numpy.unique(buckets * len(self.answers) + codes, return_counts=True)
+        for pair, count in zip(pairs, pair_counts):
+            bucket, code = divmod(int(pair), len(self.answers))
+            bucket_counts = self.trend.setdefault(bucket * self.bucket_size, {})
+            bucket_counts[code] = bucket_counts.get(code, 0) + int(count)
+        self.last_id = ids[-1]
+
+    def to_dict(self):
+        total = self.total()
+        # The most frequent answers first, the ties in the order of the answers
+        order = numpy.lexsort((numpy.array(self.answers), -self.counts)) if self.answers else []
+        percentages = self.counts * 100.0 / total if total else numpy.zeros(len(self.counts))
+        return {'challenge': self.challenge_id, 'last_id': self.last_id, 'total': total,
+                'answers': [{'answer': self.answers[code], 'count': int(self.counts[code]),
+                             'percentage': round(float(percentages[code]), 2)} for code in order],
+                'trend': [{'start': (EPOCH + datetime.timedelta(seconds=start)).isoformat(),
+                           'counts': dict((self.answers[code], count) for code, count in bucket_counts.items())}
+                          for start, bucket_counts in sorted(self.trend.items())]}
+
+
+# Permanent contributions of the challenge after the id, in chunks ordered by id
+def get_chunks(challenge_id, after_id=0, chunk_size=None):
+    chunk_size = chunk_size or tally_settings['chunk_size']
+    posts = ContributionPost.objects.filter(challenge=challenge_id, status="PE")
+    while True:
+        chunk = list(posts.filter(id__gt=after_id).order_by('id').values_list('id', 'contribution', 'datetime')
+                     [:chunk_size])
+        if chunk:
+            yield chunk
+        if len(chunk) < chunk_size:
+            break
+        after_id = chunk[-1][0]
+
+
+# Number of permanent contributions of the challenge and the times that stored contributions became permanent or
+# stopped being it
+def get_permanent_state(challenge_id):
+    counts = ContributionCount.objects.filter(challenge=challenge_id, status="PE")
+    state = counts.aggregate(total=Sum('count'), revision=Sum('revision'))
+    return state['total'] or 0, state['revision'] or 0
+
+
+def get_cache_key(challenge_id):
+    return "cparte-tally-%s" % challenge_id
+
+
+# Tally of the answers of a structured challenge. The cached tally is brought up to date with the contributions
+# saved after its last one, unless older contributions were preserved or discarded meanwhile, which is noticed
+# because the revision of the permanent contributions changed, and then the tally is computed again. The revision is
+# read before the contributions, so a change made while they are read is noticed in the next refresh
+def get_tally(challenge_id):
+    challenge = Challenge.objects.get(pk=challenge_id)
+    if challenge.style_answer != "ST" or not challenge.format_answer:
+        raise ValueError("The challenge %s doesn't have structured answers" % challenge_id)
+    total, revision = get_permanent_state(challenge_id)
+    cached = tally = cache.get(get_cache_key(challenge_id))
+    if tally is not None and getattr(tally, 'revision', None) != revision:
+        logger.info("Contributions of the challenge %s changed, its tally is computed again" % challenge_id)
+        tally = None
+    if tally is None or tally.bucket_size != tally_settings['bucket_size']:
+        tally = Tally(challenge_id, tally_settings['bucket_size'], revision)
+    last_id = tally.last_id
+    for chunk in get_chunks(challenge_id, tally.last_id):
+        tally.add(chunk)
+    if last_id == 0 and tally.total() != total:
+        logger.warning("The counts of the contributions of the challenge %s are wrong" % challenge_id)
+    if tally is not cached or tally.last_id != last_id:
+        cache.set(get_cache_key(challenge_id), tally, tally_settings['cache_timeout'])
+    return tally
@@ -0,0 +1,31 @@
+# ----------------------------------------------
+# Celery tasks of the app. The module is found
+# by the autodiscovery of the celery app, so the
+# workers register the tasks without importing
+# the modules that use them.
+# ----------------------------------------------
+
+from celery import current_app
+from cparte.models import Channel
+
+import channel_middleware
+import engagement
+import profiles
+
+
+@current_app.task(name="cparte.tasks.update_subscriptions")
+def update_subscriptions(channel_name):
+    # The changes made from now on schedule another update
+    Channel.objects.filter(name=channel_name).update(resubscribe_at=None)
+    channel_middleware.update_subscriptions(channel_name)
+
+
+@current_app.task(name="cparte.tasks.refresh_engagement")
+def refresh_engagement():
+    return engagement.refresh()
+
+
+@current_app.task(name="cparte.tasks.refresh_profiles")
+def refresh_profiles():
+    for channel_name in Channel.objects.filter(enabled=True).values_list('name', flat=True):
+        profiles.refresh(channel_name)
@@ -1,25 +1,89 @@
+from django.conf import settings
+from django.contrib import admin
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.db import connection
 from django.test import TestCase
-from cparte.models import Channel
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from cparte.models import Channel, AppPost, Account, Author, Campaign, ContributionCount, ContributionPost, \
+    Initiative, Challenge, Message, PostClaim, SearchEntry, SharePost, StreamPartition, ZipcodeCount
+from social_network import Twitter, TwitterClientWrapper, TwitterListener, TwitterStandby
 
+import benchmark
 import channel_middleware
 import ConfigParser
+import datetime
+import duplicates
+import engagement
+import export
+import fake_twitter
+import feed
+import geography
+import itertools
 import json
+import lease
+import numpy
+import load_shedding
+import os
+import pagination
+import partitioning
+import profiles
+import post_manager
+import profiler
+import query_budget
 import re
+import recovery
+import rollups
+import search
+import runtime
+import shutil
+import StringIO
+import social_network
+import stream_health
+import stream_reader
+import tally
+import tasks
+import tempfile
+import threading
+import time
 import tweepy
+import write_behind
+import zlib
 
 
 class TwitterTestCase(TestCase):
     fixtures = ['cparte.json']
     url = "https://twitter.com/"
     config = ConfigParser.ConfigParser()
-    config.read('cparte/config')
+    config.read(os.path.join(settings.BASE_DIR, "cparte/config"))
+
+    @classmethod
+    def setUpClass(cls):
+        super(TwitterTestCase, cls).setUpClass()
+        # The testing tweets are served by a local stand-in of Twitter, which also receives the app's replies
+        cls.fake_twitter = fake_twitter.FakeTwitter().start()
+        cls.org_api_settings = dict(social_network.api_settings)
+        social_network.api_settings.update(cls.fake_twitter.api_settings())
+        # tweepy doesn't allow to set the certificates of the API calls, so requests takes the one of the stand-in
+        # from the environment while these tests run
+        cls.org_ca_bundle = os.environ.get('REQUESTS_CA_BUNDLE')
+        os.environ['REQUESTS_CA_BUNDLE'] = cls.fake_twitter.certfile
+
+    @classmethod
+    def tearDownClass(cls):
+        social_network.api_settings.update(cls.org_api_settings)
+        if cls.org_ca_bundle is None:
+            del os.environ['REQUESTS_CA_BUNDLE']
+        else:
+            os.environ['REQUESTS_CA_BUNDLE'] = cls.org_ca_bundle
+        cls.fake_twitter.stop()
+        super(TwitterTestCase, cls).tearDownClass()
 
     def setUp(self):
-        auth = tweepy.OAuthHandler(self.config.get('twitter_api','consumer_key'), self.config.get('twitter_api','consumer_secret'))
-        auth.set_access_token(self.config.get('twitter_api','token'), self.config.get('twitter_api','token_secret'))
-        api = tweepy.API(auth)
-        api.retry_count = 2
-        api.retry_delay = 5
+        api = Twitter.get_api(Twitter.authenticate())
 
         self.testing_posts = self.get_array_testing_tweets()
         tweet_ids = self.get_id_testing_tweets()
@@ -28,6 +92,7 @@ class TwitterTestCase(TestCase):
 
         channel = Channel.objects.get(name="twitter")
         session_info = channel_middleware.get_session_info([1])
+        self.partition = partitioning.assign(channel, [1])[0]
         channel.connect("", json.dumps(session_info))
         self.limit_incorrect_inputs = self.config.getint('app', 'limit_wrong_input')
         self.limit_incorrect_requests = self.config.getint('app', 'limit_wrong_request')
@@ -165,4 +230,1568 @@ class TestAppBehavior(TwitterTestCase):
                 incorrect_post_existing_user_answered_challenge = self.to_dict(testing_post['status'])
         output = channel_middleware.process_post(incorrect_post_existing_user_answered_challenge, "twitter")
         self.assertNotEqual(output.category, None)
-        self.assertEqual(output.category, "incorrect_answer")
\ No newline at end of file
+        self.assertEqual(output.category, "incorrect_answer")
+
+
+# Listener that stops listening when the stream is disconnected
+class StoppingTwitterListener(TwitterListener):
+
+    def __init__(self):
+        super(StoppingTwitterListener, self).__init__()
+        self.num_statuses = 0
+
+    def on_status(self, status):
+        self.num_statuses += 1
+        return super(StoppingTwitterListener, self).on_status(status)
+
+    def on_disconnect(self, notice):
+        super(StoppingTwitterListener, self).on_disconnect(notice)
+        return False
+
+
+class TestFakeTwitter(TwitterTestCase):
+
+    def test_stream_testing_tweets(self):
+        statuses = [self.fake_twitter.statuses[tweet['id']] for tweet in self.testing_posts]
+        messages = statuses + [fake_twitter.stall_warning(60), fake_twitter.limit_notice(5)]
+        self.fake_twitter.stream = fake_twitter.StreamSettings(messages=messages, disconnect_code=4)
+        num_updates = len(self.fake_twitter.updates)
+        listener = StoppingTwitterListener()
+        stream = TwitterClientWrapper(Twitter.authenticate(), listener)
+        try:
+            stream.filter(track=["calrepcard"], stall_warnings=True)
+        finally:
+            listener.health.stop()
+        self.assertEqual(self.fake_twitter.stream_requests[-1]['track'], "calrepcard")
+        self.assertEqual(listener.num_statuses, len(statuses))
+        self.assertEqual(listener.health.undelivered, 5)
+        self.assertEqual(listener.health.percent_full, 60)
+        # Every testing tweet gets a reply from the app
+        self.assertEqual(len(self.fake_twitter.updates) - num_updates, len(statuses))
+        self.assertEqual(AppPost.objects.filter(category="NT").count() + AppPost.objects.filter(category="TH").count(),
+                         len(statuses))
+
+    def test_gzipped_stream(self):
+        statuses = [self.fake_twitter.statuses[tweet['id']] for tweet in self.testing_posts]
+        self.fake_twitter.stream = fake_twitter.StreamSettings(messages=statuses, disconnect_code=4)
+        self.addCleanup(social_network.api_settings.update, {'gzip': social_network.api_settings['gzip']})
+        received = {}
+        for gzipped in (False, True):
+            social_network.api_settings['gzip'] = gzipped
+            listener = StoppingTwitterListener()
+            stream = TwitterClientWrapper(Twitter.authenticate(), listener)
+            try:
+                stream.filter(track=["calrepcard"], stall_warnings=True)
+            finally:
+                listener.health.stop()
+            self.assertEqual(listener.num_statuses, len(statuses))
+            received[gzipped] = stream.reader.received
+        self.assertEqual(self.fake_twitter.stream_encodings[-2:], ["identity", "gzip"])
+        self.assertTrue(received[True] < received[False] / 2)
+
+    def test_delete_post(self):
+        tweet_id = self.fake_twitter.new_status("Testing post #calrepcard", self.fake_twitter.users["156641445"])["id_str"]
+        Twitter.delete_post({"id": tweet_id})
+        self.assertEqual(self.fake_twitter.destroyed, [tweet_id])
+        self.assertEqual(Twitter.delete_post({"id": tweet_id}), None)
+
+    def test_backfill_after_reconnecting(self):
+        checkpoint = max(self.fake_twitter.statuses.values(), key=lambda status: status["id"])["id_str"]
+        author = self.fake_twitter.users["156641445"]
+        missed = [self.fake_twitter.new_status("B #obamacare #calrepcard", author)["id_str"],
+                  self.fake_twitter.new_status("Not a post for the app #elsewhere", author)["id_str"]]
+        listener = TwitterListener(self.partition)
+        listener.recovery.checkpoint = checkpoint
+        listener.recovery.failed_at = time.time() - 2
+        self.assertEqual(listener.recovery.on_connect(listener.backfill), 1)
+        self.assertTrue(listener.recovery.time_to_reconnect >= 2)
+        partition = StreamPartition.objects.get(pk=self.partition.id)
+        self.assertEqual(partition.reconnections, 1)
+        self.assertEqual(partition.missed_msgs, 1)
+        # The post recovered by the backfill is not processed again when the stream delivers it
+        status = Twitter.get_post(missed[0])
+        num_updates = len(self.fake_twitter.updates)
+        self.assertTrue(listener.on_status(status))
+        self.assertEqual(len(self.fake_twitter.updates), num_updates)
+
+    def test_backfill_after_the_stream(self):
+        checkpoint = max(self.fake_twitter.statuses.values(), key=lambda status: status["id"])["id_str"]
+        author = self.fake_twitter.users["156641445"]
+        missed = self.fake_twitter.new_status("B #obamacare #calrepcard", author)["id_str"]
+        listener = TwitterListener(self.partition)
+        # The stream, read while the backfill searches, delivers the post first
+        listener.recovery.start_backfill()
+        num_updates = len(self.fake_twitter.updates)
+        self.assertTrue(listener.on_status(Twitter.get_post(missed)))
+        self.assertEqual(len(self.fake_twitter.updates), num_updates + 1)
+        self.assertEqual(listener.backfill(checkpoint), 1)
+        self.assertEqual(len(self.fake_twitter.updates), num_updates + 1)
+
+    def test_search_keeps_the_oldest_posts(self):
+        checkpoint = max(self.fake_twitter.statuses.values(), key=lambda status: status["id"])["id_str"]
+        author = self.fake_twitter.users["156641445"]
+        oldest = self.fake_twitter.new_status("B #obamacare #calrepcard", author)["id_str"]
+        self.fake_twitter.new_status("C #obamacare #calrepcard", author)
+        self.assertEqual([status.id_str for status in Twitter.search_since(["calrepcard"], checkpoint, 1)], [oldest])
+
+    def test_resubscribe_make_before_break(self):
+        org_apply_async = tasks.update_subscriptions.apply_async
+        tasks.update_subscriptions.apply_async = lambda args, countdown: None
+        self.addCleanup(setattr, tasks.update_subscriptions, 'apply_async', org_apply_async)
+        self.fake_twitter.stream = fake_twitter.StreamSettings(keep_alive=True)
+        standby = TwitterStandby(self.partition.id)
+        standby.warm_up(StreamPartition.objects.select_related('channel', 'account').get(pk=self.partition.id))
+        old_stream = standby.stream
+        old_stream.filter(track=standby.partition.get_hashtags(), async=True)
+        try:
+            self.assertTrue(standby.listener.connected.wait(5))
+            # A new challenge is added in the admin, and the stream subscribes to its hashtag
+            Challenge.objects.create(name="New challenge", campaign_id=1, hashtag="newchallenge", style_answer="FR")
+            tasks.update_subscriptions("twitter")
+            self.assertEqual(StreamPartition.objects.get(pk=self.partition.id).version, self.partition.version + 1)
+            self.assertTrue(standby.resubscribe())
+            # The new stream was connected before the old one was closed
+            self.assertTrue(standby.stream.running)
+            self.assertFalse(old_stream.running)
+            self.assertIn("newchallenge", self.fake_twitter.stream_requests[-1]['track'])
+            self.assertIs(standby.listener.recovery, old_stream.listener.recovery)
+            # The switch is made by the thread that watches the subscriptions, where the stream can't set signal
+            # handlers
+            streams = []
+            watcher = threading.Thread(target=lambda: streams.append(TwitterClientWrapper(Twitter.authenticate(),
+                                                                                          standby.listener)))
+            watcher.start()
+            watcher.join()
+            self.assertEqual(len(streams), 1)
+        finally:
+            standby.stream.disconnect()
+            old_stream.disconnect()
+            standby.listener.health.stop()
+
+
+class TestEngagement(TwitterTestCase):
+
+    def setUp(self):
+        super(TestEngagement, self).setUp()
+        self.org_settings = dict(engagement.engagement_settings)
+
+    def tearDown(self):
+        engagement.engagement_settings.update(self.org_settings)
+        super(TestEngagement, self).tearDown()
+
+    def add_app_post(self, minutes_ago=0):
+        status = self.fake_twitter.new_status("Thanks for your contribution #calrepcard",
+                                              {"id": 2733258272, "id_str": "2733258272", "screen_name": "josaldev"})
+        AppPost.objects.create(id_in_channel=status["id_str"], text=status["text"], initiative_id=1, campaign_id=1,
+                               challenge_id=1, channel_id=1, category="EN",
+                               datetime=timezone.now() - datetime.timedelta(minutes=minutes_ago))
+        return status
+
+    def test_refresh_changed_posts(self):
+        changed = self.add_app_post()
+        unchanged = self.add_app_post()
+        changed.update({"retweet_count": 3, "favorite_count": 2})
+        self.assertEqual(engagement.refresh(), 1)
+        app_post = AppPost.objects.get(id_in_channel=changed["id_str"])
+        self.assertEqual((app_post.re_posts, app_post.bookmarks), (3, 2))
+        # The pass ended, and the next one doesn't start until the refresh interval passes
+        channel = Channel.objects.get(name="twitter")
+        self.assertEqual(channel.metrics_cursor, None)
+        self.assertNotEqual(channel.metrics_pass_started, None)
+        unchanged.update({"retweet_count": 1})
+        with self.assertNumQueries(1):
+            self.assertEqual(engagement.refresh(), 0)
+        Channel.objects.filter(name="twitter").update(metrics_pass_started=timezone.now() - datetime.timedelta(days=1))
+        self.assertEqual(engagement.refresh(), 1)
+
+    def test_recent_posts_first(self):
+        old = self.add_app_post(minutes_ago=60)
+        recent = self.add_app_post()
+        channel = Channel.objects.get(name="twitter")
+        due = engagement.get_due_posts(channel, timezone.now(), 1)
+        self.assertEqual([post_id for _, _, _, post_id, _, _ in due], [recent["id_str"]])
+        due = engagement.get_due_posts(channel, timezone.now(), 100)
+        self.assertEqual([post_id for _, _, _, post_id, _, _ in due], [recent["id_str"], old["id_str"]])
+        # The old posts are never due
+        self.assertEqual(engagement.get_due_posts(channel, timezone.now() - datetime.timedelta(days=31), 100), [])
+
+    def test_cursor(self):
+        engagement.engagement_settings['batch_size'] = 1
+        old = self.add_app_post(minutes_ago=60)
+        recent = self.add_app_post()
+        old.update({"retweet_count": 1})
+        recent.update({"retweet_count": 2})
+        recent_published = AppPost.objects.get(id_in_channel=recent["id_str"]).datetime
+        # The pass ends with the old post, and the next one isn't due yet
+        for cursor, updated in ((recent_published, 1), (None, 1), (None, 0)):
+            self.assertEqual(engagement.refresh(max_lookups=1), updated)
+            self.assertEqual(Channel.objects.get(name="twitter").metrics_cursor, cursor)
+
+    def test_cursor_kept_on_failure(self):
+        engagement.engagement_settings['batch_size'] = 1
+        old = self.add_app_post(minutes_ago=60)
+        recent = self.add_app_post()
+        org_lookup_posts = Twitter.lookup_posts
+        lookups = []
+
+        def lookup_posts(post_ids):
+            lookups.append(post_ids)
+            if len(lookups) > 1:
+                raise tweepy.TweepError("Rate limit exceeded")
+            return org_lookup_posts(post_ids)
+        Twitter.lookup_posts = staticmethod(lookup_posts)
+        self.addCleanup(setattr, Twitter, 'lookup_posts', staticmethod(org_lookup_posts))
+        with self.assertRaises(tweepy.TweepError):
+            engagement.refresh(max_lookups=3)
+        # The next run goes on after the batch that was refreshed
+        self.assertEqual(lookups, [[recent["id_str"]], [old["id_str"]]])
+        self.assertEqual(Channel.objects.get(name="twitter").metrics_cursor,
+                         AppPost.objects.get(id_in_channel=recent["id_str"]).datetime)
+
+    def test_cursor_between_posts_published_together(self):
+        posts = [(datetime.datetime(2026, 1, 1, 10, minute), ) for minute in (3, 2, 2, 1)]
+        self.assertEqual(engagement.get_cursor(posts, 1, None), posts[0][0])
+        # The posts published at the time of the first post not refreshed are refreshed again in the next run
+        self.assertEqual(engagement.get_cursor(posts, 2, None), posts[0][0])
+        self.assertEqual(engagement.get_cursor(posts, 3, None), posts[2][0])
+        self.assertEqual(engagement.get_cursor(posts[1:], 1, None), None)
+
+
+class TestProfiles(TwitterTestCase):
+
+    def setUp(self):
+        super(TestProfiles, self).setUp()
+        self.org_settings = dict(profiles.profile_settings)
+        self.tester = Author.objects.create(name="Participa Tester", screen_name="participatester",
+                                            id_in_channel="2812345678", channel_id=1, friends=1, followers=1,
+                                            posts_count=1, description="Old description")
+
+    def tearDown(self):
+        profiles.profile_settings.update(self.org_settings)
+        super(TestProfiles, self).tearDown()
+
+    def test_refresh_changed_profiles(self):
+        # The profile of the author of the fixture is outdated too, and differs from the one of the tester
+        with self.assertNumQueries(8):
+            self.assertEqual(profiles.refresh(), 2)
+        tester = Author.objects.get(pk=self.tester.pk)
+        self.assertEqual((tester.friends, tester.followers, tester.posts_count, tester.description),
+                         (40, 8, 12, "Testing account"))
+        # All the authors were refreshed, so the next run starts over and finds nothing to write
+        self.assertEqual(Channel.objects.get(name="twitter").authors_cursor, 0)
+        with self.assertNumQueries(4):
+            self.assertEqual(profiles.refresh(), 0)
+
+    def test_cursor(self):
+        profiles.profile_settings['batch_size'] = 1
+        gone = Author.objects.create(name="Gone", screen_name="gone", id_in_channel="2899999999", channel_id=1)
+        first_pk = Author.objects.order_by('pk').values_list('pk', flat=True).first()
+        for cursor, updated in ((first_pk, 1), (self.tester.pk, 1), (gone.pk, 0), (0, 0)):
+            self.assertEqual(profiles.refresh(max_lookups=1), updated)
+            self.assertEqual(Channel.objects.get(name="twitter").authors_cursor, cursor)
+
+    def test_cursor_kept_on_failure(self):
+        profiles.profile_settings['batch_size'] = 1
+        first_pk = Author.objects.order_by('pk').values_list('pk', flat=True).first()
+        org_lookup_users = Twitter.lookup_users
+        lookups = []
+
+        def lookup_users(user_ids):
+            lookups.append(user_ids)
+            if len(lookups) > 1:
+                raise tweepy.TweepError("Rate limit exceeded")
+            return org_lookup_users(user_ids)
+        Twitter.lookup_users = staticmethod(lookup_users)
+        self.addCleanup(setattr, Twitter, 'lookup_users', staticmethod(org_lookup_users))
+        with self.assertRaises(tweepy.TweepError):
+            profiles.refresh(max_lookups=3)
+        # The next run goes on after the batch that was refreshed
+        self.assertEqual(Channel.objects.get(name="twitter").authors_cursor, first_pk)
+
+class TestPostsView(TestCase):
+    fixtures = ['cparte.json']
+
+    def setUp(self):
+        cache.clear()
+        self.org_settings = dict(pagination.pagination_settings)
+        pagination.pagination_settings['page_size'] = 2
+
+    def tearDown(self):
+        pagination.pagination_settings.update(self.org_settings)
+
+    def test_pages(self):
+        expected = list(ContributionPost.objects.order_by('-datetime', '-id').values_list('id', flat=True))
+        # The posts of the page, with their relations, and the total
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('cparte:posts'))
+        self.assertEqual([post.id for post in response.context['posts']], expected[:2])
+        self.assertEqual(response.context['total'], len(expected))
+        # The total is taken from the cache
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('cparte:posts') + response.context['next_url'])
+        self.assertEqual([post.id for post in response.context['posts']], expected[2:4])
+        self.assertEqual(response.context['next_url'], None)
+
+    def test_filters(self):
+        response = self.client.get(reverse('cparte:posts'), {'status': "PE", 'challenge': "4"})
+        self.assertEqual([post.id for post in response.context['posts']], [42])
+        self.assertEqual(response.context['total'], 1)
+        response = self.client.get(reverse('cparte:posts'), {'status': "DI"})
+        self.assertEqual(list(response.context['posts']), [])
+        response = self.client.get(reverse('cparte:posts'), {'cursor': "yesterday"})
+        self.assertEqual(response.status_code, 400)
+
+
+class TestExport(TestCase):
+    fixtures = ['cparte.json']
+
+    def test_rows_read_in_chunks(self):
+        with self.assertNumQueries(2):
+            rows = list(export.get_rows(chunk_size=2))
+        self.assertEqual([row['id'] for row in rows], [35, 42, 46])
+        self.assertEqual(rows[0]['author_screen_name'], "jorgesaldivar")
+        # Incremental exports
+        self.assertEqual([row['id'] for row in export.get_rows(since_id=35)], [42, 46])
+        since = export.parse_since("2014-09-15T00:00:00")
+        self.assertEqual([row['id'] for row in export.get_rows(since=since)], [42, 46])
+
+    def test_contributions_preserved_later(self):
+        since = timezone.now().replace(microsecond=0)
+        # A temporal contribution older than the ones already exported is preserved after the export
+        post = ContributionPost.objects.get(pk=35)
+        post.status = "TE"
+        post.save()
+        self.assertEqual([row['id'] for row in export.get_rows(since=since)], [])
+        post.preserve()
+        rows = list(export.get_rows(since=since, chunk_size=1))
+        self.assertEqual([row['id'] for row in rows], [35])
+        self.assertTrue(rows[0]['preserved_at'] >= since)
+
+    def test_export_view(self):
+        url = reverse('cparte:export')
+        self.assertEqual(self.client.get(url).status_code, 302)  # Only for the staff
+        User.objects.create_superuser("admin", "admin@participa.test", "admin")
+        self.client.login(username="admin", password="admin")
+        response = self.client.get(url, {'since_id': 35})
+        lines = "".join(response.streaming_content).splitlines()
+        self.assertEqual(lines[0].split(",")[:3], ["id", "id_in_channel", "datetime"])
+        self.assertEqual(len(lines), 3)
+        response = self.client.get(url, {'format': "jsonl"})
+        rows = [json.loads(line) for line in "".join(response.streaming_content).splitlines()]
+        self.assertEqual([row['id'] for row in rows], [35, 42, 46])
+        self.assertEqual(self.client.get(url, {'format': "xml"}).status_code, 400)
+
+    def test_export_command(self):
+        output = StringIO.StringIO()
+        call_command("export_contributions", format="jsonl", since="2014-09-16T00:00:00", stdout=output)
+        rows = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual([row['id'] for row in rows], [46])
+
+
+class TestAdminQueries(TestCase):
+    fixtures = ['cparte.json']
+
+    def setUp(self):
+        User.objects.create_superuser("admin", "admin@participa.test", "admin")
+        self.client.login(username="admin", password="admin")
+
+    def count_queries(self, model_name):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('admin:cparte_%s_changelist' % model_name))
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def add_author(self, i):
+        return Author.objects.create(name="Participant %s" % i, screen_name="participant%s" % i,
+                                     id_in_channel=str(2900000100 + i), channel_id=1, zipcode="9470%s" % i)
+
+    def add_rows(self, i):
+        author = self.add_author(i)
+        post = ContributionPost.objects.get(pk=35)
+        ContributionPost.objects.create(id_in_channel=str(700000000000000000 + i), datetime=post.datetime,
+                                        contribution="B", full_text="B #calrepcard", url=post.url, author=author,
+                                        initiative_id=1, campaign=post.campaign, challenge=post.challenge,
+                                        channel_id=1, status="PE")
+        SharePost.objects.create(id_in_channel=str(800000000000000000 + i), datetime=post.datetime, text="Shared",
+                                 url=post.url, author=author, initiative_id=1, campaign=post.campaign,
+                                 challenge=post.challenge, channel_id=1)
+        campaign = Campaign.objects.create(name="Campaign %s" % i, initiative_id=1)
+        campaign.messages.add(*Message.objects.all()[:2])
+        Challenge.objects.create(name="Challenge %s" % i, campaign=campaign, hashtag="challenge%s" % i,
+                                 style_answer="FR")
+        Channel.objects.create(name="channel%s" % i)
+
+    def test_changelist_queries_dont_grow_with_rows(self):
+        model_names = ("contributionpost", "sharepost", "campaign", "message", "challenge", "channel")
+        self.add_rows(0)
+        queries = dict((model_name, self.count_queries(model_name)) for model_name in model_names)
+        for i in range(1, 4):
+            self.add_rows(i)
+        for model_name in model_names:
+            self.assertEqual(self.count_queries(model_name), queries[model_name], model_name)
+
+
+    def test_delete_selected_posts(self):
+        rollups.rebuild()
+        geography.backfill()
+        search.rebuild()
+        self.assertTrue(SearchEntry.objects.filter(kind="CP", post_id=35).exists())
+        url = reverse('admin:cparte_contributionpost_changelist')
+        self.assertNotIn('delete_selected', self.client.get(url).context['action_form'].fields['action'].choices[1])
+        response = self.client.post(url, {'action': "delete_each", '_selected_action': [35, 42]})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(list(ContributionPost.objects.values_list('id', flat=True)), [46])
+        # The counts and the search index were updated with the posts
+        self.assertEqual(rollups.verify(), [])
+        self.assertEqual(geography.verify(), [])
+        self.assertFalse(SearchEntry.objects.filter(kind="CP", post_id__in=[35, 42]).exists())
+
+class TestApproximateCounts(TestCase):
+    fixtures = ['cparte.json']
+
+    def setUp(self):
+        User.objects.create_superuser("admin", "admin@participa.test", "admin")
+        self.client.login(username="admin", password="admin")
+        self.org_estimate_count = pagination.estimate_count
+        self.addCleanup(setattr, pagination, 'estimate_count', self.org_estimate_count)
+
+    def get_changelist(self, **params):
+        return self.client.get(reverse('admin:cparte_contributionpost_changelist'), params).context['cl']
+
+    def test_estimated_above_threshold(self):
+        pagination.estimate_count = lambda queryset: 2000000
+        with self.assertNumQueries(0):
+            self.assertEqual(pagination.approximate(ContributionPost.objects.all()).count(), 2000000)
+        changelist = self.get_changelist(challenge__id__exact=4)
+        self.assertEqual((changelist.result_count, changelist.full_result_count), (2000000, 2000000))
+        self.assertTrue(changelist.multi_page)
+
+    def test_counted_below_threshold(self):
+        pagination.estimate_count = lambda queryset: 10
+        changelist = self.get_changelist(challenge__id__exact=4)
+        self.assertEqual((changelist.result_count, changelist.full_result_count), (1, 3))
+        # The dbs that can't estimate counts always count
+        pagination.estimate_count = self.org_estimate_count
+        self.assertEqual(pagination.estimate_count(ContributionPost.objects.all()), None)
+        self.assertEqual(self.get_changelist().result_count, 3)
+
+
+# Offline tests. Posts are built by hand and the messages that the app would send are recorded instead of being
+# published, so neither the Twitter API nor its credentials are needed.
+class OfflineTwitterTestCase(TestCase):
+    fixtures = ['cparte.json']
+    url = "https://twitter.com/"
+    existing_author = {"id": "156641445", "name": "Jorge Saldivar", "screen_name": "jorgesaldivar"}
+    new_author = {"id": "2900000001", "name": "New Participant", "screen_name": "newparticipant"}
+    next_post_id = 600000000000000000
+
+    def setUp(self):
+        self.sent_messages = []
+        self.org_send_message = Twitter.__dict__['send_message']
+        Twitter.send_message = staticmethod(self.fake_send_message)
+        channel = Channel.objects.get(name="twitter")
+        session_info = channel_middleware.get_session_info([1])
+        channel.connect("", json.dumps(session_info))
+
+    def tearDown(self):
+        Twitter.send_message = self.org_send_message
+
+    def fake_send_message(self, message, type_msg, payload, recipient_id, channel_url):
+        post_id = self.get_next_post_id()
+        self.sent_messages.append({'text': message, 'type_msg': type_msg, 'recipient_id': recipient_id})
+        return {'delivered': True, 'response': {"id": post_id, "text": message,
+                                                "url": channel_url + "josaldev/status/" + post_id}}
+
+    def get_next_post_id(self):
+        OfflineTwitterTestCase.next_post_id += 1
+        return str(OfflineTwitterTestCase.next_post_id)
+
+    def build_post(self, text, author, parent_id=None, sharing_post=False, org_post=None):
+        post_id = self.get_next_post_id()
+        hashtags = [word[1:].lower() for word in text.split() if word.startswith("#")]
+        return {"id": post_id, "text": text, "parent_id": parent_id, "datetime": datetime.datetime(2014, 10, 1, 12, 0),
+                "url": self.url + author["screen_name"] + "/status/" + post_id, "votes": 0, "re_posts": 0,
+                "bookmarks": 0, "hashtags": hashtags, "source": "Twitter Web Client", "sharing_post": sharing_post,
+                "author": {"id": author["id"], "name": author["name"], "screen_name": author["screen_name"],
+                           "print_name": "@" + author["screen_name"], "url": self.url + author["screen_name"],
+                           "description": "", "language": "en", "posts_count": 10, "friends": 10,
+                           "followers": 10, "groups": 0},
+                "channel": "twitter", "org_post": org_post}
+
+    def get_last_app_post(self):
+        return AppPost.objects.order_by('-id').first()
+
+
+class TestQueryBudget(OfflineTwitterTestCase):
+    # The number of queries run by each conversation path is pinned here, a change in these numbers means that
+    # the pipeline started doing more (or less) work per post
+
+    def test_new_user_correct_answer_to_new_challenge(self):
+        post = self.build_post("B #obamacare #calrepcard", self.new_author)
+        with self.assertNumQueries(26):
+            output = channel_middleware.process_post(post, "twitter")
+        self.assertEqual(output.category, "request_author_extrainfo")
+
+    def test_new_user_incorrect_answer_to_new_challenge(self):
+        post = self.build_post("Excellent #obamacare #calrepcard", self.new_author)
+        with self.assertNumQueries(17):
+            output = channel_middleware.process_post(post, "twitter")
+        self.assertEqual(output.category, "incorrect_answer")
+
+    def test_existing_user_correct_answer_to_new_challenge(self):
+        post = self.build_post("A #obamacare #calrepcard", self.existing_author)
+        with self.assertNumQueries(32):
+            output = channel_middleware.process_post(post, "twitter")
+        self.assertEqual(output.category, "thanks_contribution")
+
+    def test_existing_user_correct_answer_to_previously_answered_challenge(self):
+        post = self.build_post("C #marijuanalaws #calrepcard", self.existing_author)
+        with self.assertNumQueries(23):
+            output = channel_middleware.process_post(post, "twitter")
+        self.assertEqual(output.category, "ask_change_contribution")
+
+    def test_existing_user_incorrect_answer_to_new_challenge(self):
+        post = self.build_post("Excellent #obamacare #calrepcard", self.existing_author)
+        with self.assertNumQueries(15):
+            output = channel_middleware.process_post(post, "twitter")
+        self.assertEqual(output.category, "incorrect_answer")
+
+    def test_new_user_free_answer(self):
+        post = self.build_post("Water supply #newissue #calrepcard", self.new_author)
+        with self.assertNumQueries(34):
+            output = channel_middleware.process_post(post, "twitter")
+        self.assertEqual(output.category, "thanks_contribution")
+
+    def test_reply_with_extra_info(self):
+        channel_middleware.process_post(self.build_post("B #obamacare #calrepcard", self.new_author), "twitter")
+        request_post = self.get_last_app_post()
+        post = self.build_post("@josaldev 94704", self.new_author, parent_id=request_post.id_in_channel)
+        with self.assertNumQueries(40):
+            output = channel_middleware.process_post(post, "twitter")
+        self.assertEqual(output.category, "thanks_contribution")
+
+    def test_reply_accepting_change(self):
+        channel_middleware.process_post(self.build_post("C #marijuanalaws #calrepcard", self.existing_author),
+                                        "twitter")
+        question_post = self.get_last_app_post()
+        post = self.build_post("@josaldev yes", self.existing_author, parent_id=question_post.id_in_channel)
+        with self.assertNumQueries(52):
+            output = channel_middleware.process_post(post, "twitter")
+        self.assertEqual(output.category, "thanks_change")
+
+    def test_reply_to_engagement_post(self):
+        post = self.build_post("@josaldev B", self.existing_author, parent_id="509053644746924032")
+        with self.assertNumQueries(23):
+            output = channel_middleware.process_post(post, "twitter")
+        self.assertEqual(output.category, "ask_change_contribution")
+
+    def test_sharing_post(self):
+        post = self.build_post("I graded California #obamacare #calrepcard", self.new_author, sharing_post=True)
+        with self.assertNumQueries(11):
+            output = channel_middleware.process_post(post, "twitter")
+        self.assertEqual(output, None)
+
+    def test_tracker_flags_post_over_budget(self):
+        post = self.build_post("A #obamacare #calrepcard", self.existing_author)
+        org_budget = dict(query_budget.budget)
+        query_budget.budget.update({'max_queries': 1, 'max_sql_time': None})
+        try:
+            with query_budget.QueryTracker("manage_post", post["id"], enabled=True) as tracker:
+                post_manager.manage_post(post)
+        finally:
+            query_budget.budget.update(org_budget)
+        self.assertTrue(tracker.num_queries > 1)
+        self.assertTrue(tracker.over_budget)
+
+
+class TestWriteBehind(OfflineTwitterTestCase):
+
+    def setUp(self):
+        super(TestWriteBehind, self).setUp()
+        self.org_settings = dict(write_behind.writer_settings)
+        write_behind.writer_settings['enabled'] = True
+        # The buffer is written by the tests, the flusher thread doesn't see the testing db
+        write_behind.buffer = write_behind.WriteBuffer(max_rows=10, max_delay=3600)
+        self.other_author = {"id": "2900000002", "name": "Other Participant", "screen_name": "otherparticipant"}
+        Initiative.objects.filter(pk=1).update(social_sharing_message="I graded California #calrepcard")
+
+    def tearDown(self):
+        write_behind.buffer.stop()
+        write_behind.buffer = None
+        write_behind.writer_settings.update(self.org_settings)
+        super(TestWriteBehind, self).tearDown()
+
+    def share(self, author):
+        post = self.build_post("I graded California #obamacare #calrepcard", author, sharing_post=True)
+        channel_middleware.process_post(post, "twitter")
+        return post
+
+    def test_rows_written_in_batch(self):
+        first = self.share(self.new_author)
+        second = self.share(self.other_author)
+        self.assertEqual(write_behind.buffer.size(), 4)
+        self.assertFalse(SharePost.objects.filter(id_in_channel__in=[first["id"], second["id"]]).exists())
+        with self.assertNumQueries(11):
+            self.assertEqual(write_behind.flush(), 4)
+        share_post = SharePost.objects.get(id_in_channel=second["id"])
+        self.assertEqual(share_post.author.id_in_channel, self.other_author["id"])
+        self.assertEqual(write_behind.buffer.size(), 0)
+
+    def test_conflicts_skipped(self):
+        post = self.share(self.new_author)
+        # Delivered twice, by the stream and by the backfill. Its author is read, so the first delivery is written
+        channel_middleware.process_post(post, "twitter")
+        self.assertEqual(write_behind.buffer.size(), 1)
+        write_behind.flush()
+        self.assertEqual(SharePost.objects.filter(id_in_channel=post["id"]).count(), 1)
+        self.assertEqual(write_behind.buffer.conflicts, 1)
+
+    def test_read_your_writes(self):
+        share_post = self.share(self.new_author)
+        # The author of the buffered share post answers the challenge, which needs the author in the db
+        output = channel_middleware.process_post(self.build_post("B #obamacare #calrepcard", self.new_author),
+                                                 "twitter")
+        self.assertEqual(output.category, "request_author_extrainfo")
+        self.assertEqual(Author.objects.filter(id_in_channel=self.new_author["id"]).count(), 1)
+        self.assertEqual(write_behind.buffer.size(), 0)
+        # Replies to buffered posts find them
+        self.share(self.other_author)
+        reply = self.build_post("@josaldev A", self.other_author, parent_id=share_post["id"])
+        self.assertEqual(channel_middleware.process_post(reply, "twitter").category, "request_author_extrainfo")
+
+    def test_written_when_full(self):
+        write_behind.buffer.max_rows = 2
+        post = self.share(self.new_author)
+        self.assertEqual(write_behind.buffer.size(), 0)
+        self.assertTrue(SharePost.objects.filter(id_in_channel=post["id"]).exists())
+
+
+class TestRollups(OfflineTwitterTestCase):
+
+    def setUp(self):
+        super(TestRollups, self).setUp()
+        # The contributions of the fixture are loaded without counting them
+        rollups.rebuild()
+
+    def get_statuses(self, challenge_id):
+        return rollups.get_summary([challenge_id])[challenge_id]['statuses']
+
+    def test_counted_with_the_conversation(self):
+        channel_middleware.process_post(self.build_post("A #obamacare #calrepcard", self.existing_author), "twitter")
+        summary = rollups.get_summary([1])[1]
+        self.assertEqual(summary['statuses'], {'PE': 1})
+        self.assertEqual(summary['sources'], {'Twitter Web Client': 1})
+        self.assertEqual(sum(summary['days'].values()), 1)
+        # The author replaces the contribution of the fixture, the new one is temporal until it is accepted
+        channel_middleware.process_post(self.build_post("C #marijuanalaws #calrepcard", self.existing_author),
+                                        "twitter")
+        self.assertEqual(self.get_statuses(6), {'PE': 1, 'TE': 1})
+        question_post = self.get_last_app_post()
+        channel_middleware.process_post(self.build_post("@josaldev yes", self.existing_author,
+                                                        parent_id=question_post.id_in_channel), "twitter")
+        self.assertEqual(self.get_statuses(6), {'PE': 1, 'TE': 0, 'DI': 1})
+        self.assertEqual(rollups.verify(), [])
+        ContributionPost.objects.get(pk=35).delete()
+        self.assertEqual(self.get_statuses(6), {'PE': 1, 'TE': 0, 'DI': 0})
+        self.assertEqual(rollups.verify(), [])
+
+    def test_rebuild(self):
+        self.assertEqual(self.get_statuses(4), {'PE': 1})
+        ContributionCount.objects.filter(challenge=4).update(count=5)
+        ContributionPost.objects.filter(pk=46).update(status="DI")
+        differences = rollups.verify()
+        self.assertEqual([(key[:2], stored, counted) for key, stored, counted in differences],
+                         [((2, "DI"), 0, 1), ((2, "PE"), 1, 0), ((4, "PE"), 5, 1)])
+        output = StringIO.StringIO()
+        call_command('rebuild_rollups', verify=True, stdout=output)
+        self.assertIn("3 counts differ", output.getvalue())
+        self.assertEqual(self.get_statuses(4), {'PE': 5})
+        call_command('rebuild_rollups', stdout=output)
+        self.assertEqual(rollups.verify(), [])
+        self.assertEqual(self.get_statuses(4), {'PE': 1})
+        self.assertEqual(self.get_statuses(2), {'DI': 1})
+
+    def test_stats_view(self):
+        with self.assertNumQueries(4):
+            response = self.client.get(reverse('cparte:stats'), {'campaign': 1})
+        content = json.loads(response.content)
+        self.assertEqual(len(content), 6)
+        self.assertEqual(content["6"], {'statuses': {'PE': 1}, 'sources': {'': 1}, 'days': {'2014-09-12': 1}})
+        self.assertEqual(content["1"], rollups.new_summary())
+        self.assertEqual(self.client.get(reverse('cparte:stats'), {'challenge': "x"}).status_code, 400)
+
+
+class TestGeography(OfflineTwitterTestCase):
+
+    def setUp(self):
+        super(TestGeography, self).setUp()
+        # The contributions of the fixture are loaded without counting them
+        geography.backfill()
+
+    def get_zipcodes(self, challenge_id):
+        return geography.get_counts([challenge_id]).get(challenge_id, {})
+
+    def test_counted_when_preserved(self):
+        self.assertEqual(self.get_zipcodes(6), {"94702": 1})
+        # The contribution of the new author is temporal until the author gives the zipcode
+        channel_middleware.process_post(self.build_post("B #obamacare #calrepcard", self.new_author), "twitter")
+        self.assertEqual(self.get_zipcodes(1), {})
+        request_post = self.get_last_app_post()
+        channel_middleware.process_post(self.build_post("@josaldev 94704", self.new_author,
+                                                        parent_id=request_post.id_in_channel), "twitter")
+        self.assertEqual(self.get_zipcodes(1), {"94704": 1})
+        # The change of a contribution keeps the count of the zipcode
+        channel_middleware.process_post(self.build_post("C #marijuanalaws #calrepcard", self.existing_author),
+                                        "twitter")
+        question_post = self.get_last_app_post()
+        channel_middleware.process_post(self.build_post("@josaldev yes", self.existing_author,
+                                                        parent_id=question_post.id_in_channel), "twitter")
+        self.assertEqual(self.get_zipcodes(6), {"94702": 1})
+        self.assertEqual(geography.verify(), [])
+
+    def test_discarded_after_the_author_moves(self):
+        Author.objects.filter(pk=20).update(zipcode="94704")
+        self.assertEqual(geography.verify(), [])
+        ContributionPost.objects.get(pk=35).discard()
+        self.assertEqual(self.get_zipcodes(6), {})
+        self.assertEqual(geography.get_counts([2]), {2: {"94702": 1}})
+        ContributionPost.objects.get(pk=35).preserve()
+        self.assertEqual(self.get_zipcodes(6), {"94704": 1})
+        self.assertEqual(geography.verify(), [])
+
+    def test_backfill(self):
+        ZipcodeCount.objects.all().delete()
+        # The contributions are counted where they were preserved, not where their author lives now
+        Author.objects.filter(pk=20).update(zipcode=None)
+        output = StringIO.StringIO()
+        call_command('backfill_zipcode_counts', verify=True, stdout=output)
+        self.assertIn("3 counts differ", output.getvalue())
+        call_command('backfill_zipcode_counts', chunk_size=2, stdout=output)
+        self.assertEqual(geography.get_counts(), {2: {"94702": 1}, 4: {"94702": 1}, 6: {"94702": 1}})
+        self.assertEqual(geography.verify(), [])
+
+    def test_zipcodes_view(self):
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('cparte:zipcodes'), {'campaign': 1})
+        content = json.loads(response.content)
+        self.assertEqual(content["4"], {"94702": 1})
+        self.assertEqual(content["1"], {})
+        self.assertEqual(self.client.get(reverse('cparte:zipcodes'), {'campaign': "x"}).status_code, 400)
+
+
+class TestDuplicates(OfflineTwitterTestCase):
+
+    def setUp(self):
+        super(TestDuplicates, self).setUp()
+        self.org_settings = dict(duplicates.duplicate_settings)
+        duplicates.duplicate_settings['index_dir'] = tempfile.mkdtemp()
+        duplicates.indexes.clear()
+
+    def tearDown(self):
+        shutil.rmtree(duplicates.duplicate_settings['index_dir'])
+        duplicates.duplicate_settings.update(self.org_settings)
+        duplicates.indexes.clear()
+        super(TestDuplicates, self).tearDown()
+
+    def propose(self, text, author):
+        channel_middleware.process_post(self.build_post(text + " #newissue #calrepcard", author), "twitter")
+        return ContributionPost.objects.order_by('-id').first()
+
+    def test_signatures(self):
+        signature = duplicates.get_signature("Water supply in the Central Valley is running out")
+        edited = duplicates.get_signature("water supply in the central valley is running out!!")
+        other = duplicates.get_signature("Fix the roads of Los Angeles before the next winter")
+        self.assertEqual(numpy.mean(signature == edited), 1.0)
+        self.assertLess(numpy.mean(signature == other), 0.2)
+        lightly_edited = duplicates.get_signature("Water supply in the Central Valley is running out fast")
+        self.assertGreater(numpy.mean(signature == lightly_edited), duplicates.duplicate_settings['threshold'])
+
+    def test_clusters_updated_as_posts_arrive(self):
+        first = self.propose("Water supply in the Central Valley is running out", self.existing_author)
+        other = self.propose("Fix the roads of Los Angeles before the next winter", self.existing_author)
+        copy = self.propose("water supply in the central valley is running out!!", self.new_author)
+        index = duplicates.get_index(3)
+        self.assertEqual(index.get_clusters(), [[first.id, copy.id]])
+        self.assertEqual((index.cluster_size(first.id), index.cluster_size(other.id)), (2, 1))
+        # Another process loads the index from the file
+        duplicates.indexes.clear()
+        model_admin = admin.site._registry[ContributionPost]
+        self.assertEqual(model_admin.near_duplicates(first), 2)
+        self.assertEqual(model_admin.near_duplicates(ContributionPost.objects.get(pk=35)), "-")
+        # The index is rebuilt from the contributions
+        output = StringIO.StringIO()
+        call_command('index_duplicates', challenge=3, chunk_size=2, stdout=output)
+        self.assertIn("Challenge 3: 3 contributions, 1 clusters of near-duplicates", output.getvalue())
+        self.assertEqual(duplicates.get_index(3).get_clusters(), [[first.id, copy.id]])
+
+    def test_only_permanent_contributions(self):
+        first = self.propose("Water supply in the Central Valley is running out", self.existing_author)
+        copy = self.propose("water supply in the central valley is running out!!", self.new_author)
+        # Another process keeps the index loaded
+        loaded = duplicates.get_index(3)
+        self.assertEqual(loaded.get_clusters(), [[first.id, copy.id]])
+        copy.status = "TE"
+        copy.save()
+        self.assertEqual(duplicates.get_index(3).cluster_size(first.id), 1)
+        copy.preserve()
+        self.assertEqual(duplicates.get_index(3).get_clusters(), [[first.id, copy.id]])
+        copy.discard()
+        # The rebuilt index replaces the file, which the other process notices
+        duplicates.indexes.clear()
+        other = self.propose("Fix the roads of Los Angeles before the next winter", self.existing_author)
+        self.assertEqual(sorted(duplicates.rebuild(ContributionPost.objects.get(pk=first.id).challenge).signatures),
+                         [first.id, other.id])
+        loaded.refresh()
+        self.assertEqual(sorted(loaded.signatures), [first.id, other.id])
+        self.assertEqual(loaded.get_clusters(), [])
+
+    def test_remove_joins_cluster_again(self):
+        index = duplicates.DuplicateIndex(3)
+        # The second post is similar to the first and the third, which aren't similar to each other
+        index.add(1, numpy.array([0] * 128, dtype=numpy.int64))
+        index.add(2, numpy.array([0] * 80 + [1] * 48, dtype=numpy.int64))
+        index.add(3, numpy.array([2] * 48 + [0] * 32 + [1] * 48, dtype=numpy.int64))
+        index.add(4, numpy.array([0] * 128, dtype=numpy.int64))
+        index.add(5, numpy.array([3] * 128, dtype=numpy.int64))
+        self.assertEqual(index.get_clusters(min_size=1), [[1, 2, 3, 4], [5]])
+        index.remove(4)
+        self.assertEqual(index.get_clusters(min_size=1), [[1, 2, 3], [5]])
+        index.remove(2)
+        self.assertEqual(index.get_clusters(min_size=1), [[1], [3], [5]])
+        self.assertEqual((index.cluster_size(1), index.cluster_size(2)), (1, 0))
+        self.assertEqual(sorted(set(post_id for bucket in index.buckets.values() for post_id in bucket)), [1, 3, 5])
+
+    def test_unreadable_index(self):
+        first = self.propose("Water supply in the Central Valley is running out", self.existing_author)
+        with open(duplicates.get_index(3).path, "a") as index_file:
+            index_file.write("x\n")
+        duplicates.indexes.clear()
+        # The contribution is saved, and the error logged, even if the index can't be loaded
+        copy = self.propose("water supply in the central valley is running out!!", self.new_author)
+        self.assertEqual(copy.status, "PE")
+        self.assertNotEqual(copy.id, first.id)
+
+
+class TestSearch(TestCase):
+    fixtures = ['cparte.json']
+
+    def setUp(self):
+        cache.clear()
+        # The posts of the fixture are loaded without indexing them
+        search.rebuild()
+
+    def contribute(self, full_text):
+        post = ContributionPost.objects.get(pk=42)
+        post.pk = None
+        post.counted_in = None
+        post.full_text = full_text
+        post.save()
+        return post
+
+    def share(self, text):
+        post = SharePost(id_in_channel="700000000000000001", datetime=timezone.now(), text=text,
+                         url="https://twitter.com/jorgesaldivar/status/700000000000000001", author_id=20,
+                         initiative_id=1, campaign_id=1, challenge_id=4, channel_id=1)
+        post.save()
+        return post
+
+    def get_ids(self, query, kinds=None):
+        return [(kind, post_id) for kind, post_id, _ in search.search(query, kinds)]
+
+    def test_ranked_results(self):
+        self.assertEqual(self.get_ids("#calrepcard"), [("CP", 42), ("CP", 35)])
+        self.assertEqual(self.get_ids("calrepcard MARIJUANALAWS"), [("CP", 35)])
+        self.assertEqual(self.get_ids("unknown calrepcard"), [])
+        self.assertEqual(self.get_ids("#"), [])
+        once = self.contribute("The water supply of California #calrepcard C")
+        twice = self.contribute("Water, water everywhere, but the supply is short #calrepcard D")
+        shared = self.share("I graded the water supply of California #calrepcard")
+        # The posts where the terms occur more come first, the ties the most recent first
+        self.assertEqual(self.get_ids("water supply"), [("CP", twice.pk), ("CP", once.pk), ("SP", shared.pk)])
+        self.assertEqual(self.get_ids("water supply", [search.SHARES]), [("SP", shared.pk)])
+        cache.clear()
+        self.assertEqual(search.get_document_frequencies(["calrepcard", "water"]), {"calrepcard": 5, "water": 3})
+
+    def test_status_changes(self):
+        post = self.contribute("Tuition keeps rising #affordcollege #calrepcard D")
+        self.assertEqual(self.get_ids("tuition"), [("CP", post.pk)])
+        post.discard()
+        self.assertEqual(self.get_ids("tuition"), [])
+        post.preserve()
+        self.assertEqual(self.get_ids("tuition"), [("CP", post.pk)])
+        post.delete()
+        self.assertEqual(SearchEntry.objects.filter(post_id=post.pk, kind="CP").count(), 0)
+
+    def test_view_and_admin(self):
+        self.contribute("The water supply of California #calrepcard C")
+        content = json.loads(self.client.get(reverse('cparte:search'), {'q': "water", 'kind': "contributions"}).content)
+        self.assertEqual([(result['kind'], result['text']) for result in content['results']],
+                         [("contribution", "The water supply of California #calrepcard C")])
+        self.assertEqual(self.client.get(reverse('cparte:search'), {'q': "water", 'kind': "x"}).status_code, 400)
+        User.objects.create_superuser("admin", "admin@participa.test", "admin")
+        self.client.login(username="admin", password="admin")
+        response = self.client.get(reverse('admin:cparte_contributionpost_changelist'), {'q': "water"})
+        self.assertEqual(response.context['cl'].result_count, 1)
+        # The admin lists all the posts that contain the terms, beyond the results of the search of the app
+        self.contribute("Water, water everywhere, but the supply is short #calrepcard D")
+        self.addCleanup(search.search_settings.update, {'max_results': search.search_settings['max_results']})
+        search.search_settings['max_results'] = 1
+        response = self.client.get(reverse('admin:cparte_contributionpost_changelist'), {'q': "water supply"})
+        self.assertEqual(response.context['cl'].result_count, 2)
+        self.assertEqual(self.client.get(reverse('admin:cparte_contributionpost_changelist'),
+                                         {'q': "#"}).context['cl'].result_count, 0)
+        output = StringIO.StringIO()
+        call_command('rebuild_search_index', chunk_size=2, stdout=output)
+        self.assertIn("5 posts were indexed", output.getvalue())
+
+
+class TestTally(TestCase):
+    fixtures = ['cparte.json']
+
+    def setUp(self):
+        cache.clear()
+        rollups.rebuild()
+
+    def contribute(self, answer, day):
+        post = ContributionPost.objects.get(pk=42)
+        post.pk = None
+        post.counted_in = None
+        post.contribution = answer
+        post.datetime = timezone.make_aware(datetime.datetime(2014, 9, day, 10, 0), timezone.utc)
+        post.save()
+        return post
+
+    def test_distribution(self):
+        for answer, day in (("b", 15), ("B ", 16), ("a", 16)):
+            self.contribute(answer, day)
+        content = tally.get_tally(4).to_dict()
+        self.assertEqual(content['total'], 4)
+        self.assertEqual(content['answers'], [{'answer': "B", 'count': 2, 'percentage': 50.0},
+                                              {'answer': "A", 'count': 1, 'percentage': 25.0},
+                                              {'answer': "E-", 'count': 1, 'percentage': 25.0}])
+        self.assertEqual(content['trend'], [{'start': "2014-09-15T00:00:00", 'counts': {"E-": 1, "B": 1}},
+                                            {'start': "2014-09-16T00:00:00", 'counts': {"B": 1, "A": 1}}])
+
+    def test_refresh_reads_new_contributions(self):
+        self.assertEqual(tally.get_tally(4).total(), 1)
+        post = self.contribute("C", 17)
+        # The challenge, the revision of the permanent contributions and the contributions after the cached tally
+        with self.assertNumQueries(3):
+            refreshed = tally.get_tally(4)
+        self.assertEqual((refreshed.total(), refreshed.last_id), (2, post.pk))
+        # The older contribution is discarded, so the tally is computed again
+        ContributionPost.objects.get(pk=42).discard()
+        self.assertEqual(tally.get_tally(4).to_dict()['answers'], [{'answer': "C", 'count': 1, 'percentage': 100.0}])
+
+    def test_refresh_after_preserve_and_discard(self):
+        temporal = self.contribute("D", 17)
+        temporal.status = "TE"
+        temporal.save()
+        self.contribute("C", 18)
+        self.assertEqual(tally.get_tally(4).total(), 2)
+        # One older contribution is preserved and another one discarded, so the total stays the same
+        temporal.preserve()
+        ContributionPost.objects.get(pk=42).discard()
+        refreshed = tally.get_tally(4)
+        self.assertEqual(refreshed.total(), 2)
+        self.assertEqual(sorted(answer['answer'] for answer in refreshed.to_dict()['answers']), ["C", "D"])
+
+    def test_view(self):
+        response = self.client.get(reverse('cparte:tally', args=[4]))
+        self.assertEqual(json.loads(response.content)['answers'][0]['answer'], "E-")
+        # Challenges with free answers aren't tallied
+        self.assertEqual(self.client.get(reverse('cparte:tally', args=[3])).status_code, 400)
+        self.assertEqual(self.client.get(reverse('cparte:tally', args=[999])).status_code, 404)
+
+
+class TestFeed(TestCase):
+    fixtures = ['cparte.json']
+
+    def setUp(self):
+        self.org_settings = dict(feed.feed_settings)
+        # The events are sent and received through an in-memory broker, which works within the process
+        feed.feed_settings.update({'heartbeat': 0.05, 'max_duration': 0.3, 'broker_url': "memory://"})
+        feed.local_feed = feed.Feed(size=10)
+        feed.stop_threads()
+        self.assertTrue(feed.get_relay().ready.wait(5))
+
+    def tearDown(self):
+        feed.stop_threads()
+        feed.local_feed = feed.Feed()
+        feed.feed_settings.update(self.org_settings)
+
+    def wait_events(self, number):
+        deadline = time.time() + 5
+        events = []
+        while len(events) < number and time.time() < deadline:
+            events = feed.local_feed.wait(0, 0.1)
+        return events
+
+    def read_stream(self, **params):
+        headers = {}
+        if 'last_event_id' in params:
+            headers['HTTP_LAST_EVENT_ID'] = params.pop('last_event_id')
+        response = self.client.get(reverse('cparte:feed'), params, **headers)
+        self.assertEqual(response['Content-Type'], "text/event-stream")
+        return "".join(response.streaming_content)
+
+    def test_positions(self):
+        events = feed.Feed(size=2)
+        for event_id in ("a", "b", "c"):
+            events.publish(event_id, "counts", {})
+        self.assertEqual(events.get_position(), 3)
+        self.assertEqual(events.get_position("b"), 2)
+        # The event "a" is no longer kept, all the kept ones are sent
+        self.assertEqual([event[1] for event in events.wait(events.get_position("a"), 0)], ["b", "c"])
+        self.assertEqual(events.wait(3, 0.01), [])
+
+    def test_send_never_waits(self):
+        publisher = feed.Publisher(size=1)
+        publisher.send([("counts", {'challenge': 4})])
+        # The queue is full, the events are dropped instead of waiting for the broker
+        publisher.send([("counts", {'challenge': 6})])
+        self.assertEqual(publisher.events.get_nowait(), [("counts", {'challenge': 4})])
+        self.assertTrue(publisher.events.empty())
+
+    def test_preserved_contributions_streamed(self):
+        post = ContributionPost.objects.get(pk=42)
+        post.pk = None
+        post.counted_in = None
+        post.status = "TE"
+        post.save()
+        self.assertEqual(feed.local_feed.wait(0, 0.2), [])
+        post.preserve()
+        events = self.wait_events(2)
+        self.assertEqual([(event_type, data['challenge']) for _, _, event_type, data in events],
+                         [("contribution", 4), ("counts", 4)])
+        self.assertEqual(events[0][3]['id'], post.id)
+        self.assertEqual(events[1][3]['statuses'], {"PE": 1, "TE": 0})
+        # The dashboard that reconnects gets only the events after the last one it received
+        content = self.read_stream(last_event_id=events[0][1])
+        self.assertTrue(content.startswith("retry: 3000\n\n"))
+        self.assertNotIn("event: contribution", content)
+        self.assertIn("id: %s\nevent: counts\n" % events[1][1], content)
+        self.assertIn(": keepalive", self.read_stream())
+        self.assertNotIn("event:", self.read_stream(challenge=6, last_event_id="unknown"))
+
+
+class TestBenchmark(TestCase):
+    fixtures = ['cparte.json']
+
+    def test_generator_is_reproducible(self):
+        first = [post["text"] for post in itertools.islice(benchmark.TweetGenerator([1], seed=7), 50)]
+        second = [post["text"] for post in itertools.islice(benchmark.TweetGenerator([1], seed=7), 50)]
+        self.assertEqual(first, second)
+
+    def test_run(self):
+        results = benchmark.run(50, [1], seed=7)
+        self.assertEqual(results['posts'], 50)
+        self.assertEqual(sum(results['outcomes'].values()), 50)
+        self.assertTrue(results['queries_per_post']['max'] > 0)
+
+
+class TestStreamReader(TestCase):
+
+    def build_stream(self, messages):
+        stream = "\r\n"  # Keep-alive
+        for message in messages:
+            payload = json.dumps(message) + "\r\n"
+            stream += "%s\r\n%s" % (len(payload), payload)
+        return stream
+
+    def test_frames_split_across_chunks(self):
+        messages = [{"id": i, "text": "Message #%s" % i} for i in range(20)]
+        stream = self.build_stream(messages)
+        for gzipped in (False, True):
+            if gzipped:
+                compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+                stream = compressor.compress(stream) + compressor.flush()
+            reader = stream_reader.FrameReader(gzipped)
+            received = []
+            keep_alives = 0
+            for start in range(0, len(stream), 7):
+                frames, num_keep_alives = reader.feed(stream[start:start + 7])
+                received += [json.loads(frame) for frame in frames]
+                keep_alives += num_keep_alives
+            self.assertEqual(received, messages)
+            self.assertEqual(keep_alives, 1)
+            self.assertEqual(reader.received, len(stream))
+
+    def test_unexpected_content(self):
+        with self.assertRaises(ValueError):
+            stream_reader.FrameReader().feed("{\"id\": 1}\r\n")
+
+
+class TestStreamHealth(TestCase):
+    fixtures = ['cparte.json']
+
+    def setUp(self):
+        self.partition = partitioning.assign(Channel.objects.get(name="twitter"), [1])[0]
+        self.health = stream_health.StreamHealth(self.partition.id, self.partition.channel_id, flush_interval=10,
+                                                 check_interval=1, stall_timeout=90)
+        self.start = self.health.last_flush
+
+    def test_flush(self):
+        created_at = datetime.datetime.utcnow() - datetime.timedelta(seconds=30)
+        for _ in range(5):
+            self.health.record_message(created_at)
+        self.health.record_limit(3)
+        self.health.record_stall_warning(80)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.health.check(self.start + 5), None)
+        with self.assertNumQueries(2):
+            self.health.check(self.start + 10)
+        partition = StreamPartition.objects.get(pk=self.partition.id)
+        self.assertEqual(partition.message_rate, 30.0)
+        self.assertTrue(partition.stream_lag >= 30)
+        self.assertEqual(partition.undelivered_msgs, 3)
+        self.assertEqual(partition.percent_full, 80)
+        self.assertFalse(partition.stalled)
+        self.assertNotEqual(Channel.objects.get(name="twitter").last_message, None)
+        # The time of the last message of the channel is written only when it changes
+        with self.assertNumQueries(1):
+            self.health.check(self.start + 20)
+
+    def test_stall(self):
+        self.health.record_keep_alive()
+        last_activity = self.health.last_activity
+        self.health.check(last_activity + 89)
+        self.assertFalse(StreamPartition.objects.get(pk=self.partition.id).stalled)
+        self.health.check(last_activity + 91)
+        self.assertTrue(StreamPartition.objects.get(pk=self.partition.id).stalled)
+        self.health.record_keep_alive()
+        self.health.check()
+        self.assertFalse(StreamPartition.objects.get(pk=self.partition.id).stalled)
+
+
+class TestRecovery(TestCase):
+    fixtures = ['cparte.json']
+
+    def test_backoff(self):
+        network = recovery.Backoff(0.25, 16, linear=True)
+        self.assertEqual([network.next() for _ in range(4)], [0.25, 0.5, 0.75, 1.0])
+        self.assertEqual([network.next() for _ in range(100)][-1], 16)
+        http = recovery.Backoff(5, 320)
+        self.assertEqual([http.next() for _ in range(8)], [5, 10, 20, 40, 80, 160, 320, 320])
+        http.reset()
+        self.assertEqual(http.next(), 5)
+        self.assertEqual(recovery.get_error_class(420), recovery.RATE_LIMIT)
+        self.assertEqual(recovery.get_error_class(503), recovery.HTTP)
+        self.assertEqual(recovery.get_error_class(), recovery.NETWORK)
+
+    def test_reconnection_without_backfill(self):
+        partition = partitioning.assign(Channel.objects.get(name="twitter"), [1])[0]
+        controller = recovery.RecoveryController(partition.id)
+        controller.backoffs[recovery.NETWORK] = recovery.Backoff(0.01, 0.01, linear=True)
+        self.assertTrue(controller.on_failure(recovery.NETWORK, "Connection reset."))
+        controller.failed_at -= 60
+        controller.message_rate = 10.0
+        self.assertEqual(controller.on_connect(), 10)
+        self.assertEqual(controller.on_connect(), None)
+        partition = StreamPartition.objects.get(pk=partition.id)
+        self.assertEqual(partition.reconnections, 1)
+        self.assertEqual(partition.missed_msgs, 10)
+        self.assertTrue(partition.last_reconnect_time >= 60)
+        controller.stop()
+        self.assertFalse(controller.on_failure(recovery.NETWORK))
+
+    def test_overlapping_streams(self):
+        controller = recovery.RecoveryController(None)
+        controller.start_overlap()
+        self.assertFalse(controller.already_processed("1"))
+        self.assertTrue(controller.already_processed("1"))
+        controller.end_overlap()
+        # The posts delivered during the overlap are still recognized after it
+        self.assertTrue(controller.already_processed("1"))
+        self.assertFalse(controller.already_processed("2"))
+        self.assertFalse(controller.already_processed("2"))
+
+    def test_backfill_in_background(self):
+        controller = recovery.RecoveryController(None)
+        controller.checkpoint = "1"
+        controller.failed_at = time.time() - 2
+        searching = threading.Event()
+        controller.on_connect(lambda since_id: searching.wait(5) and 3, background=True)
+        # The reader of the stream isn't kept waiting while the missed posts are searched
+        self.assertTrue(controller.backfiller.is_alive())
+        self.assertEqual(controller.reconnections, 1)
+        searching.set()
+        controller.backfiller.join(5)
+        self.assertEqual(controller.missed, 3)
+
+    def test_stream_ahead_of_backfill(self):
+        controller = recovery.RecoveryController(None)
+        controller.checkpoint = "1"
+        controller.failed_at = time.time() - 2
+        streamed = threading.Event()
+        processed = []
+
+        def backfill(since_id):
+            streamed.wait(5)
+            for post_id in ("2", "3"):
+                if controller.claim_backfilled(post_id):
+                    processed.append(post_id)
+            return 2
+
+        controller.on_connect(backfill, background=True)
+        # The reconnected stream delivers a post before the search returns it
+        self.assertFalse(controller.already_processed("3"))
+        streamed.set()
+        controller.backfiller.join(5)
+        self.assertEqual(processed, ["2"])
+        self.assertTrue(controller.already_processed("2"))
+        self.assertEqual(controller.streamed_ids, set())
+        self.assertFalse(controller.already_processed("4"))
+
+    def test_backfilled_ids_capped(self):
+        controller = recovery.RecoveryController(None)
+        org_max_backfill = recovery.recovery_settings['max_backfill']
+        recovery.recovery_settings['max_backfill'] = 2
+        self.addCleanup(recovery.recovery_settings.update, {'max_backfill': org_max_backfill})
+        for post_id in ("1", "2", "3"):
+            self.assertTrue(controller.claim_backfilled(post_id))
+        self.assertEqual(list(controller.backfilled_ids), ["2", "3"])
+        self.assertTrue(controller.already_processed("3"))
+        self.assertFalse(controller.already_processed("1"))
+
+    def test_auto_recovery_reuses_session(self):
+        channel = Channel.objects.get(name="twitter")
+        session_info = channel_middleware.get_session_info([1])
+        channel.connect("", json.dumps(session_info))
+        org_connect, org_disconnect = channel_middleware.connect, channel_middleware.disconnect
+        calls = []
+        channel_middleware.connect = lambda *args, **kwargs: calls.append((args, kwargs))
+        channel_middleware.disconnect = lambda channel_name: None
+        try:
+            channel_middleware.auto_recovery("Twitter")
+        finally:
+            channel_middleware.connect, channel_middleware.disconnect = org_connect, org_disconnect
+        self.assertEqual(calls, [(([1], "twitter", session_info), {'keep_checkpoint': True})])
+
+
+class TestSubscriptions(TestCase):
+    fixtures = ['cparte.json']
+
+    def setUp(self):
+        self.channel = Channel.objects.get(name="twitter")
+        self.partition = partitioning.assign(self.channel, [1])[0]
+        self.channel.connect("", json.dumps(channel_middleware.get_session_info([1])))
+        self.scheduled = []
+        self.org_apply_async = tasks.update_subscriptions.apply_async
+        tasks.update_subscriptions.apply_async = lambda args, countdown: self.scheduled.append(args)
+
+    def tearDown(self):
+        tasks.update_subscriptions.apply_async = self.org_apply_async
+
+    def test_session_info(self):
+        with self.assertNumQueries(3):
+            session_info = channel_middleware.get_session_info([1])
+        self.assertEqual(session_info["accounts"], ["2733258272"])
+        self.assertEqual(session_info["hashtags"][:2], ["calrepcard", "obamacare"])
+        self.assertEqual(len(session_info["hashtags"]), 8)
+        with self.assertRaises(Exception):
+            channel_middleware.get_session_info([1, 999])
+
+    def test_changes_are_coalesced(self):
+        challenge = Challenge.objects.create(name="New challenge", campaign_id=1, hashtag="newchallenge",
+                                             style_answer="FR")
+        challenge.hashtag = "newerchallenge"
+        challenge.save()
+        self.assertEqual(self.scheduled, [("twitter",)])
+        self.assertNotEqual(Channel.objects.get(name="twitter").resubscribe_at, None)
+        tasks.update_subscriptions("twitter")
+        partition = StreamPartition.objects.get(pk=self.partition.id)
+        self.assertIn("newerchallenge", partition.get_hashtags())
+        self.assertNotIn("newchallenge", partition.get_hashtags())
+        self.assertEqual(partition.version, self.partition.version + 1)
+        self.assertIn("newerchallenge", json.loads(Channel.objects.get(name="twitter").session_info)["hashtags"])
+        # Once applied, the next change schedules another update
+        self.assertEqual(Channel.objects.get(name="twitter").resubscribe_at, None)
+        challenge.delete()
+        self.assertEqual(len(self.scheduled), 2)
+
+    def test_unchanged_terms_keep_the_streams(self):
+        Initiative.objects.filter(pk=1).update(name="Renamed initiative")
+        Initiative.objects.get(pk=1).save()
+        tasks.update_subscriptions("twitter")
+        self.assertEqual(StreamPartition.objects.get(pk=self.partition.id).version, self.partition.version)
+
+
+class TestLoadShedding(TestCase):
+
+    def setUp(self):
+        self.org_settings = dict(load_shedding.shedding_settings)
+        load_shedding.shedding_settings['spool_dir'] = tempfile.mkdtemp()
+        self.processed = []
+        self.queue = self.build_queue()
+
+    def tearDown(self):
+        shutil.rmtree(load_shedding.shedding_settings['spool_dir'])
+        load_shedding.shedding_settings.update(self.org_settings)
+
+    def build_queue(self):
+        return load_shedding.ProcessingQueue(1, lambda status: self.processed.append(status.id_str),
+                                             lambda data: tweepy.Status.parse(None, data), high_watermark=2,
+                                             low_watermark=0)
+
+    def build_status(self, post_id, text, reply_to=None, source="Twitter Web Client", retweet=False):
+        data = {"id_str": post_id, "text": text, "source": source, "in_reply_to_user_id_str": reply_to,
+                "entities": {"hashtags": [{"text": word[1:]} for word in text.split() if word.startswith("#")]}}
+        if retweet:
+            data["retweeted_status"] = dict(data)
+        return tweepy.Status.parse(None, data)
+
+    def test_classify(self):
+        accounts, challenge_hashtags = set(["2733258272"]), set(["obamacare"])
+        answer = self.build_status("1", "#calrepcard #ObamaCare A")
+        reply = self.build_status("2", "@josaldev yes", reply_to="2733258272")
+        retweet = self.build_status("3", "#calrepcard #obamacare A", retweet=True)
+        share = self.build_status("4", "#calrepcard #obamacare A", source="Twitter for Websites")
+        chatter = self.build_status("5", "Nice report #calrepcard")
+        self.assertEqual(load_shedding.classify(answer, accounts, challenge_hashtags), None)
+        self.assertEqual(load_shedding.classify(reply, accounts, challenge_hashtags), None)
+        self.assertEqual(load_shedding.classify(retweet, accounts, challenge_hashtags), load_shedding.RETWEETS)
+        self.assertEqual(load_shedding.classify(share, accounts, challenge_hashtags), load_shedding.SHARES)
+        self.assertEqual(load_shedding.classify(chatter, accounts, challenge_hashtags), load_shedding.CHATTER)
+
+    def test_shedding_above_high_watermark(self):
+        self.assertTrue(self.queue.put(self.build_status("1", "chatter"), load_shedding.CHATTER))
+        self.assertTrue(self.queue.put(self.build_status("2", "answer")))
+        # The queue reached its high watermark, so only the posts worth processing are queued
+        self.assertFalse(self.queue.put(self.build_status("3", "chatter"), load_shedding.CHATTER))
+        self.assertTrue(self.queue.put(self.build_status("4", "answer")))
+        self.assertEqual(self.queue.get_stats(), {'queue_depth': 3, 'shedding': True, 'deferred_retweets': 0,
+                                                  'deferred_shares': 0, 'deferred_chatter': 1})
+        for _ in range(2):
+            self.assertTrue(self.queue.step(timeout=0))
+        self.assertEqual(self.processed, ["1", "2"])
+        self.assertTrue(self.queue.shedding)
+        # Once the queue is down to the low watermark the deferred posts are processed
+        self.assertTrue(self.queue.step(timeout=0))
+        self.assertFalse(self.queue.shedding)
+        self.assertEqual(self.processed, ["1", "2", "4", "3"])
+        self.assertFalse(self.queue.step(timeout=0))
+        self.assertTrue(self.queue.spool.is_empty())
+
+    def test_falling_behind_warning(self):
+        self.queue.record_warning()
+        self.assertFalse(self.queue.put(self.build_status("1", "retweet"), load_shedding.RETWEETS))
+        self.assertFalse(self.queue.step(timeout=0))
+        self.assertTrue(self.queue.shedding)
+        self.assertEqual(self.processed, [])
+        # The shedding stops once Twitter stopped warning for a while
+        self.queue.last_warning -= load_shedding.shedding_settings['cooldown']
+        self.assertFalse(self.queue.step(timeout=0))
+        self.assertEqual(self.processed, ["1"])
+
+    def test_replay_under_steady_traffic(self):
+        load_shedding.shedding_settings['replay_batch'] = 2
+        self.queue.record_warning()
+        for post_id in ("1", "2", "3"):
+            self.queue.put(self.build_status(post_id, "chatter"), load_shedding.CHATTER)
+        self.queue.last_warning -= load_shedding.shedding_settings['cooldown']
+        # The queue never goes quiet, but the deferred posts are processed between the ones of the stream
+        self.queue.put(self.build_status("4", "answer"))
+        self.assertTrue(self.queue.step(timeout=0))
+        self.assertEqual(self.processed, ["4", "1", "2"])
+        self.assertFalse(self.queue.spool.is_empty())
+        self.queue.put(self.build_status("5", "answer"))
+        self.assertTrue(self.queue.step(timeout=0))
+        self.assertEqual(self.processed, ["4", "1", "2", "5", "3"])
+        self.assertTrue(self.queue.spool.is_empty())
+
+    def test_stop_spools_queued_posts(self):
+        self.queue.put(self.build_status("1", "answer"))
+        self.queue.stop()
+        self.assertEqual(self.processed, [])
+        # The next listener of the partition processes them
+        queue = self.build_queue()
+        queue.step(timeout=0)
+        self.assertEqual(self.processed, ["1"])
+
+
+class TestRuntime(TestCase):
+    fixtures = ['cparte.json']
+
+    def setUp(self):
+        self.org_settings = dict(runtime.runtime_settings)
+        runtime.runtime_settings['enabled'] = True
+        self.runtime = runtime.StreamRuntime("twitter", db_threads=2)
+        self.started = []
+        self.runtime.start_listener = self.fake_start_listener
+
+    def tearDown(self):
+        runtime.runtime_settings.update(self.org_settings)
+        self.runtime.pool.close()
+        self.runtime.pool.join()
+
+    def fake_start_listener(self, partition_id):
+        self.started.append(partition_id)
+        self.runtime.listeners[partition_id] = (None, FakeThread())
+
+    def test_listeners_follow_the_partitions(self):
+        self.assertEqual(self.runtime.sync(), [])
+        # Connecting the channel doesn't launch Celery tasks, the runtime starts a listener per partition
+        channel_middleware.connect([1], "twitter")
+        partition = StreamPartition.objects.get(channel__name="twitter")
+        self.assertEqual(partition.task_id, None)
+        self.assertEqual(self.runtime.sync(), [partition.id])
+        self.assertEqual(self.runtime.sync(), [partition.id])
+        self.assertEqual(self.started, [partition.id])
+        # A listener that died is started again
+        self.runtime.listeners[partition.id][1].alive = False
+        self.runtime.sync()
+        self.assertEqual(self.started, [partition.id, partition.id])
+
+    def test_posts_processed_by_the_shared_pool(self):
+        threads = []
+        queue = load_shedding.ProcessingQueue(1, lambda status: threads.append(threading.current_thread().name),
+                                              None, pool=self.runtime.pool)
+        queue.put(tweepy.Status.parse(None, {"id_str": "1"}))
+        self.assertTrue(queue.step(timeout=0))
+        self.assertEqual(len(threads), 1)
+        self.assertNotEqual(threads[0], threading.current_thread().name)
+
+
+class FakeThread(object):
+
+    def __init__(self):
+        self.alive = True
+
+    def is_alive(self):
+        return self.alive
+
+
+class TestLease(TestCase):
+    fixtures = ['cparte.json']
+
+    def setUp(self):
+        self.channel = Channel.objects.get(name="twitter")
+        self.partition = partitioning.assign(self.channel, [1])[0]
+        self.channel.connect("", json.dumps(channel_middleware.get_session_info([1])))
+        self.leader = lease.StreamLease(self.partition, owner="node1:100", duration=15)
+        self.standby = lease.StreamLease(self.partition, owner="node2:200", duration=15)
+
+    def test_only_one_holder(self):
+        self.assertTrue(self.leader.acquire())
+        self.assertFalse(self.standby.acquire())
+        self.assertTrue(self.leader.renew())
+        self.assertFalse(self.standby.renew())
+        self.assertEqual(StreamPartition.objects.get(pk=self.partition.id).lease_owner, "node1:100")
+
+    def test_takeover_after_expiry(self):
+        self.assertTrue(self.leader.acquire())
+        expired = timezone.now() - datetime.timedelta(seconds=1)
+        StreamPartition.objects.filter(pk=self.partition.id).update(lease_expires=expired)
+        self.assertTrue(self.standby.acquire())
+        # The old holder finds out that it lost the lease in its next heartbeat
+        self.assertFalse(self.leader.renew())
+
+    def test_release(self):
+        self.assertTrue(self.leader.acquire())
+        self.leader.release()
+        self.assertTrue(self.standby.acquire())
+
+    def test_channel_off(self):
+        self.assertTrue(self.leader.acquire())
+        Channel.objects.get(name="twitter").disconnect()
+        self.assertFalse(self.leader.renew())
+        self.assertFalse(self.standby.acquire())
+
+
+class TestPartitioning(TestCase):
+    fixtures = ['cparte.json']
+
+    def setUp(self):
+        self.channel = Channel.objects.get(name="twitter")
+        self.account = Account.objects.create(owner="Tester", id_in_channel="2900000002", handler="@testeraccount",
+                                              url="https://twitter.com/testeraccount", channel=self.channel,
+                                              consumer_key="key", consumer_secret="secret", token="token",
+                                              token_secret="token_secret")
+        self.initiative = Initiative.objects.create(name="Testing initiative", organizer="Tester",
+                                                    hashtag="testinginit", language="en", account=self.account)
+        self.org_settings = dict(partitioning.partition_settings)
+
+    def tearDown(self):
+        partitioning.partition_settings.update(self.org_settings)
+
+    def test_partition_per_account(self):
+        partitions = partitioning.assign(self.channel, [1, self.initiative.id])
+        self.assertEqual([partition.account_id for partition in partitions], [1, self.account.id])
+        self.assertEqual(partitions[0].get_initiative_ids(), [1])
+        self.assertIn("obamacare", partitions[0].get_hashtags())
+        self.assertEqual(partitions[1].get_hashtags(), ["testinginit"])
+        self.assertEqual(partitions[1].get_follow(), ["2900000002"])
+
+    def test_overflow_and_stable_assignment(self):
+        # The stream of the first account is full with the 8 terms of its initiative, so its new initiative goes to
+        # the stream of the other account
+        partitioning.partition_settings['max_track_terms'] = 8
+        overflowing = Initiative.objects.create(name="Overflowing initiative", organizer="Tester",
+                                                hashtag="overflowinit", language="en", account_id=1)
+        partitions = partitioning.assign(self.channel, [1, self.initiative.id, overflowing.id])
+        self.assertEqual(partitions[0].get_initiative_ids(), [1])
+        self.assertEqual(partitions[1].get_initiative_ids(), [self.initiative.id, overflowing.id])
+        self.assertEqual(partitions[1].get_follow(), ["2900000002", "2733258272"])
+        # With more room the initiatives stay in the streams where they were, and so do their checkpoints
+        partitioning.partition_settings['max_track_terms'] = 400
+        StreamPartition.objects.filter(pk=partitions[0].id).update(last_post_id="513014488925077505")
+        again = partitioning.assign(self.channel, [1, self.initiative.id, overflowing.id], keep_checkpoint=True)
+        self.assertEqual([partition.id for partition in again], [partition.id for partition in partitions])
+        self.assertEqual(again[1].get_initiative_ids(), [self.initiative.id, overflowing.id])
+        self.assertEqual(again[0].last_post_id, "513014488925077505")
+        # Partitions whose initiatives were removed are deleted
+        partitioning.assign(self.channel, [1])
+        self.assertEqual(StreamPartition.objects.filter(channel=self.channel).count(), 1)
+        with self.assertRaises(Exception):
+            partitioning.build_partitions([999])
+
+    def test_ownership(self):
+        partitions = partitioning.assign(self.channel, [1, self.initiative.id])
+        first = partitioning.PartitionOwnership(partitions, partitions[0].id)
+        second = partitioning.PartitionOwnership(partitions, partitions[1].id)
+        # A post that matches both streams is processed only by the first one
+        text = "#calrepcard #testinginit my answer"
+        self.assertTrue(first.owns("1", text, ["calrepcard", "testinginit"], ["100"]))
+        self.assertFalse(second.owns("1", text, ["calrepcard", "testinginit"], ["100"]))
+        self.assertTrue(second.owns("2", "#testinginit", ["testinginit"], ["100"]))
+        self.assertFalse(first.owns("2", "#testinginit", ["testinginit"], ["100"]))
+        # Replies to the account of the second stream belong to it
+        self.assertTrue(second.owns("3", "Thanks", [], ["100", "2900000002"]))
+        # Posts that Twitter matched by rules not applied here are processed by the first stream that delivers them,
+        # whichever it is
+        self.assertTrue(second.owns("4", "Read http://t.co/abc", [], ["100"]))
+        self.assertFalse(first.owns("4", "Read http://t.co/abc", [], ["100"]))
+        self.assertTrue(first.owns("5", "Read http://t.co/abc", [], ["100"]))
+        # The claims expire
+        PostClaim.objects.filter(id_in_channel="4").update(claimed_at=timezone.now() - datetime.timedelta(hours=1))
+        self.assertTrue(first.owns("4", "Read http://t.co/abc", [], ["100"]))
+        self.assertTrue(second.owns("6", u"Opini\xf3n #testinginit", ["testinginit"], ["100"]))
+        self.assertFalse(first.owns("6", u"\xbfQu\xe9 opinas testinginit?", [], ["100"]))
+
+
+class TestProfiler(TestCase):
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def busy_loop(self, seconds):
+        end = time.time() + seconds
+        while time.time() < end:
+            sum(range(100))
+
+    def test_collapsed_stacks(self):
+        sampler = profiler.SamplingProfiler(interval=0.005, mode="wall", output_dir=self.output_dir)
+        self.assertTrue(sampler.start(60))
+        self.assertFalse(sampler.start(60))
+        self.busy_loop(0.3)
+        output_file = sampler.stop()
+        self.assertEqual(os.path.dirname(output_file), self.output_dir)
+        with open(output_file) as f:
+            lines = f.read().splitlines()
+        self.assertTrue(lines)
+        self.assertTrue(any("test.py:busy_loop" in line for line in lines))
+        self.assertTrue(all(line.rsplit(" ", 1)[1].isdigit() for line in lines))
@@ -6,6 +6,18 @@ urlpatterns = patterns('',
     url(r'^$', views.index, name='index'),
     # ex: /cparte/posts/
     url(r'^posts/$', views.posts, name='posts'),
+    # ex: /cparte/export/?format=jsonl&since=2014-09-15T00:00:00
+    url(r'^export/$', views.export_contributions, name='export'),
+    # ex: /cparte/stats/?campaign=1
+    url(r'^stats/$', views.stats, name='stats'),
+    # ex: /cparte/zipcodes/?challenge=4
+    url(r'^zipcodes/$', views.zipcodes, name='zipcodes'),
+    # ex: /cparte/tally/4/
+    url(r'^tally/(?P<challenge_id>\d+)/$', views.challenge_tally, name='tally'),
+    # ex: /cparte/search/?q=water+supply&kind=contributions
+    url(r'^search/$', views.search_posts, name='search'),
+    # ex: /cparte/feed/?challenge=4
+    url(r'^feed/$', views.contributions_feed, name='feed'),
     # ex: /cparte/listen/twitter or /cparte/listen/all
     url(r'^listen/(?P<channel_name>[A-Za-z]+)$', views.listen, name='listen'),
     # ex: /cparte/hangup/twitter or /cparte/hangup/all
@@ -1,12 +1,21 @@
-from django.http import HttpResponse, HttpResponseRedirect
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, HttpResponseRedirect, StreamingHttpResponse
 from django.shortcuts import render
 from django.conf import settings
 
 import channel_middleware
 import ConfigParser
+import export
+import feed
+import geography
+import json
 import logging
 import models
 import os
+import pagination
+import rollups
+import search
+import tally
 
 
 logger = logging.getLogger(__name__)
@@ -17,11 +26,112 @@ def index(request):
 
 
 def posts(request):
-    contribution_posts = models.ContributionPost.objects.all()
-    context = {'posts': contribution_posts}
+    contribution_posts = models.ContributionPost.objects.select_related('author', 'initiative', 'campaign',
+                                                                        'challenge')
+    filters = {}
+    for field in ('initiative', 'campaign', 'challenge'):
+        if request.GET.get(field, "").isdigit():
+            filters[field] = int(request.GET[field])
+    if request.GET.get('status') in dict(models.ContributionPost.STATUS):
+        filters['status'] = request.GET['status']
+    contribution_posts = contribution_posts.filter(**filters)
+    try:
+        page, next_cursor = pagination.get_page(contribution_posts, request.GET.get('cursor'))
+    except ValueError:
+        return HttpResponseBadRequest("Invalid cursor")
+    next_query = request.GET.copy()
+    if next_cursor:
+        next_query['cursor'] = next_cursor
+    context = {'posts': page, 'total': pagination.get_cached_count(contribution_posts), 'filters': filters,
+               'next_url': "?" + next_query.urlencode() if next_cursor else None}
     return render(request, 'cparte/posts.html', context)
 
 
+# Stream the permanent contributions, optionally only the ones preserved since a timestamp or after an id
+@staff_member_required
+def export_contributions(request):
+    export_format = request.GET.get('format', "csv")
+    try:
+        since = export.parse_since(request.GET['since']) if request.GET.get('since') else None
+        since_id = int(request.GET['since_id']) if request.GET.get('since_id') else None
+        lines = export.export(export_format, since, since_id)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+    content_type = "text/csv" if export_format == "csv" else "application/x-ndjson"
+    response = StreamingHttpResponse(lines, content_type=content_type)
+    response['Content-Disposition'] = "attachment; filename=\"contributions.%s\"" % export_format
+    return response
+
+
+# Counts of the contributions of the challenges by status, source and day
+def stats(request):
+    try:
+        challenge_ids = get_challenge_ids(request)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+    summary = rollups.get_summary(challenge_ids)
+    content = dict((challenge_id, summary.get(challenge_id, rollups.new_summary())) for challenge_id in challenge_ids)
+    return HttpResponse(json.dumps(content), content_type="application/json")
+
+
+# Counts of the permanent contributions of the challenges by the zipcode of their authors
+def zipcodes(request):
+    try:
+        challenge_ids = get_challenge_ids(request)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+    counts = geography.get_counts(challenge_ids)
+    content = dict((challenge_id, counts.get(challenge_id, {})) for challenge_id in challenge_ids)
+    return HttpResponse(json.dumps(content), content_type="application/json")
+
+
+# Ids of the challenges requested, all of them or the ones of a campaign or a single challenge
+def get_challenge_ids(request):
+    challenges = models.Challenge.objects.all()
+    for parameter, field in (('campaign', 'campaign'), ('challenge', 'pk')):
+        value = request.GET.get(parameter)
+        if value is not None:
+            if not value.isdigit():
+                raise ValueError("Invalid %s" % parameter)
+            challenges = challenges.filter(**{field: int(value)})
+    return list(challenges.values_list('id', flat=True))
+
+
+# Distribution of the answers of a structured challenge and its trend
+def challenge_tally(request, challenge_id):
+    try:
+        content = tally.get_tally(int(challenge_id)).to_dict()
+    except models.Challenge.DoesNotExist:
+        raise Http404
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+    return HttpResponse(json.dumps(content), content_type="application/json")
+
+
+# Permanent contributions and share posts that contain all the terms of the query, the most relevant first
+def search_posts(request):
+    kinds = {'contributions': [search.CONTRIBUTIONS], 'shares': [search.SHARES], 'all': None}
+    kind = request.GET.get('kind', "all")
+    limit = request.GET.get('limit', "")
+    if kind not in kinds or (limit and not limit.isdigit()):
+        return HttpResponseBadRequest("Invalid kind or limit")
+    results = search.get_results(request.GET.get('q', ""), kinds[kind], int(limit) if limit else None)
+    return HttpResponse(json.dumps({'results': results}), content_type="application/json")
+
+
+# Live feed of the preserved contributions and the counts of their challenges, as Server-Sent Events
+def contributions_feed(request):
+    challenge_id = request.GET.get('challenge', "")
+    if challenge_id and not challenge_id.isdigit():
+        return HttpResponseBadRequest("Invalid challenge")
+    last_event_id = request.META.get('HTTP_LAST_EVENT_ID') or request.GET.get('last_event_id')
+    events = feed.stream(last_event_id, int(challenge_id) if challenge_id else None)
+    response = StreamingHttpResponse(events, content_type="text/event-stream")
+    response['Cache-Control'] = "no-cache"
+    response['X-Accel-Buffering'] = "no"  # Sent right away by the proxies
+    return response
+
+
 def listen(request, channel_name):
     initiatives = [1, 2]   # Add here the ids of the initiatives
 
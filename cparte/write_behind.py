@@ -0,0 +1,220 @@
+# ----------------------------------------------
+# Write-behind of the rows inserted by the
+# processing of the posts. The new authors, the
+# posts placed through the social sharing buttons
+# and the app posts placed from the channel's
+# clients wait a few milliseconds in a buffer and
+# are inserted in batches, so during spikes the
+# cost of the inserts is shared by many posts.
+# ----------------------------------------------
+
+from collections import OrderedDict
+from django.conf import settings
+from django.db import connection, transaction, DatabaseError
+from cparte.models import Author, AppPost, SearchEntry, SharePost
+
+import ConfigParser
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Set the size of the batches from the configuration file
+config = ConfigParser.ConfigParser()
+config.read(os.path.join(settings.BASE_DIR, "cparte/config"))
+
+writer_settings = {'enabled': False, 'max_rows': 100, 'max_delay': 0.05}
+if config.has_section('write_behind'):
+    writer_settings['enabled'] = config.getboolean('write_behind', 'enabled')
+    writer_settings['max_rows'] = config.getint('write_behind', 'max_rows')
+    writer_settings['max_delay'] = config.getint('write_behind', 'max_delay_ms') / 1000.0
+
+
+class WriteBuffer(object):
+    """Rows waiting to be inserted into the db"""
+
+    # The authors are written first because the posts refer to them
+    models = (Author, AppPost, SharePost)
+
+    def __init__(self, max_rows=None, max_delay=None):
+        self.max_rows = max_rows or writer_settings['max_rows']
+        self.max_delay = max_delay or writer_settings['max_delay']
+        self.lock = threading.Lock()
+        self.pending = dict((model, OrderedDict()) for model in self.models)
+        self.first_added = None
+        self.written = 0
+        self.conflicts = 0
+        self.stopped = threading.Event()
+        self.flusher = None
+
+    # The authors are identified by their id within their channel, the posts by their id in the channel
+    def key(self, obj):
+        if isinstance(obj, Author):
+            return obj.channel_id, obj.id_in_channel
+        return obj.id_in_channel
+
+    def size(self):
+        return sum(len(rows) for rows in self.pending.values())
+
+    # Buffer the row. If it was already buffered the first one is kept and returned
+    def add(self, obj):
+        with self.lock:
+            rows = self.pending[obj.__class__]
+            key = self.key(obj)
+            if key in rows:
+                return rows[key]
+            rows[key] = obj
+            if self.first_added is None:
+                self.first_added = time.time()
+            full = self.size() >= self.max_rows
+        if full:
+            self.flush()
+        return obj
+
+    def is_pending(self, model, key):
+        with self.lock:
+            return key in self.pending[model]
+
+    # The row is going to be read from the db, so it has to be written first
+    def sync(self, model, key):
+        if self.is_pending(model, key):
+            self.flush()
+
+    def is_due(self, now=None):
+        first_added = self.first_added
+        return first_added is not None and (now or time.time()) - first_added >= self.max_delay
+
+    # The lock is held while writing, so a row is never missing from both the buffer and the db
+    def flush(self):
+        written = 0
+        with self.lock:
+            for model in self.models:
+                rows = self.pending[model]
+                if rows:
+                    written += self.write(model, rows.values())
+                    self.pending[model] = OrderedDict()
+            self.first_added = None
+            self.written += written
+        return written
+
+    def write(self, model, objs):
+        self.resolve_references(objs)
+        saved = self.get_saved(model, objs)
+        new_objs = [obj for obj in objs if self.key(obj) not in saved]
+        self.conflicts += len(objs) - len(new_objs)
+        written = len(new_objs)
+        if new_objs:
+            try:
+                with transaction.atomic():
+                    model.objects.bulk_create(new_objs)
+                    if model is SharePost:
+                        self.index(new_objs)
+            except DatabaseError as e:
+                logger.error("The batch of %s %s rows couldn't be written, writing them one by one. %s" %
+                             (len(new_objs), model.__name__, e))
+                written = self.write_each(model, new_objs)
+        if model is Author:
+            # bulk_create doesn't set the primary keys, and the posts that refer to the authors need them
+            saved = self.get_saved(model, objs)
+            for obj in objs:
+                obj.pk = saved.get(self.key(obj))
+        return written
+
+    # The share posts written in bulk are added to the search index, which needs their primary keys
+    def index(self, share_posts):
+        saved = self.get_saved(SharePost, share_posts)
+        SearchEntry.add_posts("SP", [(saved[share_post.id_in_channel], share_post.text) for share_post in share_posts])
+
+    def write_each(self, model, objs):
+        written = 0
+        for obj in objs:
+            try:
+                with transaction.atomic():
+                    obj.save(force_insert=True)
+                written += 1
+            except DatabaseError as e:
+                logger.error("The %s %s couldn't be written. %s" % (model.__name__, obj.id_in_channel, e))
+        return written
+
+    # Primary keys of the rows that are already in the db, by key
+    def get_saved(self, model, objs):
+        ids = set(obj.id_in_channel for obj in objs)
+        if model is Author:
+            rows = Author.objects.filter(id_in_channel__in=ids).values_list('channel', 'id_in_channel', 'id')
+            return dict(((channel_id, id_in_channel), pk) for channel_id, id_in_channel, pk in rows)
+        return dict(model.objects.filter(id_in_channel__in=ids).values_list('id_in_channel', 'id'))
+
+    # Set the foreign keys to the rows that were buffered too, now that they were written
+    def resolve_references(self, objs):
+        for obj in objs:
+            for field in obj._meta.fields:
+                if field.rel is not None and getattr(obj, field.attname) is None:
+                    related = getattr(obj, field.get_cache_name(), None)
+                    if related is not None:
+                        setattr(obj, field.attname, related.pk)
+
+    def start(self):
+        if self.flusher is not None and self.flusher.is_alive():
+            return
+        self.stopped.clear()
+        self.flusher = threading.Thread(target=self.run, name="write-behind")
+        self.flusher.daemon = True
+        self.flusher.start()
+
+    def run(self):
+        try:
+            while not self.stopped.wait(self.max_delay):
+                if self.is_due():
+                    try:
+                        self.flush()
+                    except Exception as e:
+                        logger.error("The buffered rows couldn't be written. %s" % e)
+        finally:
+            connection.close()
+
+    # Nothing buffered is lost when the process stops
+    def stop(self):
+        self.stopped.set()
+        if self.flusher is not None and self.flusher is not threading.current_thread():
+            self.flusher.join()
+        self.flusher = None
+        return self.flush()
+
+
+buffer = None
+buffer_lock = threading.Lock()
+
+
+def get_buffer():
+    global buffer
+    with buffer_lock:
+        if buffer is None:
+            buffer = WriteBuffer()
+        buffer.start()
+        return buffer
+
+
+# Insert the row, through the buffer if the write-behind is enabled
+def insert(obj):
+    if not writer_settings['enabled']:
+        obj.save(force_insert=True)
+        return obj
+    return get_buffer().add(obj)
+
+
+def is_pending(model, key):
+    return buffer is not None and buffer.is_pending(model, key)
+
+
+# Write the row if it is buffered, so it can be read from the db
+def sync(model, key):
+    if buffer is not None:
+        buffer.sync(model, key)
+
+
+def flush():
+    if buffer is not None:
+        return buffer.stop()
+    return 0
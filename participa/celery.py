@@ -16,6 +16,10 @@ app = Celery('participa')
 app.config_from_object('django.conf:settings')
 app.autodiscover_tasks(lambda: settings.INSTALLED_APPS)
 
+# Register the remote control command and the signal handler of the sampling profiler
+from cparte import profiler
+profiler.register()
+
 
 @app.task(bind=True)
 def debug_task(self):